@@ -16,31 +16,107 @@ class bf(object):
         self._d = int(value)
     
     def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, end = bf.bits(index)
+            mask = ((1<<(end+1))-1) >> start
+            return (self._d >> start) & mask
         return (self._d >> index) & 1
     
     def __setitem__(self,index,value):
-        value = (value & 1L)<<index
-        mask = (1L)<<index
+        if isinstance(index, slice):
+            start, end = bf.bits(index)
+            mask = ((1<<(end+1))-1) >> start
+            value = (value & mask) << start
+            mask = mask << start
+            self._d = (self._d & ~mask) | value
+            return
+        value = (value & 1)<<index
+        mask = 1<<index
         self._d = (self._d & ~mask) | value
-    
+
+    # Python 2 hands simple slices to these instead.
     def __getslice__(self, start, end):
-        if start > end:
-            tmp = end
-            end = start
-            start = tmp
-        mask = (((1L)<<(end+1))-1) >> start
-        return (self._d >> start) & mask
+        return self.__getitem__(slice(start, end))
     
     def __setslice__(self, start, end, value):
+        self.__setitem__(slice(start, end), value)
+
+    # (low, high) bit numbers of a slice, whichever way round it was.
+    @staticmethod
+    def bits(index):
+        start = index.start
+        end = index.stop
         if start > end:
             tmp = end
             end = start
             start = tmp
-        mask = (((1L)<<(end+1))-1) >> start
-        value = (value & mask) << start
-        mask = mask << start
-        self._d = (self._d & ~mask) | value
-        return (self._d >> start) & mask
+        return (start, end)
     
     def __int__(self):
         return self._d
+
+#
+# Precompiled register descriptions. The masks and shifts are worked
+# out once, when the register's declared, and everything after that
+# works on plain ints: nothing gets allocated per access.
+#
+#   SPISR = Register('SPISR', 0x64, RX_EMPTY=0, TX_EMPTY=2)
+#   SPICR = Register('SPICR', 0x60, SPE=1, MASTER=2, ...)
+#
+#   val & SPISR.TX_EMPTY.mask           - test a bit
+#   SPICR.encode(SPE=1, MASTER=1)       - build a value
+#   SPICR.SPE.set(val, 0)               - change one field
+#   SPICR.decode(val)                   - { 'SPE' : 1, 'MASTER' : 1, ... }
+#
+# Fields are a bit number, or a (high, low) pair the same as bf slices
+# (either order).
+#
+class Field(object):
+    __slots__ = ('name', 'low', 'width', 'mask')
+
+    def __init__(self, name, bits):
+        self.name = name
+        if isinstance(bits, tuple):
+            low, high = bf.bits(slice(bits[0], bits[1]))
+        else:
+            low = high = bits
+        self.low = low
+        self.width = high - low + 1
+        self.mask = ((1 << self.width) - 1) << low
+
+    def get(self, value):
+        return (value & self.mask) >> self.low
+
+    def set(self, value, field):
+        return (value & ~self.mask) | ((field << self.low) & self.mask)
+
+    def encode(self, field):
+        return (field << self.low) & self.mask
+
+class Register(object):
+    def __init__(self, name, offset, **fields):
+        self.name = name
+        self.offset = offset
+        self.fields = []
+        for fname in fields:
+            if hasattr(self, fname):
+                raise ValueError("%s: field name %s is taken" % (name, fname))
+            field = Field(fname, fields[fname])
+            setattr(self, fname, field)
+            self.fields.append(field)
+        self.fields.sort(key=lambda f: f.low)
+
+    def field(self, name):
+        return getattr(self, name)
+
+    # Build a value: 'value' with the given fields replaced.
+    def encode(self, value=0, **fields):
+        for fname in fields:
+            value = getattr(self, fname).set(value, fields[fname])
+        return value
+
+    def decode(self, value):
+        result = {}
+        for field in self.fields:
+            result[field.name] = field.get(value)
+        return result
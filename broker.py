@@ -0,0 +1,630 @@
+from socket import *
+import collections
+import json
+import os
+import struct
+import sys
+import time
+import select
+from array import array
+
+import codec
+import controller
+import discovery
+import metrics
+import poll
+import regcache
+import retry
+import udp
+
+#
+# Sharing the boards between processes. Only one process can have the
+# host port (18521), so instead of every script opening the boards
+# itself, a broker does, and the scripts talk to it over a Unix
+# socket:
+#
+#	python broker.py &
+#
+#	dev = broker.BrokerTOF(priority=1)
+#	print dev.readTemperature()
+#
+# BrokerTOF is the same board as udp.TOFProto (it's the same
+# udp.TOFBoard on top) so spi.py, iic.py and telemetry.py all run on
+# it unchanged. Underneath, BrokerFPGA sends each request to the
+# broker, which runs it on its own handle for the board (a TOFProto
+# on one controller.BoardController). Batches and block transfers go
+# over whole and are run there as controller.Workers, so the broker
+# keeps everything else moving while they wait on polls.
+#
+# The broker keeps requests queued per client and only lets a few at a
+# time into a board's own queue, so it gets to choose who goes next:
+# the client with the highest priority (given when it connects) that
+# has something to do, and among equals whoever's been waiting
+# longest. A client's requests are always done in order, and nothing
+# after one of its batches starts until the batch is done. Lower
+# priority clients also leave a couple of slots in the board's window
+# free, so a monitor polling a few registers at priority 1 gets
+# straight onto the wire past a DAQ client streaming at priority 0.
+# Clients at the same priority take turns.
+#
+# Reads of the same register (and count) from different clients that
+# are waiting on the same answer are sent once: a read that turns up
+# while an identical one is on the wire gets that one's reply. That's
+# only done if the read was sent after the client's own last write
+# (or batch), so nobody reads something older than what they did, and
+# never for FIFOs (regcache.FIFO), where two reads aren't one.
+#
+# Messages either way are a 32-bit length and then JSON, at most
+# MAX_MESSAGE bytes of it: a client that sends anything else is
+# dropped. The socket is $HELIX_TOF_BROKER, or ~/.helix_tof_broker if
+# that isn't set (see discovery.default_path).
+#
+
+FRAME = struct.Struct('!I')
+# (a write_block of a million words is about 11 MB)
+MAX_MESSAGE = 64*1024*1024
+
+def default_path():
+	return discovery.default_path('broker')
+
+def send_message(sock, msg):
+	data = json.dumps(msg, separators=(',', ':'))
+	sock.sendall(FRAME.pack(len(data)) + data)
+
+# Take every whole message off the front of 'buf'.
+# Returns (messages, what's left). Raises ValueError if one's too
+# long or isn't JSON.
+def split_messages(buf):
+	msgs = []
+	pos = 0
+	while len(buf) - pos >= FRAME.size:
+		n = FRAME.unpack_from(buf, pos)[0]
+		if n > MAX_MESSAGE:
+			raise ValueError("%d byte message is too long" % n)
+		if len(buf) - pos - FRAME.size < n:
+			break
+		msgs.append(json.loads(buf[pos + FRAME.size:pos + FRAME.size + n]))
+		pos = pos + FRAME.size + n
+	return (msgs, buf[pos:])
+
+# What can come back as an error, by name. Anything else turns into
+# a retry.TransactionError.
+ERRORS = dict([ (cls.__name__, cls) for cls in (retry.TransactionError, retry.NoResponse,
+				retry.ShortReply, retry.NotConnected, retry.WriteLost, poll.PollTimeout, ValueError, IndexError) ])
+
+def error_message(e):
+	name = type(e).__name__
+	if isinstance(e, poll.PollTimeout):
+		args = [ e.name, e.polls, e.elapsed, e.value ]
+	elif name in ERRORS:
+		args = [ str(e) ]
+	else:
+		args = [ "%s: %s" % (name, e) ]
+		name = 'TransactionError'
+	return { 'error' : name, 'args' : args }
+
+def make_error(msg):
+	return ERRORS.get(msg['error'], retry.TransactionError)(*msg['args'])
+
+# Arrays (read results) as lists, for JSON.
+def plain(value):
+	if isinstance(value, array):
+		return value.tolist()
+	if type(value) is list:
+		return [ plain(v) for v in value ]
+	return value
+
+# A connection to the broker.
+class Client(object):
+	def __init__(self, sock):
+		self.sock = sock
+		self.rx = ''
+		self.name = None
+		self.priority = 0
+		self.handle = None
+		# messages read but not looked at yet
+		self.inbox = collections.deque()
+		# requests waiting their turn
+		self.queue = collections.deque()
+		# the Worker running its batch/block transfer, if there is one
+		self.busy = None
+		# when its last write or batch went out (see Broker.tick):
+		# only reads sent after that can answer its reads
+		self.fence = 0
+		self.served = 0
+		self.closed = False
+
+class Broker(object):
+	# requests allowed into a board's pending queue (beyond its
+	# window) at once: anything else waits here to be scheduled
+	backlog = 1
+	# window slots kept free for the highest priority clients
+	reserve = 2
+	# a client that won't take its replies for this long is dropped
+	send_timeout = 1.0
+
+	# 'path' is the socket to listen on (default_path() by default).
+	def __init__(self, path=None, ctl=None):
+		self.path = path if path != None else default_path()
+		if self.path == None:
+			raise ValueError("no socket for the broker: set $HELIX_TOF_BROKER")
+		self.controller = ctl if ctl != None else controller.BoardController()
+		self.listener = Broker.listen(self.path)
+		self.controller.watch(self.listener, self.accept)
+		# in the order they're served among equals
+		self.clients = []
+		# dna -> handle
+		self.handles = {}
+		# (dna, addr, count) -> (when it was sent, [ (client, id) ], the
+		# clients) for reads on the wire
+		self.reads = {}
+		# Worker -> (client, id)
+		self.work = {}
+		self.clock = 0
+		self.coalesced = 0
+		self.running = False
+
+	@staticmethod
+	def listen(path):
+		if os.path.exists(path):
+			sock = socket(AF_UNIX, SOCK_STREAM)
+			try:
+				sock.connect(path)
+			except error:
+				# left over from last time
+				os.unlink(path)
+			else:
+				sock.close()
+				raise IOError("there's already a broker at %s" % path)
+		sock = socket(AF_UNIX, SOCK_STREAM)
+		sock.bind(path)
+		sock.listen(16)
+		sock.setblocking(0)
+		return sock
+
+	def close(self):
+		for client in list(self.clients):
+			self.drop(client)
+		self.controller.unwatch(self.listener)
+		self.listener.close()
+		if os.path.exists(self.path):
+			os.unlink(self.path)
+
+	def serve_forever(self):
+		print "Broker listening on %s." % self.path
+		self.running = True
+		while self.running:
+			self.handle_messages()
+			self.schedule()
+			if len(self.controller.tasks):
+				for task in self.controller.run(0):
+					self.finish(task)
+			self.controller.process(self.controller.next_wakeup(self.controller.tasks))
+
+	def tick(self):
+		self.clock = self.clock + 1
+		return self.clock
+
+	def accept(self):
+		try:
+			sock = self.listener.accept()[0]
+		except error:
+			return
+		sock.settimeout(self.send_timeout)
+		client = Client(sock)
+		self.clients.append(client)
+		self.controller.watch(sock, lambda: self.receive(client))
+
+	def receive(self, client):
+		try:
+			data = client.sock.recv(65536)
+			if not len(data):
+				raise error("closed")
+			msgs, client.rx = split_messages(client.rx + data)
+		except (error, ValueError):
+			self.drop(client)
+			return
+		client.inbox.extend(msgs)
+
+	def drop(self, client):
+		client.closed = True
+		self.controller.unwatch(client.sock)
+		client.sock.close()
+		if client in self.clients:
+			self.clients.remove(client)
+
+	def send(self, client, msg):
+		if client.closed:
+			return
+		try:
+			send_message(client.sock, msg)
+		except error as e:
+			print "Dropping %s: %s" % (client.name, e)
+			self.drop(client)
+
+	# Send back the result of a Transaction.
+	def reply(self, client, id, txn):
+		client.served = client.served + 1
+		if txn.error != None:
+			msg = error_message(txn.error)
+		else:
+			msg = { 'value' : plain(txn.value) }
+		msg['id'] = id
+		self.send(client, msg)
+
+	def fail(self, client, id, e):
+		msg = error_message(e)
+		msg['id'] = id
+		self.send(client, msg)
+
+	# Connecting (and finding boards) is done right away. Everything
+	# else waits its turn in schedule().
+	def handle_messages(self):
+		for client in list(self.clients):
+			while len(client.inbox) and not client.closed:
+				msg = client.inbox.popleft()
+				if msg.get('op') == 'hello':
+					client.name = msg.get('name')
+					client.priority = msg.get('priority', 0)
+				elif msg.get('op') == 'open':
+					self.open(client, msg)
+				else:
+					client.queue.append(msg)
+
+	# Hook a client up to the board with msg['dna'], or if that's None
+	# to the board that's already open (the first one if there are
+	# several), or the first one that can be found.
+	def open(self, client, msg):
+		dna = msg.get('dna')
+		if dna == None and len(self.handles):
+			dna = sorted(self.handles)[0]
+		if dna not in self.handles:
+			handle = self.controller.board(dna)
+			if handle.target == None:
+				self.fail(client, msg['id'], retry.NotConnected("Failed to find device."))
+				return
+			self.handles[handle.target_dna] = handle
+			dna = handle.target_dna
+		client.handle = self.handles[dna]
+		self.send(client, { 'id' : msg['id'], 'value' : dna })
+
+	# Start requests, as long as there are boards with room for them.
+	def schedule(self):
+		while True:
+			client = self.next_client()
+			if client == None:
+				return
+			# to the back of the line
+			self.clients.remove(client)
+			self.clients.append(client)
+			self.start(client, client.queue.popleft())
+
+	# The highest priority client with a request that can start now,
+	# the one that's waited longest if there's a tie.
+	def next_client(self):
+		top = max([ client.priority for client in self.clients ] + [ 0 ])
+		best = None
+		for client in self.clients:
+			if client.busy != None or not len(client.queue):
+				continue
+			if client.handle != None:
+				handle = client.handle
+				room = handle.window + self.backlog - len(handle.pending) - len(handle.inflight)
+				if room <= (self.reserve if client.priority < top else 0):
+					continue
+			if best == None or client.priority > best.priority:
+				best = client
+		return best
+
+	def start(self, client, msg):
+		op = msg.get('op')
+		id = msg.get('id')
+		handle = client.handle
+		try:
+			if handle == None:
+				raise retry.NotConnected("No board, open one first")
+			if op == 'read':
+				self.read(client, id, msg['addr'], msg['count'])
+			elif op == 'write':
+				client.fence = self.tick()
+				handle.write_async(msg['addr'], msg['data'], not msg['ack'],
+								   callback=lambda txn: self.reply(client, id, txn))
+			elif op in ('batch', 'read_block', 'write_block'):
+				client.fence = self.tick()
+				client.busy = self.controller.spawn_blocking(self.perform, handle, msg)
+				self.work[client.busy] = (client, id)
+			elif op == 'declare':
+				declared = (msg['start'], msg['end'], msg['policy'], msg['clear'])
+				if declared not in handle.cache.ranges:
+					handle.cache.declare(*declared)
+			elif op == 'invalidate':
+				handle.cache.invalidate(msg['addr'])
+			else:
+				raise ValueError("unknown request %r" % op)
+		except Exception as e:
+			self.fail(client, id, e)
+
+	def read(self, client, id, addr, count):
+		handle = client.handle
+		key = (handle.target_dna, addr, count)
+		# (a client's own reads are samples: they all go)
+		if key in self.reads and self.reads[key][0] > client.fence and client not in self.reads[key][2]:
+			self.reads[key][1].append((client, id))
+			self.reads[key][2].add(client)
+			self.coalesced = self.coalesced + 1
+			return
+		if handle.cache.policy(addr)[0] == regcache.FIFO:
+			handle.read_async(addr, count, callback=lambda txn: self.reply(client, id, txn))
+			return
+		waiting = [ (client, id) ]
+		self.reads[key] = (self.tick(), waiting, set([ client ]))
+		def done(txn):
+			if self.reads.get(key, (None, None, None))[1] is waiting:
+				del self.reads[key]
+			for client, id in waiting:
+				self.reply(client, id, txn)
+		handle.read_async(addr, count, callback=done)
+
+	# A batch or block transfer, run as a Worker.
+	def perform(self, handle, msg):
+		if msg['op'] == 'read_block':
+			return handle.read_block(msg['addr'], msg['count'], msg['increment'])
+		if msg['op'] == 'write_block':
+			return handle.write_block(msg['addr'], msg['data'], msg['increment'])
+		b = handle.batch()
+		for step in msg['steps']:
+			if step[0] not in ('read', 'readMultiple', 'write', 'poll'):
+				raise ValueError("unknown batch step %r" % step[0])
+			getattr(b, step[0])(*step[1:])
+		return b.execute(msg.get('timeout'))
+
+	def finish(self, task):
+		client, id = self.work.pop(task)
+		client.busy = None
+		client.served = client.served + 1
+		if task.error != None:
+			self.fail(client, id, task.error)
+		else:
+			self.send(client, { 'id' : id, 'value' : plain(task.result) })
+
+	def report(self):
+		for client in self.clients:
+			print "%s (priority %d): %d requests" % (client.name, client.priority, client.served)
+		print "%d reads coalesced" % self.coalesced
+
+# Same as udp.Batch, but the broker runs it.
+class BrokerBatch(object):
+	def __init__(self, dev):
+		self.dev = dev
+		self.steps = []
+
+	def add(self, step):
+		self.steps.append(step)
+		return len(self.steps)-1
+
+	def read(self, addr):
+		return self.add([ 'read', addr ])
+
+	def readMultiple(self, addr, numReads):
+		return self.add([ 'readMultiple', addr, numReads ])
+
+	def write(self, addr, data, no_acknowledge=False):
+		if type(data) is not list: data = [ data ]
+		return self.add([ 'write', addr, data, no_acknowledge ])
+
+	def poll(self, addr, mask, value=None):
+		return self.add([ 'poll', addr, mask, value ])
+
+	# If it fails, none of it counts as done ('completed' stays 0).
+	def execute(self, timeout=None):
+		self.results = [ None ]*len(self.steps)
+		self.completed = 0
+		results = self.dev.request({ 'op' : 'batch', 'steps' : self.steps, 'timeout' : timeout }).result()
+		self.results = [ array(codec.WORD, r) if type(r) is list else r for r in results ]
+		self.completed = len(self.steps)
+		return self.results
+
+# The register cache lives in the broker, since any client can change
+# anything: nothing's cached here, and declarations and invalidations
+# are passed on to the broker's.
+class BrokerCache(regcache.RegisterCache):
+	def __init__(self, dev):
+		regcache.RegisterCache.__init__(self)
+		self.dev = dev
+
+	def declare(self, start, end, policy, clear=0):
+		regcache.RegisterCache.declare(self, start, end, policy, clear)
+		self.dev.post({ 'op' : 'declare', 'start' : start, 'end' : end, 'policy' : policy, 'clear' : clear })
+
+	def invalidate(self, addr=None):
+		regcache.RegisterCache.invalidate(self, addr)
+		self.dev.post({ 'op' : 'invalidate', 'addr' : addr })
+
+	def lookup(self, addr):
+		return None
+
+# Same interface as udp.UDPFPGA, through the broker. 'dna' None is
+# whatever board the broker has open (or can find). Higher
+# 'priority' clients go first.
+class BrokerFPGA:
+	# requests outstanding before throttle() waits
+	window = 8
+	# longest a batch can take (polls included)
+	timeout = 2
+	# posted writes (see udp.UDPFPGA.post)
+	post_writes = False
+
+	def __init__(self, dna=None, priority=0, path=None, name=None):
+		self.controller = None
+		self.target_dna = None
+		self.cache = BrokerCache(self)
+		self.poller = poll.Poller(self.idle)
+		self.periodic = []
+		self.next_periodic = None
+		self.metrics = None
+		self.sock = socket(AF_UNIX, SOCK_STREAM)
+		self.sock.connect(path if path != None else default_path())
+		self.rx = ''
+		self.next_id = 0
+		# id -> Transaction waiting for its reply
+		self.waiting = {}
+		# posted writes not known to have landed yet
+		self.posted = collections.deque()
+		if name == None:
+			name = "%s[%d]" % (os.path.basename(sys.argv[0]) if len(sys.argv) else 'python', os.getpid())
+		self.post({ 'op' : 'hello', 'name' : name, 'priority' : priority })
+		self.target_dna = self.request({ 'op' : 'open', 'dna' : dna }).result()
+
+	def close(self):
+		self.sock.close()
+
+	def post(self, msg):
+		send_message(self.sock, msg)
+
+	# Send 'msg' off, and return the Transaction ('txn', or a new one)
+	# its reply completes.
+	def request(self, msg, txn=None):
+		if txn == None:
+			txn = udp.Transaction(self, msg['op'], msg.get('addr'), None)
+		self.next_id = self.next_id + 1
+		msg['id'] = self.next_id
+		self.waiting[self.next_id] = txn
+		self.post(msg)
+		return txn
+
+	# Wait up to 'timeout' seconds (None: for ever) for replies, and
+	# complete whatever they're for.
+	def receive(self, timeout=None):
+		if not len(select.select([self.sock], [], [], timeout)[0]):
+			return
+		data = self.sock.recv(65536)
+		if not len(data):
+			waiting = self.waiting
+			self.waiting = {}
+			for txn in waiting.values():
+				txn.complete(None, retry.NotConnected("The broker went away"))
+			return
+		msgs, self.rx = split_messages(self.rx + data)
+		for msg in msgs:
+			txn = self.waiting.pop(msg['id'], None)
+			if txn == None:
+				continue
+			if 'error' in msg:
+				txn.complete(None, make_error(msg))
+			elif txn.opcode == 'RD':
+				txn.complete(array(codec.WORD, msg['value']))
+			else:
+				txn.complete(msg['value'])
+
+	def enable_metrics(self, m=None):
+		self.metrics = m if m != None else metrics.Metrics()
+		return self.metrics
+
+	def disable_metrics(self):
+		self.metrics = None
+
+	def read_async(self, addr, numReads=1, callback=None):
+		txn = udp.Transaction(self, 'RD', addr, None, numReads, callback=callback)
+		return self.request({ 'op' : 'read', 'addr' : addr, 'count' : numReads }, txn)
+
+	def write_async(self, addr, data, no_acknowledge=False, callback=None):
+		if type(data) is not list: data = [ data ]
+		txn = udp.Transaction(self, 'WR', addr, None, len(data), not no_acknowledge, callback=callback)
+		return self.request({ 'op' : 'write', 'addr' : addr, 'data' : data, 'ack' : not no_acknowledge }, txn)
+
+	def batch(self):
+		return BrokerBatch(self)
+
+	def readMultiple(self, addr, numReads):
+		if numReads > codec.MAX_WORDS:
+			raise ValueError("%d words is more than one read (max %d)" % (numReads, codec.MAX_WORDS))
+		result = self.read_async(addr, numReads).result()
+		if len(self.posted):
+			self.fence()
+		return result
+
+	def read(self, addr):
+		return int(self.readMultiple(addr, 1)[0])
+
+	def write(self, addr, data, no_acknowledge=False):
+		txn = self.write_async(addr, data, no_acknowledge)
+		if no_acknowledge == True:
+			return
+		if self.post_writes:
+			self.posted.append(txn)
+			while len(self.posted) and self.posted[0].done and self.posted[0].error == None:
+				self.posted.popleft()
+			self.throttle()
+			return txn.count
+		return txn.result()
+
+	def modify(self, addr, mask, value):
+		cur = self.read(addr)
+		return self.write(addr, (cur & ~mask) | (value & mask))
+
+	# Block transfers go over whole, and the broker pipelines them.
+	def read_block(self, addr, count, increment=False):
+		msg = { 'op' : 'read_block', 'addr' : addr, 'count' : count, 'increment' : increment }
+		return array(codec.WORD, self.request(msg).result())
+
+	def write_block(self, addr, data, increment=False):
+		msg = { 'op' : 'write_block', 'addr' : addr, 'data' : list(data), 'increment' : increment }
+		return self.request(msg).result()
+
+	def wait(self, txn):
+		while not txn.done:
+			self.receive()
+
+	# Requests go to the broker as they're made, so there's nothing
+	# to send: just check every posted write landed.
+	def fence(self):
+		posted = self.posted
+		self.posted = collections.deque()
+		lost = [ txn for txn in posted if txn.wait().error != None ]
+		if len(lost):
+			raise retry.WriteLost("%d posted write(s) lost: %s" % (len(lost), lost[0].error))
+
+	def wait_all(self):
+		while len(self.waiting):
+			self.receive()
+
+	def throttle(self):
+		while len(self.waiting) > self.window:
+			self.receive()
+
+	# Run the periodic hooks (see udp.run_periodic), then wait up to
+	# 'timeout' for replies or until one of them's due.
+	def process(self, timeout=0):
+		if len(self.periodic):
+			self.next_periodic = udp.run_periodic(self.periodic)
+		if self.next_periodic != None:
+			timeout = min(timeout, max(self.next_periodic - time.time(), 0))
+		self.receive(timeout)
+
+	def idle(self, seconds):
+		deadline = time.time() + seconds
+		while True:
+			remaining = deadline - time.time()
+			if remaining <= 0:
+				break
+			self.process(remaining)
+
+# A TOF board, through the broker.
+class BrokerTOF(udp.TOFBoard, BrokerFPGA):
+	def __init__(self, dna=None, priority=0, path=None, name=None):
+		BrokerFPGA.__init__(self, dna, priority, path, name)
+		print "Connected to device %x" % self.target_dna
+		self.setup()
+
+if __name__ == "__main__":
+	import argparse
+	parser = argparse.ArgumentParser(description="Share the TOF boards between processes.")
+	parser.add_argument("--socket", help="Unix socket to listen on (default $HELIX_TOF_BROKER, or ~/.helix_tof_broker)")
+	args = parser.parse_args()
+	broker = Broker(args.socket)
+	try:
+		broker.serve_forever()
+	except KeyboardInterrupt:
+		broker.report()
+	finally:
+		broker.close()
@@ -0,0 +1,94 @@
+import struct
+import sys
+from array import array
+
+#
+# Wire format for the board protocol, with everything precompiled.
+# All multi-byte fields are big-endian.
+#
+# Commands (to port 18520):
+#   ID  : 'I' 'D' 0
+#   SI  : 'S' 'I' 0 dna(8) ip(4)
+#   RD  : 'R' 'D' 0 addr(2) count(1)
+#   WR  : 'W' 'R' 0 addr(2) word(4) * count
+# Replies (to port 18521):
+#   ID  : 'I' 'D' 0 ip(4) dna(8)
+#   SI  : 'S' 'I' 0 dna(8)
+#   RD  : 'R' 'D' 0 addr(2) word(4) * count
+#   WR  : 'W' 'R' 0 addr(2) count(1)
+#
+# A multi-word RD/WR accesses the same address every time (so FIFOs
+# can be filled/drained), at most MAX_WORDS words per datagram.
+#
+# Replies are decoded straight out of a reusable receive buffer
+# (see ReplyBuffer) with unpack_from, so nothing gets sliced.
+#
+
+MAX_WORDS = 16
+MAX_DATAGRAM = 4096
+
+HEADER = struct.Struct('!2sB')
+REPLY = struct.Struct('!2sBH')
+ID_COMMAND = struct.Struct('!2sB')
+SI_COMMAND = struct.Struct('!2sBQ4s')
+RD_COMMAND = struct.Struct('!2sBHB')
+ID_REPLY = struct.Struct('!2sB4sQ')
+SI_REPLY = struct.Struct('!2sBQ')
+WR_REPLY = struct.Struct('!2sBHB')
+# RD replies carry their data after the header
+DATA_OFFSET = REPLY.size
+
+# array typecode for a 32-bit unsigned word
+WORD = 'I' if array('I').itemsize == 4 else 'L'
+SWAP = sys.byteorder == 'little'
+
+# Precompiled WR commands/RD replies for every legal word count.
+WR_COMMANDS = [ struct.Struct('!2sBH%dL' % n) for n in xrange(MAX_WORDS+1) ]
+RD_WORDS = [ struct.Struct('!%dL' % n) for n in xrange(MAX_WORDS+1) ]
+
+def wr_command_struct(count):
+	if count <= MAX_WORDS:
+		return WR_COMMANDS[count]
+	return struct.Struct('!2sBH%dL' % count)
+
+def id_command():
+	return ID_COMMAND.pack('ID', 0)
+
+def static_ip_command(dna, ip):
+	return SI_COMMAND.pack('SI', 0, dna, ip)
+
+def read_command(addr, count=1):
+	return RD_COMMAND.pack('RD', 0, addr, count)
+
+def write_command(addr, data):
+	return wr_command_struct(len(data)).pack('WR', 0, addr, *data)
+
+# Pull 'count' words starting at 'offset' out of a reply buffer into
+# an array. This is the only copy made of the data.
+def words(buf, count, offset=DATA_OFFSET):
+	a = array(WORD)
+	a.fromstring(buffer(buf, offset, 4*count))
+	if SWAP:
+		a.byteswap()
+	return a
+
+# Same, but as a NumPy view directly onto the buffer (no copy at all).
+# The view is only good until the buffer's reused for the next
+# datagram: copy it if you want to keep it.
+def words_view(buf, count, offset=DATA_OFFSET):
+	import numpy
+	return numpy.frombuffer(buf, dtype='>u4', count=count, offset=offset)
+
+# A preallocated receive buffer. recv()/recvfrom() fill it in place
+# with recv_into and return the length: decode with the Structs above
+# using unpack_from(rx.buf), and words(rx.buf, ...).
+class ReplyBuffer(object):
+	def __init__(self, size=MAX_DATAGRAM):
+		self.buf = bytearray(size)
+		self.view = memoryview(self.buf)
+
+	def recv(self, sock):
+		return sock.recv_into(self.buf)
+
+	def recvfrom(self, sock):
+		return sock.recvfrom_into(self.buf)
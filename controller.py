@@ -0,0 +1,480 @@
+from socket import *
+import select
+import threading
+import time
+
+import codec
+import discovery
+import metrics
+import retry
+import udp
+
+# A cooperative task run by BoardController. Tasks are generators
+# which yield whatever they're waiting on:
+#   a Transaction           - resumed with the Transaction once it completes
+#   a list of Transactions  - resumed with the list once they all complete
+#   a number                - sleep that many seconds, resumed with None
+#   None                    - just give everyone else a turn
+# This is how one process runs many boards at once without a thread
+# per board.
+class Task(object):
+	def __init__(self, gen):
+		self.gen = gen
+		self.waiting = []
+		self.resume = None
+		self.wake = 0
+		self.started = False
+		self.done = False
+		self.error = None
+
+	def ready(self, now):
+		if now < self.wake:
+			return False
+		for txn in self.waiting:
+			if not txn.done:
+				return False
+		return True
+
+# A blocking function run as a task, so code written for one board
+# (spi.SPI.program_mcs, say) can run on many boards at once. It gets a
+# thread of its own, but only runs while the controller has handed
+# control to it: wherever it would block (UDPFPGA.wait, idle) it
+# hands control back and waits to be resumed, the same as a Task
+# yielding. Only one thing ever runs at a time, so nothing needs
+# locking. Its return value ends up in 'result'.
+class Worker(Task):
+	def __init__(self, func, args):
+		Task.__init__(self, None)
+		self.func = func
+		self.args = args
+		self.result = None
+		self.thread = None
+		self.go = threading.Event()
+		self.stopped = threading.Event()
+
+	def main(self):
+		self.go.wait()
+		try:
+			self.result = self.func(*self.args)
+		except Exception as e:
+			self.error = e
+		self.done = True
+		self.stopped.set()
+
+# Owns the single host-side port (18521) and routes incoming datagrams
+# to per-board handles. RD/WR replies are routed by source IP, ID/SI
+# replies by the DNA they carry.
+#
+# Usage:
+#	ctl = BoardController()
+#	boards = ctl.connect_all()
+#	print ctl.temperatures()
+#
+# Where each board was last seen is remembered (see discovery.py), so
+# after the first time boards are found with a unicast ID each, all
+# at once, rather than by broadcasting and waiting for answers. SI
+# assignments for any number of boards also go out together.
+#
+# Board handles are ordinary TOFProto objects (or whatever class is
+# passed in) so all of the blocking calls still work on them; any
+# blocking call keeps every other board's transactions moving too.
+class BoardController:
+	broadcast = ("255.255.255.255", 18520)
+	port = 18520
+	# unicast IDs sent to a cached address before giving up on it
+	probe_attempts = 2
+
+	# 'board_cache' is a discovery.BoardCache: by default the shared
+	# one for the default file.
+	def __init__(self, board_cache=None):
+		self.client = socket(AF_INET, SOCK_DGRAM)
+		self.client.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+		self.server = socket(AF_INET, SOCK_DGRAM)
+		self.server.bind(('0.0.0.0', 18521))
+		self.server.setblocking(0)
+		# ip -> board handle
+		self.boards = {}
+		# dna -> ip, from any ID/SI reply we've seen
+		self.found = {}
+		self.tasks = []
+		self.rx = codec.ReplyBuffer()
+		# hook(now) called on every process(), see udp.run_periodic
+		self.periodic = []
+		self.next_periodic = None
+		# other sockets process() waits on: socket -> callback()
+		self.watched = {}
+		self.metrics = None
+		self.broadcast_sent = None
+		# the Worker that has control, if one does
+		self.current = None
+		# for retransmitting ID/SI commands
+		self.retry = retry.RetryPolicy()
+		self.board_cache = board_cache if board_cache != None else discovery.default_cache()
+
+	# Record metrics for ID/SI traffic and every attached board, all
+	# into the one Metrics. Returns it.
+	def enable_metrics(self, m=None):
+		self.metrics = m if m != None else metrics.Metrics()
+		for handle in self.boards.values():
+			handle.metrics = self.metrics
+		return self.metrics
+
+	def disable_metrics(self):
+		self.metrics = None
+		for handle in self.boards.values():
+			handle.metrics = None
+
+	def send_broadcast(self, datagram):
+		self.client.setsockopt(SOL_SOCKET, SO_BROADCAST, 1)
+		self.client.sendto(datagram, self.broadcast)
+		self.client.setsockopt(SOL_SOCKET, SO_BROADCAST, 0)
+		self.broadcast_sent = time.time()
+		if self.metrics != None:
+			self.metrics.sent(datagram[0:2], None, len(datagram))
+
+	def send_to(self, datagram, ip):
+		self.client.sendto(datagram, (ip, self.port))
+		self.broadcast_sent = time.time()
+		if self.metrics != None:
+			self.metrics.sent(datagram[0:2], None, len(datagram))
+
+	# Broadcast an ID and collect every reply that comes back within
+	# 'window' seconds, or until every board in 'expect' (a list of
+	# DNAs) has answered. The ID's resent on the retry policy's
+	# timeouts in case a board missed it. Returns the DNA -> IP map.
+	def discover(self, window=0.5, expect=None):
+		datagram = udp.UDPFPGA.id_command()
+		deadline = time.time() + window
+		resend = 0
+		attempt = 0
+		while True:
+			now = time.time()
+			if now >= deadline:
+				break
+			if expect != None and not len([ dna for dna in expect if dna not in self.found ]):
+				break
+			if now >= resend:
+				self.send_broadcast(datagram)
+				resend = now + self.retry.timeout(attempt)
+				attempt = attempt + 1
+				if attempt > self.retry.retries:
+					resend = deadline
+			self.process(min(deadline, resend) - now)
+		self.board_cache.update(self.found)
+		return dict(self.found)
+
+	# Ask each of 'dnas' (by default, every board in the cache) whether
+	# it's still where the cache says, with a unicast ID to each, all
+	# at once. Returns DNA -> IP for the ones that answered; the rest
+	# are dropped from the cache.
+	def probe(self, dnas=None):
+		if dnas == None:
+			dnas = self.board_cache.dnas()
+		targets = {}
+		for dna in dnas:
+			ip = self.board_cache.get(dna)
+			if ip != None:
+				self.found.pop(dna, None)
+				targets[dna] = ip
+		datagram = udp.UDPFPGA.id_command()
+		resend = 0
+		attempt = 0
+		while True:
+			missing = [ dna for dna in targets if dna not in self.found ]
+			if not len(missing):
+				break
+			now = time.time()
+			if now >= resend:
+				if attempt >= self.probe_attempts:
+					break
+				for dna in missing:
+					self.send_to(datagram, targets[dna])
+				resend = now + self.retry.timeout(attempt)
+				attempt = attempt + 1
+			self.process(resend - now)
+		result = {}
+		for dna in targets:
+			if self.found.get(dna) == targets[dna]:
+				result[dna] = targets[dna]
+		self.board_cache.forget([ dna for dna in targets if dna not in result ])
+		return result
+
+	# Where are these boards (by default, everything in the cache)?
+	# Cached ones are probed; anything not cached, or not where it
+	# used to be, is looked for by broadcast. With nothing to go on
+	# (no DNAs and an empty cache) it's just discover(). Returns DNA
+	# -> IP for every board found.
+	def find(self, dnas=None, window=0.5):
+		if dnas == None:
+			dnas = self.board_cache.dnas()
+			if not len(dnas):
+				return self.discover(window)
+		result = self.probe([ dna for dna in dnas if dna in self.board_cache ])
+		missing = [ dna for dna in dnas if dna not in result ]
+		if len(missing):
+			found = self.discover(window, expect=missing)
+			for dna in missing:
+				if dna in found:
+					result[dna] = found[dna]
+		return result
+
+	# A board that's been found but has nothing attached to it yet.
+	def unclaimed(self):
+		for dna in self.found:
+			if self.found[dna] not in self.boards:
+				return dna
+		return None
+
+	# Find a board and hook 'handle' up to it.
+	def connect(self, handle, dna=None):
+		if dna == None:
+			dna = self.unclaimed()
+			if dna == None:
+				self.probe([ d for d in self.board_cache.dnas() if self.board_cache.get(d) not in self.boards ])
+				dna = self.unclaimed()
+			if dna == None:
+				self.discover()
+				dna = self.unclaimed()
+		elif dna not in self.found:
+			self.find([ dna ])
+		if dna == None or dna not in self.found:
+			print "Failed to find device."
+			return False
+		self.attach(handle, self.found[dna], dna)
+		return True
+
+	# Handles for a whole crate: every board in 'dnas' that can be
+	# found (see find()). Returns DNA -> handle.
+	def connect_all(self, dnas=None, cls=udp.TOFProto):
+		found = self.find(dnas)
+		return dict([ (dna, self.board(dna, cls=cls)) for dna in sorted(found) ])
+
+	# Give every board in 'assignments' (DNA -> IP) its address. All
+	# the SIs go out together, and the ones that haven't been
+	# acknowledged are resent on the retry policy's timeouts until
+	# 'window' runs out. Returns DNA -> IP for the boards that
+	# acknowledged.
+	def assign_ips(self, assignments, window=2):
+		commands = {}
+		for dna in assignments:
+			ip = assignments[dna]
+			if len(ip) == 4:
+				ip = inet_ntoa(ip)
+			self.found.pop(dna, None)
+			commands[dna] = (ip, udp.UDPFPGA.static_ip_command(dna, inet_aton(ip)))
+		deadline = time.time() + window
+		resend = 0
+		attempt = 0
+		while True:
+			waiting = [ dna for dna in commands if dna not in self.found ]
+			now = time.time()
+			if not len(waiting) or now >= deadline:
+				break
+			if now >= resend:
+				for dna in waiting:
+					self.send_broadcast(commands[dna][1])
+				resend = now + self.retry.timeout(attempt)
+				attempt = attempt + 1
+			self.process(min(deadline, resend) - now)
+		result = {}
+		for dna in commands:
+			if dna in self.found:
+				self.found[dna] = commands[dna][0]
+				result[dna] = commands[dna][0]
+		self.board_cache.update(result)
+		return result
+
+	def assign_ip(self, handle, dna, ip, window=2):
+		result = self.assign_ips({ dna : ip }, window)
+		if dna not in result:
+			print "No acknowledgement of IP address assignment."
+			print "Check IP address "
+			return False
+		self.attach(handle, result[dna], dna)
+		return True
+
+	def attach(self, handle, ip, dna):
+		handle.target = (ip, self.port)
+		handle.target_dna = dna
+		self.boards[ip] = handle
+		if self.metrics != None:
+			handle.metrics = self.metrics
+
+	def detach(self, handle):
+		if handle.target != None and self.boards.get(handle.target[0]) is handle:
+			del self.boards[handle.target[0]]
+
+	# Convenience: get a handle for a board.
+	def board(self, dna=None, ip=None, cls=udp.TOFProto):
+		return cls(dna, ip, controller=self)
+
+	# Wait on 'sock' in process() too, calling callback() whenever
+	# it's readable (see broker.py).
+	def watch(self, sock, callback):
+		self.watched[sock] = callback
+
+	def unwatch(self, sock):
+		self.watched.pop(sock, None)
+
+	# Wait up to 'timeout' seconds for datagrams (or a watched socket)
+	# and route them, then let every board expire/refill its window.
+	def process(self, timeout=0):
+		ready = select.select([self.server] + self.watched.keys(), [], [], timeout)[0]
+		for sock in ready:
+			if sock in self.watched:
+				self.watched[sock]()
+		if self.server in ready:
+			while True:
+				try:
+					n, addr = self.rx.recvfrom(self.server)
+				except error:
+					break
+				self.route(self.rx.buf, n, addr[0])
+		for handle in self.boards.values():
+			handle.expire()
+			handle.fill()
+		if len(self.periodic):
+			self.next_periodic = udp.run_periodic(self.periodic)
+
+	def route(self, buf, length, ip):
+		if length < codec.HEADER.size:
+			return
+		cmd = codec.HEADER.unpack_from(buf)
+		if cmd[1] != 0:
+			return
+		if cmd[0] == 'ID' and length >= codec.ID_REPLY.size:
+			vals = codec.ID_REPLY.unpack_from(buf)
+			self.found[vals[3]] = inet_ntoa(vals[2])
+			self.broadcast_reply('ID', length)
+		elif cmd[0] == 'SI' and length >= codec.SI_REPLY.size:
+			vals = codec.SI_REPLY.unpack_from(buf)
+			self.found[vals[2]] = ip
+			self.broadcast_reply('SI', length)
+		elif ip in self.boards:
+			self.boards[ip].dispatch(buf, length)
+		elif self.metrics != None:
+			# not from any board we know
+			self.metrics.received(length)
+			self.metrics.mismatch(cmd[0], None, length)
+
+	def broadcast_reply(self, opcode, length):
+		if self.metrics != None:
+			self.metrics.received(length)
+			self.metrics.completed(opcode, 0, time.time() - self.broadcast_sent)
+
+	# Read one register from every board at once.
+	# Returns a DNA -> value map (None if that board didn't answer).
+	def read_all(self, addr):
+		txns = {}
+		for handle in self.boards.values():
+			txns[handle.target_dna] = handle.read_async(addr)
+		result = {}
+		for dna in txns:
+			txn = txns[dna].wait()
+			result[dna] = txn.value[0] if txn.error == None else None
+		return result
+
+	def temperatures(self):
+		result = self.read_all(0x1200)
+		for dna in result:
+			if result[dna] != None:
+				result[dna] = udp.TOFProto.temperature(result[dna])
+		return result
+
+	def spawn(self, gen):
+		task = Task(gen)
+		self.tasks.append(task)
+		return task
+
+	# Run func(*args) as a Worker.
+	def spawn_blocking(self, func, *args):
+		task = Worker(func, args)
+		self.tasks.append(task)
+		return task
+
+	# Hand control to a Worker until it blocks or finishes.
+	def switch(self, worker):
+		worker.waiting = []
+		worker.wake = 0
+		if worker.thread == None:
+			worker.thread = threading.Thread(target=worker.main)
+			worker.thread.daemon = True
+			worker.thread.start()
+		self.current = worker
+		worker.stopped.clear()
+		worker.go.set()
+		worker.stopped.wait()
+		self.current = None
+
+	# Called from inside a Worker: hand control back until everything
+	# in 'waiting' (Transactions) has completed and 'wake' has passed.
+	def suspend(self, waiting=[], wake=0):
+		worker = self.current
+		worker.waiting = waiting
+		worker.wake = wake
+		worker.go.clear()
+		worker.stopped.set()
+		worker.go.wait()
+
+	def step(self, task, value):
+		if isinstance(task, Worker):
+			self.switch(task)
+			return
+		task.waiting = []
+		task.resume = None
+		try:
+			what = task.gen.send(value)
+		except StopIteration:
+			task.done = True
+			return
+		except Exception as e:
+			task.error = e
+			task.done = True
+			return
+		if isinstance(what, udp.Transaction):
+			task.waiting = [ what ]
+			task.resume = what
+		elif isinstance(what, list):
+			task.waiting = what
+			task.resume = what
+		elif what != None:
+			task.wake = time.time() + what
+
+	# Run spawned tasks until they've all finished (or 'timeout'
+	# seconds pass). Returns the tasks that finished.
+	def run(self, timeout=None):
+		start = time.time()
+		while True:
+			now = time.time()
+			for task in self.tasks:
+				if not task.started:
+					task.started = True
+					self.step(task, None)
+				elif not task.done and task.ready(now):
+					self.step(task, task.resume)
+			running = [ task for task in self.tasks if not task.done ]
+			if not len(running):
+				break
+			if timeout != None and now - start > timeout:
+				break
+			self.process(self.next_wakeup(running))
+		finished = [ task for task in self.tasks if task.done ]
+		self.tasks = running
+		return finished
+
+	# How long we can sleep in select before something needs us.
+	def next_wakeup(self, running):
+		now = time.time()
+		wakeup = now + udp.UDPFPGA.timeout
+		for task in running:
+			if not task.started or task.ready(now):
+				return 0
+			if task.wake > now:
+				wakeup = min(wakeup, task.wake)
+		for handle in self.boards.values():
+			deadline = handle.next_deadline()
+			if deadline != None:
+				wakeup = min(wakeup, deadline)
+		if self.next_periodic != None:
+			wakeup = min(wakeup, self.next_periodic)
+		return max(wakeup - now, 0)
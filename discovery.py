@@ -0,0 +1,122 @@
+import os
+
+#
+# Remembering where boards are, so they don't have to be found again
+# every time. Every DNA -> IP learned (from an ID or SI reply) goes in
+# a small text file, one board per line:
+#
+#	<dna, in hex> <ip>
+#
+# Next time round each board can be asked directly with a unicast ID,
+# which takes a round trip, instead of broadcasting and waiting out a
+# window for whatever answers. If a board doesn't answer at its old
+# address (or something else does) the entry's stale: it's dropped
+# and the board is looked for by broadcast instead.
+#
+# The file is $HELIX_TOF_BOARDS, or ~/.helix_tof_boards if that isn't
+# set. Set it to nothing to keep everything in memory.
+#
+# Anything else worth remembering per board goes in a BoardCache of
+# its own, under another name: the flash identity (see spi.SPI.probe)
+# is 'flash', so $HELIX_TOF_FLASH or ~/.helix_tof_flash. Values are
+# just strings without spaces.
+#
+
+def default_path(name='boards'):
+	path = os.environ.get('HELIX_TOF_' + name.upper())
+	if path == None:
+		return os.path.join(os.path.expanduser('~'), '.helix_tof_' + name)
+	if path == '':
+		return None
+	return path
+
+class BoardCache(object):
+	# 'path' None keeps it all in memory.
+	def __init__(self, path=None):
+		self.path = path
+		# dna -> ip
+		self.boards = self.read()
+		# dna -> ip, or None if forgotten, since the last save
+		self.changed = {}
+
+	def read(self):
+		boards = {}
+		if self.path == None or not os.path.exists(self.path):
+			return boards
+		try:
+			f = open(self.path)
+			for line in f:
+				fields = line.split()
+				if len(fields) < 2 or fields[0].startswith('#'):
+					continue
+				try:
+					boards[int(fields[0], 16)] = fields[1]
+				except ValueError:
+					pass
+			f.close()
+		except IOError as e:
+			print "Couldn't read board cache %s: %s" % (self.path, e)
+		return boards
+
+	def __contains__(self, dna):
+		return dna in self.boards
+
+	def __len__(self):
+		return len(self.boards)
+
+	def get(self, dna):
+		return self.boards.get(dna)
+
+	def dnas(self):
+		return self.boards.keys()
+
+	# Record what's been found (a DNA -> IP map), and save if anything
+	# changed.
+	def update(self, found):
+		for dna in found:
+			if self.boards.get(dna) != found[dna]:
+				self.boards[dna] = found[dna]
+				self.changed[dna] = found[dna]
+		self.save()
+
+	def forget(self, dnas):
+		for dna in dnas:
+			if dna in self.boards:
+				del self.boards[dna]
+				self.changed[dna] = None
+		self.save()
+
+	# Write it out. Anything another process saved in the meantime is
+	# kept, unless we've changed it since.
+	def save(self):
+		if self.path == None:
+			self.changed = {}
+		if not len(self.changed):
+			return
+		boards = self.read()
+		for dna in self.changed:
+			if self.changed[dna] == None:
+				boards.pop(dna, None)
+			else:
+				boards[dna] = self.changed[dna]
+		tmp = self.path + '.tmp'
+		try:
+			f = open(tmp, 'w')
+			for dna in sorted(boards):
+				f.write("%x %s\n" % (dna, boards[dna]))
+			f.close()
+			os.rename(tmp, self.path)
+		except (IOError, OSError) as e:
+			print "Couldn't save board cache %s: %s" % (self.path, e)
+			return
+		self.boards = boards
+		self.changed = {}
+
+# One cache per process for each default file, shared by everything
+# that doesn't get handed its own.
+shared = {}
+
+def default_cache(name='boards'):
+	if name not in shared:
+		shared[name] = BoardCache(default_path(name))
+	return shared[name]
@@ -0,0 +1,166 @@
+import sys
+import time
+
+import image
+import retry
+
+#
+# Reprogramming a whole detector at once.
+#
+#	ctl = controller.BoardController()
+#	boards = ctl.connect_all()
+#	fleet.Fleet(ctl, boards.values()).program("image.mcs")
+#
+# The image is loaded once (see image.py), and every board's flash is
+# programmed at the same time, each by the usual spi.SPI.program_image
+# running as a controller.Worker, so the whole thing takes about as
+# long as the slowest board. A status line shows how many boards are
+# at each stage and the total throughput. Boards that fail are tried
+# again (incrementally, so whatever did get programmed isn't redone).
+# Then every board that made it is reloaded, and waited for until it
+# answers again.
+#
+
+# what SPI.say() messages mean for where a board's got to
+PHASES = [ ('Comparing', 'comparing'), ('Erasing', 'erasing'), ('Programming', 'programming'),
+		   ('Complete', 'done') ]
+
+class Fleet(object):
+	# extra tries for a board that fails
+	retries = 2
+	# how long a board gets to come back after a reload
+	reload_timeout = 30.0
+	# seconds between status lines
+	report_interval = 0.5
+
+	# 'boards' are TOFProto handles attached to 'controller'.
+	def __init__(self, controller, boards):
+		self.controller = controller
+		self.boards = dict([ (handle.target_dna, handle) for handle in boards ])
+		# dna -> phase, and progress through it
+		self.phase = {}
+		self.progress = {}
+		# dna -> when it finished programming
+		self.finished = {}
+		# dna -> what went wrong last
+		self.errors = {}
+		self.start = None
+		self.next_report = 0
+
+	# Program every board with 'filename', and reload them if 'reload'.
+	# Returns DNA -> None for the boards that made it, or the error
+	# for those that didn't.
+	def program(self, filename, reload=True, incremental=False, allow_bulk=False):
+		f = image.load(filename)
+		self.start = time.time()
+		todo = sorted(self.boards)
+		good = []
+		for attempt in xrange(self.retries + 1):
+			tasks = {}
+			for dna in todo:
+				spi = self.boards[dna].spi
+				self.watch(dna, spi)
+				tasks[dna] = self.controller.spawn_blocking(spi.program_image, f, 0,
+															incremental or attempt > 0, allow_bulk)
+			self.controller.periodic.append(self.report)
+			try:
+				self.controller.run()
+			finally:
+				self.controller.periodic.remove(self.report)
+			self.report(time.time(), True)
+			print
+			todo = []
+			for dna in sorted(tasks):
+				if tasks[dna].error != None:
+					self.errors[dna] = tasks[dna].error
+					self.phase[dna] = 'failed'
+					todo.append(dna)
+				else:
+					self.errors.pop(dna, None)
+					good.append(dna)
+			if not len(todo):
+				break
+			for dna in todo:
+				print "%x failed: %s" % (dna, self.errors[dna])
+			if attempt < self.retries:
+				print "Retrying %d board(s)." % len(todo)
+		if reload and len(good):
+			self.reload(good)
+		self.summary()
+		return dict([ (dna, self.errors.get(dna)) for dna in self.boards ])
+
+	# Send a board's progress here instead of printing it.
+	def watch(self, dna, spi):
+		self.phase[dna] = 'starting'
+		self.progress[dna] = 0.0
+		def say(text):
+			for prefix, phase in PHASES:
+				if text.startswith(prefix):
+					self.phase[dna] = phase
+					self.progress[dna] = 0.0
+					if phase == 'done':
+						self.finished[dna] = time.time()
+		def update_progress(progress):
+			self.progress[dna] = progress
+		spi.say = say
+		spi.update_progress = update_progress
+
+	def programmed(self):
+		total = 0
+		for handle in self.boards.values():
+			if 'spi' in handle.__dict__:
+				total = total + handle.spi.programmed
+		return total
+
+	# Periodic hook (see udp.run_periodic): print the status line.
+	def report(self, now, force=False):
+		if not force and now < self.next_report:
+			return self.next_report
+		self.next_report = now + self.report_interval
+		counts = {}
+		for dna in self.phase:
+			counts[self.phase[dna]] = counts.get(self.phase[dna], 0) + 1
+		stages = ', '.join([ '%d %s' % (counts[phase], phase) for phase in sorted(counts) ])
+		elapsed = max(now - self.start, 1e-6)
+		kb = self.programmed()/1024.0
+		sys.stdout.write("\r%d boards: %s; %.0f kB programmed, %.1f kB/s, %.0f s   " % (len(self.boards),
+						 stages, kb, kb/elapsed, elapsed))
+		sys.stdout.flush()
+		return self.next_report
+
+	# Reload every board in 'dnas' and wait until they all answer
+	# again (from wherever they turn up).
+	def reload(self, dnas):
+		tasks = [ self.controller.spawn_blocking(self.boards[dna].reloadFPGA) for dna in dnas ]
+		self.controller.run()
+		for dna, task in zip(dnas, tasks):
+			self.phase[dna] = 'reloading' if task.error == None else 'failed'
+			if task.error != None:
+				self.errors[dna] = task.error
+		waiting = [ dna for dna in dnas if self.phase[dna] == 'reloading' ]
+		deadline = time.time() + self.reload_timeout
+		while len(waiting) and time.time() < deadline:
+			found = self.controller.find(waiting)
+			for dna in found:
+				handle = self.boards[dna]
+				if handle.target == None or handle.target[0] != found[dna]:
+					self.controller.detach(handle)
+					self.controller.attach(handle, found[dna], dna)
+				self.phase[dna] = 'back'
+			waiting = [ dna for dna in waiting if dna not in found ]
+			self.report(time.time(), True)
+		for dna in waiting:
+			self.phase[dna] = 'failed'
+			self.errors[dna] = retry.NoResponse("%x didn't come back after reload" % dna)
+		print
+
+	def summary(self):
+		elapsed = time.time() - self.start
+		good = [ dna for dna in self.boards if dna not in self.errors ]
+		print "%d of %d boards done in %.1f s." % (len(good), len(self.boards), elapsed)
+		times = [ self.finished[dna] - self.start for dna in good if dna in self.finished ]
+		if len(times):
+			print "Programming took %.1f s to %.1f s per board, %.1f kB/s overall." % (min(times), max(times),
+				self.programmed()/1024.0/max(times))
+		for dna in sorted(self.errors):
+			print "%x: %s" % (dna, self.errors[dna])
@@ -0,0 +1,163 @@
+import poll
+import retry
+from bf import Register
+
+# Xilinx AXI IIC controller in dynamic mode. This presumes you have
+# read/write/readMultiple and a batch() to queue them up with (see
+# udp.Batch), same as spi.AXIQuadSPI.
+#
+# Each transfer is one batch. The address and payload go into the TX
+# FIFO with a single write. Reads set RX_FIFO_PIRQ to however much of
+# the transfer fits in the RX FIFO, wait once for the ISR to say it's
+# there, and pull it all out with one readMultiple. Anything bigger
+# than the FIFOs just takes more loads of them.
+#
+# A NAK makes a transfer return False/None. Losing the board (a
+# retry.TransactionError, or poll.PollTimeout if the controller never
+# finishes) raises, after leaving the controller to be reset.
+class AXIIIC:
+	fifo_depth = 16
+	# the length byte of a dynamic-mode read
+	max_read = 255
+	# roughly one byte at 100 kHz
+	byte_time = 0.0001
+	# times to redo a transfer that a lost request broke
+	retries = 3
+
+	ISR = Register('ISR', 0x020, ARB_LOST=0, TX_ERROR=1, TX_EMPTY=2, RX_FULL=3,
+				   BUS_NOT_BUSY=4, ADDRESSED=5, NOT_ADDRESSED=6, TX_HALF_EMPTY=7)
+	CR = Register('CR', 0x100, EN=0, TX_FIFO_RESET=1, MSMS=2, TX=3, TXAK=4, RSTA=5, GC_EN=6)
+	SR = Register('SR', 0x104, ABGC=0, AAS=1, BB=2, SRW=3, TX_FIFO_FULL=4,
+				  RX_FIFO_FULL=5, RX_FIFO_EMPTY=6, TX_FIFO_EMPTY=7)
+	TX_FIFO = Register('TX_FIFO', 0x108, DATA=(7,0), START=8, STOP=9)
+	SOFTR = 0x040
+	RX_FIFO = 0x10C
+	RX_FIFO_PIRQ = 0x120
+
+	# TX_FIFO: address byte with start (and the read bit), last byte
+	# (or the read length) with stop
+	START = TX_FIFO.START.mask
+	STOP = TX_FIFO.STOP.mask
+	READ = 0x1
+	RESET_KEY = 0xA
+	CR_ENABLE = CR.encode(EN=1)
+	CR_FLUSH = CR.encode(EN=1, TX_FIFO_RESET=1)
+	# a load of the TX FIFO went out, or the device NAKed (which
+	# leaves the rest of it there)
+	TX_DONE = ISR.TX_ERROR.mask | ISR.TX_EMPTY.mask
+
+	def __init__(self, dev, base):
+		self.dev = dev
+		self.base = base
+		self.isr = base + self.ISR.offset
+		self.cr = base + self.CR.offset
+		self.sr = base + self.SR.offset
+		self.tx_fifo = base + self.TX_FIFO.offset
+		self.rx_fifo = base + self.RX_FIFO
+		self.rx_fifo_pirq = base + self.RX_FIFO_PIRQ
+		self.softr = base + self.SOFTR
+		# reset() before the first transfer
+		self.ready = False
+
+	# Put the controller in a known state (both FIFOs empty). Happens
+	# by itself before the first transfer, and the one after a failure.
+	def reset(self):
+		b = self.dev.batch()
+		b.write(self.softr, self.RESET_KEY)
+		b.write(self.cr, self.CR_ENABLE)
+		b.execute()
+		self.ready = True
+
+	# Write 'data' to the device with 7-bit address 'dev'.
+	# Returns True if it all went out and got acknowledged.
+	# Each load of the TX FIFO waits for the ISR to say it's empty or
+	# NAKed, then clears TX_EMPTY (the core only sets it when the FIFO
+	# empties) for the next. The last byte's ACK comes after TX_EMPTY,
+	# so the ISR's checked again once the bus is idle.
+	# A write that fails partway is done over: the device may see the
+	# start of it twice, which is fine for register writes.
+	def write(self, dev, data):
+		words = [ (dev << 1) | self.START ] + list(data)
+		words[-1] = words[-1] | self.STOP
+		b = self.dev.batch()
+		status = []
+		for start in xrange(0, len(words), self.fifo_depth):
+			b.write(self.tx_fifo, words[start:start+self.fifo_depth])
+			status.append(b.poll(self.isr, self.TX_DONE))
+			b.write(self.isr, self.ISR.TX_EMPTY.mask)
+		b.poll(self.sr, self.SR.BB.mask, 0)
+		status.append(b.read(self.isr))
+		return self.finish(b, status, len(words), True) != None
+
+	# Read 'length' bytes from the device with 7-bit address 'dev'.
+	# If 'register' is given (a byte, or a list of them) it's written
+	# first and the read follows a repeated start. Returns a list of
+	# bytes, or None if the device didn't answer.
+	# With 'register' a read that fails partway is done over, since
+	# that sets the device's pointer again. Without, the device has
+	# moved on by however much was read, so it's up to the caller.
+	def read(self, dev, length, register=None):
+		if length > self.max_read:
+			raise ValueError("I2C read of %d bytes (max %d)" % (length, self.max_read))
+		if length == 0:
+			return []
+		words = []
+		if register != None:
+			if type(register) is not list: register = [ register ]
+			words = [ (dev << 1) | self.START ] + register
+		words = words + [ (dev << 1) | self.START | self.READ, length | self.STOP ]
+		b = self.dev.batch()
+		polls = []
+		reads = []
+		rx_full = self.ISR.RX_FULL.mask
+		for start in xrange(0, length, self.fifo_depth):
+			n = min(self.fifo_depth, length - start)
+			b.write(self.rx_fifo_pirq, n - 1)
+			if not start:
+				b.write(self.tx_fifo, words)
+			polls.append(b.poll(self.isr, rx_full | self.ISR.TX_ERROR.mask))
+			reads.append(b.readMultiple(self.rx_fifo, n))
+			if not start:
+				# the TX FIFO's long since empty: leave TX_EMPTY
+				# clear for the next write
+				b.write(self.isr, rx_full | self.ISR.TX_EMPTY.mask)
+			else:
+				b.write(self.isr, rx_full)
+		results = self.finish(b, polls, len(words) + length, register != None)
+		if results == None:
+			return None
+		rxd = []
+		for rd in reads:
+			rxd.extend([ int(val & 0xFF) for val in results[rd] ])
+		return rxd
+
+	# Run the batch, and check the ISR values at 'status' for errors.
+	# Returns the batch results, or None if the device NAKed.
+	# Whatever a failed transfer left behind (the rest of a NAKed
+	# write in the TX FIFO, data nobody read in the RX FIFO,
+	# RX_FIFO_PIRQ, ISR bits) mustn't turn up in the next one, so after
+	# any failure the controller's soft reset before it's used again.
+	# If 'again', a transfer that lost a request is redone (up to
+	# 'retries' times) before the error's raised.
+	def finish(self, b, status, nbytes, again):
+		attempt = 0
+		while True:
+			try:
+				if not self.ready:
+					self.reset()
+				results = b.execute(self.dev.timeout + 10*nbytes*self.byte_time)
+				break
+			except (retry.WriteLost, poll.PollTimeout):
+				# something before this went wrong, or the bus is stuck
+				self.ready = False
+				raise
+			except retry.TransactionError:
+				self.ready = False
+				attempt = attempt + 1
+				if not again or attempt > self.retries:
+					raise
+		for index in status:
+			if results[index] & self.ISR.TX_ERROR.mask:
+				self.ready = False
+				return None
+		return results
@@ -0,0 +1,310 @@
+import hashlib
+import mmap
+import os
+import struct
+
+import discovery
+
+#
+# Flash images, loaded once and then handed out a page at a time
+# without copying.
+#
+#	img = image.load("image.mcs")
+#	dev.spi.program_image(img)
+#
+# An MCS (or Intel HEX) file is text and slow to parse, so it's only
+# parsed the first time: the bytes it holds go in <key>.bin, back to
+# back, and where they go in <key>.plan, along with which pages
+# actually need programming (runs of anything that isn't blank) and
+# the erase plans worked out for it so far (see SPI.plan_erase). The
+# key is the SHA-1 of the MCS file, so the next time the same file is
+# loaded it's hashed, the .bin is mapped in, and that's all.
+#
+# Raw .bin files (and .bit files, whose header is skipped) don't need
+# parsing at all: they're mapped in as they are, at 'address' (0 by
+# default). Their plans are cached the same way, keyed by what's in
+# them.
+#
+# The cache is the directory $HELIX_TOF_IMAGES, or ~/.helix_tof_images
+# if that isn't set (see discovery.default_path). Set it to nothing to
+# keep everything in memory.
+#
+
+page_size = 256
+
+# Part of an Image: 'size' bytes starting at 'offset' in the image's
+# data, which go to the flash at 'start_address'. Sliced by flash
+# address, the same as a hexfile segment, and 'data' is a buffer on
+# the image (so nothing gets copied).
+class Segment(object):
+	def __init__(self, image, start_address, offset, size):
+		self.image = image
+		self.start_address = start_address
+		self.end_address = start_address + size
+		self.offset = offset
+		self.size = size
+
+	def __getitem__(self, s):
+		start = self.start_address if s.start == None else max(s.start, self.start_address)
+		end = self.end_address if s.stop == None else min(s.stop, self.end_address)
+		end = max(start, end)
+		return Segment(self.image, start, self.offset + start - self.start_address, end - start)
+
+	@property
+	def data(self):
+		return buffer(self.image.data, self.offset, self.size)
+
+class Image(object):
+	# 'data' is anything that can be buffered (an mmap, bytearray or
+	# str), 'segments' a list of (address, offset, size). 'runs' and
+	# 'erase_plans' come from a cached plan, if there was one.
+	def __init__(self, data, segments, digest=None, runs=None, erase_plans=None):
+		self.data = data
+		self.segments = [ Segment(self, address, offset, size) for address, offset, size in segments ]
+		self.digest = digest if digest != None else self.hash()
+		# (address, offset, length) of everything that needs programming
+		self.runs = runs if runs != None else self.find_runs()
+		# key (see erase_plan) -> (plan, predicted time)
+		self.erase_plans = erase_plans if erase_plans != None else {}
+		# where to save the plan, if it's cached
+		self.plan_path = None
+
+	def hash(self):
+		h = hashlib.sha1()
+		for seg in self.segments:
+			h.update("%x %x\n" % (seg.start_address, seg.size))
+		for seg in self.segments:
+			h.update(seg.data)
+		return h.hexdigest()
+
+	# Find the pages that aren't blank (erased flash is already all
+	# 1s), merged into runs. Pages are aligned the way the flash's
+	# are, so a page program never wraps.
+	def find_runs(self):
+		runs = []
+		blank = '\xff'*page_size
+		for seg in self.segments:
+			address = seg.start_address
+			while address < seg.end_address:
+				end = min((address/page_size + 1)*page_size, seg.end_address)
+				offset = seg.offset + address - seg.start_address
+				page = self.data[offset:offset + end - address]
+				if page != blank[:end - address]:
+					if len(runs) and runs[-1][0] + runs[-1][2] == address and runs[-1][1] + runs[-1][2] == offset:
+						runs[-1] = (runs[-1][0], runs[-1][1], runs[-1][2] + end - address)
+					else:
+						runs.append((address, offset, end - address))
+				address = end
+		return runs
+
+	# (address, data) for every page that needs programming.
+	def pages(self):
+		for address, offset, length in self.runs:
+			end = address + length
+			while address < end:
+				n = min((address/page_size + 1)*page_size, end) - address
+				yield (address, buffer(self.data, offset, n))
+				address = address + n
+				offset = offset + n
+
+	def page_count(self):
+		count = 0
+		for address, offset, length in self.runs:
+			count = count + (address + length - 1)/page_size - address/page_size + 1
+		return count
+
+	# spi.plan_erase(self, allow_bulk, largest), worked out once per
+	# kind of flash.
+	def erase_plan(self, spi, allow_bulk=False, largest=None):
+		what = (spi.erase_types(), spi.memory_capacity, spi.chip_erase_time(), allow_bulk)
+		if largest != None:
+			what = what + (largest,)
+		key = hashlib.sha1(repr(what)).hexdigest()[:16]
+		if key not in self.erase_plans:
+			self.erase_plans[key] = spi.plan_erase(self, allow_bulk, largest)
+			self.save_plan()
+		return self.erase_plans[key]
+
+	def save_plan(self):
+		if self.plan_path == None:
+			return
+		lines = [ "digest %s\n" % self.digest ]
+		for seg in self.segments:
+			lines.append("segment %x %x %x\n" % (seg.start_address, seg.offset, seg.size))
+		for run in self.runs:
+			lines.append("run %x %x %x\n" % run)
+		for key in sorted(self.erase_plans):
+			plan, predicted = self.erase_plans[key]
+			lines.append("erase %s %r %s\n" % (key, predicted,
+				' '.join([ '%x:%x:%x:%r' % op for op in plan ])))
+		write_file(self.plan_path, ''.join(lines))
+
+# Write 'data' to 'path' by way of a temporary file, so nobody ever
+# sees half of it.
+def write_file(path, data):
+	tmp = path + '.tmp'
+	try:
+		f = open(tmp, 'wb')
+		f.write(data)
+		f.close()
+		os.rename(tmp, path)
+	except (IOError, OSError) as e:
+		print "Couldn't save %s: %s" % (path, e)
+		return False
+	return True
+
+# Everything in a file, mapped in read-only.
+def map_file(filename):
+	f = open(filename, 'rb')
+	try:
+		if os.fstat(f.fileno()).st_size == 0:
+			return ''
+		return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+	finally:
+		f.close()
+
+def file_hash(filename):
+	h = hashlib.sha1()
+	f = open(filename, 'rb')
+	while True:
+		data = f.read(1024*1024)
+		if not len(data):
+			break
+		h.update(data)
+	f.close()
+	return h.hexdigest()
+
+# The cached plan at 'path' as (digest, segments, runs, erase plans),
+# or None if there isn't one.
+def read_plan(path):
+	if not os.path.exists(path):
+		return None
+	digest = None
+	segments = []
+	runs = []
+	erase_plans = {}
+	try:
+		f = open(path)
+		for line in f:
+			fields = line.split()
+			if not len(fields):
+				continue
+			if fields[0] == 'digest':
+				digest = fields[1]
+			elif fields[0] == 'segment':
+				segments.append(tuple([ int(x, 16) for x in fields[1:4] ]))
+			elif fields[0] == 'run':
+				runs.append(tuple([ int(x, 16) for x in fields[1:4] ]))
+			elif fields[0] == 'erase':
+				plan = []
+				for op in fields[3:]:
+					address, size, opcode, t = op.split(':')
+					plan.append((int(address, 16), int(size, 16), int(opcode, 16), float(t)))
+				erase_plans[fields[1]] = (plan, float(fields[2]))
+		f.close()
+	except (IOError, ValueError, IndexError) as e:
+		print "Couldn't read image plan %s: %s" % (path, e)
+		return None
+	if digest == None:
+		return None
+	return (digest, segments, runs, erase_plans)
+
+def default_directory():
+	return discovery.default_path('images')
+
+def cache_paths(directory, key):
+	if directory == None:
+		return (None, None)
+	if not os.path.isdir(directory):
+		try:
+			os.makedirs(directory)
+		except OSError as e:
+			print "Couldn't make image cache %s: %s" % (directory, e)
+			return (None, None)
+	return (os.path.join(directory, key + '.bin'), os.path.join(directory, key + '.plan'))
+
+# Images loaded so far, by key.
+loaded = {}
+
+# Load an MCS/HEX, .bin or .bit file. 'address' is where a .bin or
+# .bit goes in the flash.
+def load(filename, address=0):
+	ext = os.path.splitext(filename)[1].lower()
+	if ext in ('.bin', '.bit'):
+		return load_binary(filename, address, ext == '.bit')
+	return load_hex(filename)
+
+def load_hex(filename):
+	key = file_hash(filename)
+	if key in loaded:
+		return loaded[key]
+	bin_path, plan_path = cache_paths(default_directory(), key)
+	img = None
+	if plan_path != None:
+		cached = read_plan(plan_path)
+		if cached != None and os.path.exists(bin_path):
+			digest, segments, runs, erase_plans = cached
+			data = map_file(bin_path)
+			if len(data) == sum([ size for address, offset, size in segments ]):
+				img = Image(data, segments, digest, runs, erase_plans)
+	if img == None:
+		import hexfile
+		img = from_hexfile(hexfile.load(filename))
+		if bin_path != None and write_file(bin_path, img.data):
+			img.plan_path = plan_path
+			img.save_plan()
+	else:
+		img.plan_path = plan_path
+	loaded[key] = img
+	return img
+
+# A parsed hexfile, as an Image (in memory).
+def from_hexfile(f):
+	data = bytearray()
+	segments = []
+	for seg in f.segments:
+		if seg.end_address <= seg.start_address:
+			continue
+		segments.append((seg.start_address, len(data), seg.end_address - seg.start_address))
+		data.extend(seg[seg.start_address:seg.end_address].data)
+	return Image(data, segments)
+
+# Where the configuration data starts in a .bit file, and how long it
+# is: skip the header fields ('a' to 'd', 16-bit lengths) up to the
+# data ('e', 32-bit length).
+def bitstream_data(data):
+	pos = 2 + struct.unpack('>H', data[0:2])[0] + 2
+	while pos < len(data):
+		field = data[pos]
+		if field == 'e':
+			return (pos + 5, struct.unpack('>I', data[pos+1:pos+5])[0])
+		if field not in 'abcd':
+			break
+		pos = pos + 3 + struct.unpack('>H', data[pos+1:pos+3])[0]
+	raise ValueError("not a bitstream")
+
+def load_binary(filename, address=0, bitstream=False):
+	data = map_file(filename)
+	offset = 0
+	size = len(data)
+	if bitstream:
+		offset, size = bitstream_data(data)
+		size = min(size, len(data) - offset)
+	segments = [ (address, offset, size) ] if size else []
+	h = hashlib.sha1("%x %x\n" % (address, size))
+	h.update(buffer(data, offset, size))
+	digest = h.hexdigest()
+	key = 'raw-' + digest
+	if key in loaded:
+		return loaded[key]
+	plan_path = cache_paths(default_directory(), key)[1]
+	cached = read_plan(plan_path) if plan_path != None else None
+	if cached != None and cached[0] == digest:
+		img = Image(data, segments, digest, cached[2], cached[3])
+		img.plan_path = plan_path
+	else:
+		img = Image(data, segments, digest)
+		img.plan_path = plan_path
+		img.save_plan()
+	loaded[key] = img
+	return img
@@ -0,0 +1,205 @@
+import math
+
+#
+# Transaction instrumentation. Off by default: a UDPFPGA (or
+# BoardController) only records anything once it's been given a
+# Metrics with enable_metrics(), so all it costs otherwise is a
+# None check per datagram.
+#
+#	m = dev.enable_metrics()
+#	dev.spi.program_mcs("image.mcs")
+#	m.report()
+#
+# Recorded:
+#   - latency histograms per opcode, and per opcode and address range
+#     (range_size wide, so by default one per peripheral)
+#   - timeouts, retransmissions, duplicate replies dropped, replies
+#     nobody was waiting for, short replies, and datagrams thrown away
+#     by empty_socket()
+#   - datagrams and payload bytes each way
+#
+# Anything else (a profiler, an exporter) can watch with add_hook():
+# hook(event, opcode, addr, value) is called for every 'sent',
+# 'received', 'completed', 'timeout', 'retransmit', 'duplicate',
+# 'unmatched', 'short' and 'discarded' event. 'value' is the latency
+# in seconds for 'completed' and the datagram length for the others.
+#
+
+# Latencies binned by powers of two, from under 'base' seconds up.
+class Histogram(object):
+	base = 0.00001
+	buckets = 24
+
+	def __init__(self):
+		self.counts = [ 0 ]*self.buckets
+		self.count = 0
+		self.total = 0.0
+		self.min = None
+		self.max = None
+
+	def add(self, seconds):
+		if seconds < self.base:
+			i = 0
+		else:
+			i = min(math.frexp(seconds/self.base)[1], self.buckets-1)
+		self.counts[i] = self.counts[i] + 1
+		self.count = self.count + 1
+		self.total = self.total + seconds
+		if self.min == None or seconds < self.min:
+			self.min = seconds
+		if self.max == None or seconds > self.max:
+			self.max = seconds
+
+	# Upper edge of bucket 'i'.
+	def edge(self, i):
+		return self.base*(2**i)
+
+	# Latency that fraction 'p' of transactions came in under (to
+	# within a bucket).
+	def percentile(self, p):
+		if not self.count:
+			return None
+		target = p*self.count
+		seen = 0
+		for i in xrange(self.buckets):
+			seen = seen + self.counts[i]
+			if seen >= target:
+				return min(self.edge(i), self.max)
+		return self.max
+
+	def mean(self):
+		return self.total/self.count if self.count else None
+
+class Metrics(object):
+	# address range granularity for the per-range histograms
+	range_size = 0x1000
+	# IPv4 + UDP headers, for estimating what went over the wire
+	header_bytes = 28
+
+	def __init__(self):
+		self.reset()
+		self.hooks = []
+
+	def reset(self):
+		# opcode -> Histogram
+		self.latency = {}
+		# (opcode, range base) -> Histogram
+		self.ranges = {}
+		self.timeouts = {}
+		self.retransmits = {}
+		self.duplicates = 0
+		self.unmatched = 0
+		self.short = 0
+		self.discarded = 0
+		# writes sent combined (see UDPFPGA.combine_write), and the
+		# datagrams they went in
+		self.combined_writes = 0
+		self.combined_datagrams = 0
+		self.sent_datagrams = 0
+		self.sent_bytes = 0
+		self.received_datagrams = 0
+		self.received_bytes = 0
+
+	def add_hook(self, hook):
+		self.hooks.append(hook)
+
+	def remove_hook(self, hook):
+		self.hooks.remove(hook)
+
+	def event(self, event, opcode, addr, value):
+		for hook in self.hooks:
+			hook(event, opcode, addr, value)
+
+	def sent(self, opcode, addr, length):
+		self.sent_datagrams = self.sent_datagrams + 1
+		self.sent_bytes = self.sent_bytes + length
+		if len(self.hooks):
+			self.event('sent', opcode, addr, length)
+
+	def received(self, length):
+		self.received_datagrams = self.received_datagrams + 1
+		self.received_bytes = self.received_bytes + length
+		if len(self.hooks):
+			self.event('received', None, None, length)
+
+	def completed(self, opcode, addr, seconds):
+		if opcode not in self.latency:
+			self.latency[opcode] = Histogram()
+		self.latency[opcode].add(seconds)
+		key = (opcode, addr - (addr % self.range_size))
+		if key not in self.ranges:
+			self.ranges[key] = Histogram()
+		self.ranges[key].add(seconds)
+		if len(self.hooks):
+			self.event('completed', opcode, addr, seconds)
+
+	def timeout(self, opcode, addr):
+		self.timeouts[opcode] = self.timeouts.get(opcode, 0) + 1
+		if len(self.hooks):
+			self.event('timeout', opcode, addr, 0)
+
+	def retransmit(self, opcode, addr):
+		self.retransmits[opcode] = self.retransmits.get(opcode, 0) + 1
+		if len(self.hooks):
+			self.event('retransmit', opcode, addr, 0)
+
+	def duplicate(self, opcode, addr, length):
+		self.duplicates = self.duplicates + 1
+		if len(self.hooks):
+			self.event('duplicate', opcode, addr, length)
+
+	def mismatch(self, opcode, addr, length):
+		self.unmatched = self.unmatched + 1
+		if len(self.hooks):
+			self.event('unmatched', opcode, addr, length)
+
+	def short_reply(self, opcode, addr, length):
+		self.short = self.short + 1
+		if len(self.hooks):
+			self.event('short', opcode, addr, length)
+
+	def discard(self, length):
+		self.discarded = self.discarded + 1
+		if len(self.hooks):
+			self.event('discarded', None, None, length)
+
+	def combined(self, writes):
+		self.combined_writes = self.combined_writes + writes
+		self.combined_datagrams = self.combined_datagrams + 1
+
+	# Everything as plain dicts/numbers, for exporters.
+	def snapshot(self):
+		def hist(h):
+			return { 'count' : h.count, 'mean' : h.mean(), 'min' : h.min, 'max' : h.max,
+					 'p50' : h.percentile(0.5), 'p99' : h.percentile(0.99),
+					 'buckets' : [ (h.edge(i), h.counts[i]) for i in xrange(h.buckets) if h.counts[i] ] }
+		return { 'latency' : dict([ (op, hist(self.latency[op])) for op in self.latency ]),
+				 'ranges' : dict([ ('%s 0x%04x' % key, hist(self.ranges[key])) for key in self.ranges ]),
+				 'timeouts' : dict(self.timeouts),
+				 'retransmits' : dict(self.retransmits),
+				 'duplicates' : self.duplicates,
+				 'unmatched' : self.unmatched,
+				 'short' : self.short,
+				 'discarded' : self.discarded,
+				 'combined' : (self.combined_writes, self.combined_datagrams),
+				 'sent' : (self.sent_datagrams, self.sent_bytes),
+				 'received' : (self.received_datagrams, self.received_bytes) }
+
+	def report(self):
+		def line(name, h):
+			print "%-14s %8d  mean %8.1f us  p50 %8.1f us  p99 %8.1f us  max %8.1f us" % (name, h.count,
+				h.mean()*1e6, h.percentile(0.5)*1e6, h.percentile(0.99)*1e6, h.max*1e6)
+		for op in sorted(self.latency):
+			line(op, self.latency[op])
+		for key in sorted(self.ranges):
+			line('%s 0x%04x' % key, self.ranges[key])
+		def counts(d):
+			return ', '.join([ '%s %d' % (op, d[op]) for op in sorted(d) ]) or '0'
+		print "timeouts: %s  retransmits: %s  duplicates: %d  unmatched: %d  short: %d  discarded: %d" % (
+			counts(self.timeouts), counts(self.retransmits), self.duplicates,
+			self.unmatched, self.short, self.discarded)
+		if self.combined_datagrams:
+			print "combined %d writes into %d datagrams" % (self.combined_writes, self.combined_datagrams)
+		print "sent %d datagrams (%d bytes), received %d (%d bytes), ~%d bytes on the wire" % (
+			self.sent_datagrams, self.sent_bytes, self.received_datagrams, self.received_bytes,
+			self.sent_bytes + self.received_bytes + self.header_bytes*(self.sent_datagrams + self.received_datagrams))
@@ -0,0 +1,273 @@
+import ctypes
+import mmap
+import os
+import time
+from array import array
+
+import codec
+import metrics
+import poll
+import regcache
+import udp
+
+#
+# Talking to the AXI bus directly, for when the host can see it (a
+# Zynq's ARM, say, or a PCIe bridge): the registers are mapped into
+# memory, and a register access is a load or a store. MMapFPGA has
+# the same interface as udp.UDPFPGA (read/write/readMultiple, batch(),
+# the async and block calls, periodic hooks) so everything built on
+# one - spi.py, iic.py, telemetry.py - runs on it unchanged, with no
+# network in the way.
+#
+#	dev = mmio.MMapTOF('/dev/uio0')
+#	dev.spi.program_mcs("image.mcs")
+#
+# The region can be:
+#   - a UIO device, /dev/uioN: 'map_index' picks which of its maps,
+#     and the size comes from sysfs
+#   - /dev/mem: 'address' is the physical base of the registers, and
+#     the size has to be given
+#   - any other file (from 'address' to the end by default), which is
+#     handy for testing
+#
+# Every register access is exactly one 32-bit load or store, through a
+# ctypes word array laid over the mapping. That matters for FIFOs: a
+# read of SPIDRR pops it, so it mustn't be done a byte at a time.
+# Block transfers to incrementing addresses (memories, not registers)
+# are a single memmove straight between the mapping and an array.
+# Nothing's copied through Python strings on the way.
+#
+
+# Same as udp.Batch, but each step's done as execute() gets to it.
+class MMapBatch(object):
+	poll_interval = 0.001
+
+	def __init__(self, dev):
+		self.dev = dev
+		self.steps = []
+
+	def add(self, kind, addr, data=None, count=1, mask=0, value=None):
+		self.steps.append((kind, addr, data, count, mask, value))
+		return len(self.steps)-1
+
+	def read(self, addr):
+		return self.add('read', addr)
+
+	def readMultiple(self, addr, numReads):
+		return self.add('readMultiple', addr, count=numReads)
+
+	def write(self, addr, data, no_acknowledge=False):
+		if type(data) is not list: data = [ data ]
+		return self.add('write', addr, data, len(data))
+
+	def poll(self, addr, mask, value=None):
+		return self.add('poll', addr, mask=mask, value=value)
+
+	def execute(self, timeout=None):
+		if timeout == None:
+			timeout = self.dev.timeout
+		deadline = time.time() + timeout
+		results = []
+		for kind, addr, data, count, mask, val in self.steps:
+			if kind == 'read':
+				results.append(self.dev.read(addr))
+			elif kind == 'readMultiple':
+				results.append(self.dev.readMultiple(addr, count))
+			elif kind == 'write':
+				results.append(self.dev.write(addr, data))
+			else:
+				results.append(self.wait_for(addr, mask, val, deadline))
+		return results
+
+	def wait_for(self, addr, mask, value, deadline):
+		name = 'poll 0x%04x' % addr
+		start = time.time()
+		delays = self.dev.poller.backoff(self.poll_interval)
+		polls = 0
+		while True:
+			val = self.dev.read(addr)
+			polls = polls + 1
+			if (value == None and val & mask) or (value != None and (val & mask) == value):
+				self.dev.poller.record(name, polls, time.time() - start, False)
+				return val
+			now = time.time()
+			if now > deadline:
+				self.dev.poller.record(name, polls, now - start, True)
+				raise poll.PollTimeout(name, polls, now - start, val)
+			self.dev.idle(min(delays.next(), deadline - now))
+
+class MMapFPGA:
+	# longest a batch can take (polls included)
+	timeout = 2
+
+	def __init__(self, path, address=0, size=None, map_index=0, dna=None):
+		self.path = path
+		self.controller = None
+		self.target_dna = dna
+		self.cache = regcache.RegisterCache()
+		self.poller = poll.Poller(self.idle)
+		self.periodic = []
+		self.next_periodic = None
+		self.metrics = None
+		offset, size = MMapFPGA.region(path, address, size, map_index)
+		# mmap wants a page-aligned offset
+		self.skew = offset % mmap.PAGESIZE
+		fd = os.open(path, os.O_RDWR | os.O_SYNC)
+		try:
+			self.mem = mmap.mmap(fd, size + self.skew, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE,
+								 offset=offset - self.skew)
+		finally:
+			os.close(fd)
+		self.words = (ctypes.c_uint32*((size + self.skew)/4)).from_buffer(self.mem)
+		self.base = ctypes.addressof(self.words) + self.skew
+		self.size = size
+
+	# (offset, size) of the registers in 'path'.
+	@staticmethod
+	def region(path, address, size, map_index):
+		name = os.path.basename(path)
+		if name.startswith('uio'):
+			# map N is at offset N pages
+			if size == None:
+				f = open('/sys/class/uio/%s/maps/map%d/size' % (name, map_index))
+				size = int(f.read().strip(), 16)
+				f.close()
+			return (map_index*mmap.PAGESIZE + address, size)
+		if size == None:
+			size = os.path.getsize(path) - address
+			if size <= 0:
+				raise ValueError("need the size of the region in %s" % path)
+		return (address, size)
+
+	def close(self):
+		self.words = None
+		self.mem.close()
+
+	def enable_metrics(self, m=None):
+		self.metrics = m if m != None else metrics.Metrics()
+		return self.metrics
+
+	def disable_metrics(self):
+		self.metrics = None
+
+	def index(self, addr):
+		if addr < 0 or addr + 4 > self.size:
+			raise IndexError("0x%x is outside the %d byte region" % (addr, self.size))
+		return (self.skew + addr) >> 2
+
+	def read(self, addr):
+		if self.metrics != None:
+			return int(self.readMultiple(addr, 1)[0])
+		return int(self.words[self.index(addr)])
+
+	# 'numReads' loads of the same address (a FIFO).
+	def readMultiple(self, addr, numReads):
+		if self.metrics != None:
+			start = time.time()
+		i = self.index(addr)
+		words = self.words
+		result = array(codec.WORD, [ words[i] for n in xrange(numReads) ])
+		if self.metrics != None:
+			self.metrics.completed('RD', addr, time.time() - start)
+		return result
+
+	# A list goes to the same address, one store each (a FIFO).
+	# Returns the number of words written, like an acknowledgement.
+	def write(self, addr, data, no_acknowledge=False):
+		if type(data) is not list: data = [ data ]
+		if not len(data):
+			return 0
+		if self.metrics != None:
+			start = time.time()
+		i = self.index(addr)
+		words = self.words
+		for value in data:
+			words[i] = value & 0xFFFFFFFF
+		self.cache.written(addr, data[-1])
+		if self.metrics != None:
+			self.metrics.completed('WR', addr, time.time() - start)
+		if no_acknowledge == True:
+			return
+		return len(data)
+
+	def modify(self, addr, mask, value):
+		cur = self.read(addr)
+		return self.write(addr, (cur & ~mask) | (value & mask))
+
+	# Everything's done by the time these return, but the callbacks
+	# and udp.Transaction results work the same.
+	def read_async(self, addr, numReads=1, callback=None):
+		txn = udp.Transaction(self, 'RD', addr, None, numReads, callback=callback)
+		txn.complete(self.readMultiple(addr, numReads))
+		return txn
+
+	def write_async(self, addr, data, no_acknowledge=False, callback=None):
+		if type(data) is not list: data = [ data ]
+		txn = udp.Transaction(self, 'WR', addr, None, len(data), not no_acknowledge, callback=callback)
+		txn.complete(self.write(addr, data))
+		return txn
+
+	def batch(self):
+		return MMapBatch(self)
+
+	def read_block(self, addr, count, increment=False):
+		if not increment:
+			return self.readMultiple(addr, count)
+		self.index(addr + 4*(count - 1))
+		result = array(codec.WORD, [ 0 ])*count
+		ctypes.memmove(result.buffer_info()[0], self.base + addr, 4*count)
+		return result
+
+	def write_block(self, addr, data, increment=False):
+		if not increment:
+			return self.write(addr, list(data))
+		self.index(addr + 4*(len(data) - 1))
+		if not isinstance(data, array) or data.itemsize != 4:
+			data = array(codec.WORD, data)
+		ctypes.memmove(self.base + addr, data.buffer_info()[0], 4*len(data))
+		return len(data)
+
+	# Nothing's ever outstanding (or held back).
+	def wait(self, txn):
+		pass
+
+	def fence(self):
+		pass
+
+	def wait_all(self):
+		pass
+
+	def throttle(self):
+		pass
+
+	# Run the periodic hooks (see udp.run_periodic), then sleep up to
+	# 'timeout' or until one of them's due.
+	def process(self, timeout=0):
+		if len(self.periodic):
+			self.next_periodic = udp.run_periodic(self.periodic)
+		if timeout > 0:
+			if self.next_periodic != None:
+				timeout = min(timeout, max(self.next_periodic - time.time(), 0))
+			time.sleep(timeout)
+
+	def idle(self, seconds):
+		deadline = time.time() + seconds
+		while True:
+			remaining = deadline - time.time()
+			if remaining <= 0:
+				break
+			self.process(remaining)
+
+# A TOF board on the local bus.
+class MMapTOF(udp.TOFBoard, MMapFPGA):
+	def __init__(self, path, address=0, size=None, map_index=0, dna=None):
+		MMapFPGA.__init__(self, path, address, size, map_index, dna)
+		self.setup()
+
+	def __getattr__(self, name):
+		value = udp.TOFBoard.__getattr__(self, name)
+		if name == 'spi':
+			# here the SPI bus is slower than we are: nothing to gain
+			# from reading ahead
+			value.dev.read_ahead = False
+		return value
@@ -0,0 +1,89 @@
+import time
+
+#
+# Bounded status polling. Instead of firing reads back-to-back until
+# something happens, Poller.until() waits most of the operation's
+# expected time before it asks at all, then backs off exponentially
+# (capped at a fraction of the expected time) until a hard deadline,
+# after which it raises PollTimeout.
+#
+# Every poll is counted per operation name, so you can see how many
+# reads each kind of wait is costing: Poller.report().
+#
+
+# It's an IOError so anything already catching I/O trouble catches
+# this too.
+class PollTimeout(IOError):
+	def __init__(self, name, polls, elapsed, value):
+		IOError.__init__(self, "%s timed out after %d polls (%.3f s), last value %r" % (name, polls, elapsed, value))
+		self.name = name
+		self.polls = polls
+		self.elapsed = elapsed
+		self.value = value
+
+class Poller(object):
+	# shortest/longest gap between polls
+	min_interval = 0.00005
+	max_interval = 0.1
+	# fraction of the expected time to wait before the first poll
+	head_start = 0.75
+
+	# 'sleep' is how to pass the time between polls: a board hands
+	# in something that keeps its other traffic moving.
+	def __init__(self, sleep=time.sleep):
+		self.sleep = sleep
+		# name -> [ operations, polls, seconds, timeouts ]
+		self.stats = {}
+
+	def record(self, name, polls, elapsed, timed_out):
+		if name not in self.stats:
+			self.stats[name] = [ 0, 0, 0.0, 0 ]
+		s = self.stats[name]
+		s[0] = s[0] + 1
+		s[1] = s[1] + polls
+		s[2] = s[2] + elapsed
+		if timed_out:
+			s[3] = s[3] + 1
+
+	# Call read() until done(value) is true and return that value.
+	# 'expected' is how long the operation typically takes and seeds
+	# the backoff; 'timeout' is the hard limit (default: 10x expected,
+	# at least a second).
+	def until(self, read, done, expected=0.0, timeout=None, name='poll'):
+		start = time.time()
+		if timeout == None:
+			timeout = max(10*expected, 1.0)
+		deadline = start + timeout
+		if expected > 0:
+			self.sleep(expected*self.head_start)
+		interval = max(expected/8, self.min_interval)
+		cap = min(max(expected/4, self.min_interval), self.max_interval)
+		polls = 0
+		while True:
+			value = read()
+			polls = polls + 1
+			if done(value):
+				self.record(name, polls, time.time() - start, False)
+				return value
+			now = time.time()
+			if now >= deadline:
+				self.record(name, polls, now - start, True)
+				raise PollTimeout(name, polls, now - start, value)
+			self.sleep(min(interval, deadline - now))
+			interval = min(interval*2, cap)
+
+	# Delays to wait between successive re-polls with no expected
+	# time (for callers that do their own reads, like Batch): none at
+	# first, then doubling up to 'cap'.
+	def backoff(self, cap=None):
+		if cap == None:
+			cap = self.max_interval
+		interval = 0.0
+		while True:
+			yield interval
+			interval = min(max(interval*2, self.min_interval), cap)
+
+	def report(self):
+		for name in sorted(self.stats):
+			ops, polls, elapsed, timeouts = self.stats[name]
+			print "%-20s %6d ops %8d polls (%.1f/op) %8.3f s %d timeouts" % (name, ops, polls, float(polls)/ops, elapsed, timeouts)
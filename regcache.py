@@ -0,0 +1,107 @@
+#
+# Shadow register cache. Each board's UDPFPGA has one; by default
+# nothing is declared, so every register is volatile and nothing
+# changes. Declare address ranges to make them cached:
+#
+#   CACHEABLE  - normal read/write register that only we change.
+#                The first read goes to the board, after that reads
+#                (and read-modify-writes) are served locally.
+#   WRITE_ONLY - reads don't give back what was written (or can't
+#                be trusted to): only values we wrote are served.
+#   VOLATILE   - status/anything the hardware changes. Never
+#                cached. This is the default.
+#   FIFO       - volatile, and accessing it twice isn't the same as
+#                once, so requests to it never get retransmitted
+#                (see retry.py).
+#   TOGGLE     - volatile, and the same for writes only (toggle-on-
+#                write interrupt status registers). Reads are fine.
+#
+# 'clear' bits are self-clearing (e.g. FIFO resets) and get dropped
+# from the value we remember on a write.
+#
+CACHEABLE = 'cacheable'
+WRITE_ONLY = 'write-only'
+VOLATILE = 'volatile'
+FIFO = 'fifo'
+TOGGLE = 'toggle'
+
+class RegisterCache(object):
+	def __init__(self):
+		# (start, end, policy, clear) with end exclusive
+		self.ranges = []
+		# addr -> (policy, clear), filled in as addresses get looked up
+		self.policies = {}
+		self.values = {}
+		self.hooks = []
+		self.hits = 0
+		self.misses = 0
+
+	def declare(self, start, end, policy, clear=0):
+		self.ranges.append((start, end, policy, clear))
+		self.policies = {}
+		self.values = {}
+
+	def policy(self, addr):
+		if addr in self.policies:
+			return self.policies[addr]
+		result = (VOLATILE, 0)
+		for start, end, policy, clear in self.ranges:
+			if start <= addr < end:
+				result = (policy, clear)
+		self.policies[addr] = result
+		return result
+
+	# Cached value for a read of 'addr', or None if it has to go
+	# to the board.
+	def lookup(self, addr):
+		if not len(self.ranges):
+			return None
+		if self.policy(addr)[0] not in (CACHEABLE, WRITE_ONLY):
+			return None
+		if addr in self.values:
+			self.hits = self.hits + 1
+			return self.values[addr]
+		self.misses = self.misses + 1
+		return None
+
+	# A read of 'addr' came back from the board. Only used if nothing
+	# was written in the meantime.
+	def fill(self, addr, value):
+		if not len(self.ranges) or addr in self.values:
+			return
+		if self.policy(addr)[0] == CACHEABLE:
+			self.values[addr] = value
+
+	# We wrote 'value' to 'addr'.
+	def written(self, addr, value):
+		if not len(self.ranges):
+			return
+		policy, clear = self.policy(addr)
+		if policy in (CACHEABLE, WRITE_ONLY):
+			self.values[addr] = value & ~clear
+
+	# Forget cached values: everything, or just one address.
+	def invalidate(self, addr=None):
+		if addr == None:
+			self.values = {}
+		else:
+			self.values.pop(addr, None)
+		for hook in self.hooks:
+			hook(addr)
+
+	# Call 'hook(addr)' whenever the cache is invalidated
+	# (addr is None if everything was).
+	def on_invalidate(self, hook):
+		self.hooks.append(hook)
+
+	# Can a request to 'addr' safely be sent twice?
+	def idempotent(self, opcode, addr):
+		policy = self.policy(addr)[0]
+		if policy == FIFO:
+			return False
+		if policy == TOGGLE:
+			return opcode == 'RD'
+		return True
+
+	def stats(self):
+		return { 'hits' : self.hits, 'misses' : self.misses, 'cached' : len(self.values) }
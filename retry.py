@@ -0,0 +1,81 @@
+#
+# How hard UDPFPGA tries before giving up on a request, and what it
+# raises when it does.
+#
+# The per-attempt timeout comes from the measured round trip time
+# (smoothed, plus four times its variation, the same way TCP does
+# it), so on a LAN a lost datagram costs milliseconds instead of the
+# full timeout. Each retransmission doubles it. Round trips are only
+# measured from requests that weren't retransmitted, since otherwise
+# there's no telling which copy the reply was for.
+#
+# Only idempotent requests get retransmitted. FIFO accesses (and
+# writes to toggle-on-write registers) are declared in the register
+# cache (regcache.FIFO, regcache.TOGGLE): doing those twice isn't the
+# same as doing them once, so they get one attempt with a longer
+# timeout instead, and fail if that runs out.
+#
+# Above that, the I2C and SPI cores redo or resume a transfer that
+# lost one of those (iic.AXIIIC.finish, spi.SPI.write_command and
+# stream_read), so in the simulator program_mcs and I2C register
+# access get through 1% loss of requests and replies, or 2% of
+# requests alone. Past that, expect the odd TransactionError from I2C
+# and program_mcs giving up.
+#
+
+# Anything that goes wrong with a request. It's an IOError, same as
+# poll.PollTimeout.
+class TransactionError(IOError):
+	pass
+
+# Nothing came back, even after retransmitting.
+class NoResponse(TransactionError):
+	pass
+
+# The reply was too short for what was asked for.
+class ShortReply(TransactionError):
+	pass
+
+# There's no board to talk to (connect() failed or wasn't called).
+class NotConnected(TransactionError):
+	pass
+
+# A posted write (see UDPFPGA.post) was never acknowledged. It's
+# raised by whatever checks next, which isn't the request that was
+# lost, so retrying that request doesn't help.
+class WriteLost(TransactionError):
+	pass
+
+class RetryPolicy(object):
+	# retransmissions of an idempotent request before giving up
+	retries = 4
+	# bounds on a single attempt's timeout
+	min_timeout = 0.01
+	max_timeout = 0.5
+	# until there's a round trip measured
+	initial_timeout = 0.05
+	backoff = 2.0
+
+	def __init__(self, **kwargs):
+		for key in kwargs:
+			if not hasattr(self, key):
+				raise TypeError("unknown retry parameter '%s'" % key)
+			setattr(self, key, kwargs[key])
+		self.srtt = None
+		self.rttvar = None
+
+	def measured(self, rtt):
+		if self.srtt == None:
+			self.srtt = rtt
+			self.rttvar = rtt/2
+		else:
+			self.rttvar = 0.75*self.rttvar + 0.25*abs(self.srtt - rtt)
+			self.srtt = 0.875*self.srtt + 0.125*rtt
+
+	# Timeout for attempt number 'attempt' (0 is the first send).
+	def timeout(self, attempt=0):
+		if self.srtt == None:
+			base = self.initial_timeout
+		else:
+			base = self.srtt + 4*self.rttvar
+		return min(max(base, self.min_timeout)*(self.backoff**attempt), self.max_timeout)
@@ -0,0 +1,741 @@
+from socket import *
+import struct
+import select
+import time
+import random
+import heapq
+import threading
+import collections
+
+#
+# Local stand-in for a TOF board's FPGA, for exercising and timing
+# udp.py/spi.py without hardware. Speaks the ID/SI/RD/WR protocol on
+# port 18520 and replies to port 18521 on whoever asked, just like the
+# firmware does.
+#
+# Register models (same base addresses as the real thing):
+#             0000 = gpio (LED etc, plain registers)
+#             1000 = xadc (status registers at 0x1200)
+#             2000 = AXI IIC (dynamic mode, with simulated I2C devices)
+#             3000 = AXI Quad SPI (standard mode, with a SimFlash on SS0)
+#             4000 = HWICAP (IPROG triggers a simulated reload)
+#
+# Like the firmware, a multi-word RD/WR hits the same register over and
+# over (that's what makes FIFO access work), it doesn't increment.
+#
+# Quick start:
+#	sim = Simulator([ SimBoard() ])
+#	sim.start()
+#	dev = udp.TOFProto()
+#
+# Or run it as its own process: python sim.py --help
+#
+
+# Micron N25Q128-ish serial flash.
+class SimFlash(object):
+	# JEDEC basic flash parameter table (JESD216B, 16 dwords), as read
+	# back by RDSFDP at 'sfdp_pointer'.
+	#   erase type 1: 4 kB,  0x20, typ. 48 ms
+	#   erase type 2: 64 kB, 0xD8, typ. 640 ms
+	#   page program: 256 bytes, typ. 512 us
+	#   chip erase: typ. 120 s
+	sfdp_pointer = 0x30
+	basic_table = [ 0xE5, 0x20, 0xF1, 0xFF,  0xFF, 0xFF, 0xFF, 0x07,
+					0x29, 0xEB, 0x27, 0x6B,  0x27, 0x3B, 0x27, 0xBB,
+					0xFF, 0xFF, 0xFF, 0xFF,  0xFF, 0xFF, 0x27, 0xBB,
+					0xFF, 0xFF, 0x29, 0xEB,  0x0C, 0x20, 0x10, 0xD8,
+					0x00, 0x00, 0x00, 0x00,  0x22, 0x22, 0x02, 0x00,
+					0x81, 0x27, 0x00, 0x5D,  0xFF, 0xFF, 0xFF, 0xFF,
+					0xFF, 0xFF, 0xFF, 0xFF,  0xFF, 0xFF, 0xFF, 0xFF,
+					0xFF, 0xFF, 0xFF, 0xFF,  0xFF, 0xFF, 0xFF, 0xFF ]
+	# erase opcode -> (erase size, typical time in seconds)
+	erase_ops = { 0x20 : (4*1024, 0.048),
+				  0x21 : (4*1024, 0.048),
+				  0xD8 : (64*1024, 0.640),
+				  0xDC : (64*1024, 0.640) }
+	page_time = 0.000512
+	bulk_time = 120.0
+	page_size = 256
+	# opcodes that take a 4-byte address
+	four_byte = [ 0x13, 0x0C, 0x12, 0xDC, 0x21 ]
+
+	# 'time_scale' scales all the program/erase busy times: 1 is real
+	# flash speed, 0 makes them instant. The default keeps them short
+	# but long enough for WIP to be seen.
+	def __init__(self, capacity=16*1024*1024, image=None, time_scale=0.01,
+				 manufacturer_id=0x20, memory_type=0xBA):
+		self.capacity = capacity
+		self.time_scale = time_scale
+		self.image = bytearray('\xff'*capacity)
+		if image != None:
+			self.image[0:len(image)] = image
+		capacity_code = 0
+		while (1 << capacity_code) < capacity:
+			capacity_code += 1
+		self.id = [ manufacturer_id, memory_type, capacity_code, 0x10 ] + [ 0x00 ]*16
+		self.signature = 0x17
+		header = [ ord(c) for c in 'SFDP' ] + [ 0x06, 0x01, 0x00, 0xFF ]
+		header += [ 0x00, 0x06, 0x01, len(self.basic_table)/4,
+					self.sfdp_pointer & 0xFF, (self.sfdp_pointer >> 8) & 0xFF, 0x00, 0xFF ]
+		self.sfdp = bytearray('\xff'*256)
+		self.sfdp[0:len(header)] = bytearray(header)
+		self.sfdp[self.sfdp_pointer:self.sfdp_pointer+len(self.basic_table)] = bytearray(self.basic_table)
+		self.wel = False
+		self.busy_until = 0
+		self.bank = 0
+		self.erase_count = 0
+		self.program_count = 0
+		self.read_bytes = 0
+		self.selected = False
+		self.args = []
+		self.cmd = None
+
+	@classmethod
+	def from_file(cls, filename, **kwargs):
+		f = open(filename, 'rb')
+		image = f.read()
+		f.close()
+		return cls(image=image, **kwargs)
+
+	def save(self, filename):
+		f = open(filename, 'wb')
+		f.write(self.image)
+		f.close()
+
+	def busy(self):
+		return time.time() < self.busy_until
+
+	def status(self):
+		return (0x1 if self.busy() else 0) | (0x2 if self.wel else 0)
+
+	def select(self):
+		self.selected = True
+		self.cmd = None
+		self.args = []
+
+	def deselect(self):
+		if self.selected and self.cmd != None:
+			self.finish()
+		self.selected = False
+		self.cmd = None
+		self.args = []
+
+	def address(self, nbytes):
+		addr = 0
+		for b in self.args[0:nbytes]:
+			addr = (addr << 8) | b
+		if nbytes == 3 and self.capacity > 2**24:
+			addr |= (self.bank << 24)
+		return addr % self.capacity
+
+	def address_bytes(self):
+		return 4 if self.cmd in self.four_byte else 3
+
+	# Exchange one byte on the bus.
+	def xfer(self, b):
+		if self.cmd == None:
+			self.cmd = b
+			if self.cmd == 0x06 and not self.busy():
+				self.wel = True
+			elif self.cmd == 0x04 and not self.busy():
+				self.wel = False
+			return 0xFF
+		self.args.append(b)
+		n = len(self.args)
+		cmd = self.cmd
+		if cmd == 0x05:
+			return self.status()
+		elif cmd == 0x9F:
+			return self.id[(n-1) % len(self.id)]
+		elif cmd == 0xAB:
+			return self.signature if n > 3 else 0xFF
+		elif cmd == 0x16:
+			return self.bank
+		elif cmd in (0x03, 0x13, 0x0B, 0x0C, 0x5A):
+			alen = self.address_bytes()
+			dummy = 0 if cmd in (0x03, 0x13) else 1
+			i = n - 1 - alen - dummy
+			if i < 0:
+				return 0xFF
+			if cmd == 0x5A:
+				return self.sfdp[(self.address(3) + i) % len(self.sfdp)]
+			self.read_bytes += 1
+			return self.image[(self.address(alen) + i) % self.capacity]
+		return 0xFF
+
+	# Chip select went away: commit programs/erases.
+	def finish(self):
+		cmd = self.cmd
+		if cmd == 0x17 and len(self.args) >= 1:
+			self.bank = self.args[0]
+			return
+		if not self.wel or self.busy():
+			return
+		if cmd in (0x02, 0x12):
+			alen = self.address_bytes()
+			if len(self.args) <= alen:
+				return
+			addr = self.address(alen)
+			data = self.args[alen:][-self.page_size:]
+			page = addr & ~(self.page_size-1)
+			for i in xrange(len(data)):
+				a = page | ((addr + i) & (self.page_size-1))
+				self.image[a] &= data[i]
+			self.program_count += 1
+			self.busy_until = time.time() + self.page_time*self.time_scale
+			self.wel = False
+		elif cmd in self.erase_ops:
+			alen = self.address_bytes()
+			if len(self.args) < alen:
+				return
+			size, t = self.erase_ops[cmd]
+			start = self.address(alen) & ~(size-1)
+			self.image[start:start+size] = '\xff'*size
+			self.erase_count += 1
+			self.busy_until = time.time() + t*self.time_scale
+			self.wel = False
+		elif cmd == 0xC7:
+			self.image[:] = '\xff'*self.capacity
+			self.erase_count += 1
+			self.busy_until = time.time() + self.bulk_time*self.time_scale
+			self.wel = False
+
+class SimGPIO(object):
+	def __init__(self):
+		self.regs = {}
+
+	def read(self, offset):
+		return self.regs.get(offset, 0)
+
+	def write(self, offset, value):
+		self.regs[offset] = value
+
+# XADC status registers, returning fixed (settable) readings.
+class SimXADC(object):
+	def __init__(self):
+		self.temperature = 45.0
+		self.vccint = 1.0
+		self.vccaux = 1.8
+		self.vccbram = 1.0
+
+	@staticmethod
+	def supply(volts):
+		return (int(volts*4096/3.0) & 0xFFF) << 4
+
+	def read(self, offset):
+		if offset == 0x200:
+			return (int((self.temperature + 273.15)*4096/503.975) & 0xFFF) << 4
+		elif offset == 0x204:
+			return SimXADC.supply(self.vccint)
+		elif offset == 0x208:
+			return SimXADC.supply(self.vccaux)
+		elif offset == 0x218:
+			return SimXADC.supply(self.vccbram)
+		return 0
+
+	def write(self, offset, value):
+		pass
+
+# A generic I2C slave with 256 byte-wide registers: the first byte
+# written sets the register pointer, the rest are written from there.
+# Reads continue from the pointer.
+class SimI2CDevice(object):
+	def __init__(self, regs=None):
+		self.regs = bytearray(256)
+		if regs != None:
+			self.regs[0:len(regs)] = bytearray(regs)
+		self.pointer = 0
+
+	def write(self, data):
+		if not len(data):
+			return
+		self.pointer = data[0]
+		for b in data[1:]:
+			self.regs[self.pointer] = b
+			self.pointer = (self.pointer + 1) & 0xFF
+
+	def read(self, length):
+		data = []
+		for i in xrange(length):
+			data.append(self.regs[self.pointer])
+			self.pointer = (self.pointer + 1) & 0xFF
+		return data
+
+# AXI IIC in dynamic controller mode. The bus is infinitely fast:
+# transfers happen as soon as the TX FIFO has enough to do them.
+class SimIIC(object):
+	fifo_depth = 16
+
+	def __init__(self, devices=None):
+		self.devices = devices if devices != None else {}
+		self.reset()
+
+	def reset(self):
+		self.cr = 0
+		self.isr = 0xD0
+		self.ier = 0
+		self.gie = 0
+		self.pirq = 0
+		self.tx = collections.deque()
+		self.rx = collections.deque()
+		# read data the RX FIFO didn't have room for yet
+		self.rx_pending = collections.deque()
+		# open write transfer: (device address, bytes so far)
+		self.writing = None
+		self.reading = None
+		# NAKed, until the TX FIFO's reset
+		self.stopped = False
+
+	def status(self):
+		sr = 0
+		if not len(self.tx):
+			sr |= 0x80
+		if not len(self.rx):
+			sr |= 0x40
+		if len(self.rx) >= self.fifo_depth:
+			sr |= 0x20
+		if len(self.tx) >= self.fifo_depth:
+			sr |= 0x10
+		if self.writing != None or self.reading != None or len(self.rx_pending):
+			sr |= 0x04
+		return sr
+
+	def read(self, offset):
+		if offset == 0x01C:
+			return self.gie
+		elif offset == 0x020:
+			return self.isr
+		elif offset == 0x028:
+			return self.ier
+		elif offset == 0x100:
+			return self.cr
+		elif offset == 0x104:
+			return self.status()
+		elif offset == 0x10C:
+			val = self.rx.popleft() if len(self.rx) else 0
+			self.refill()
+			return val
+		elif offset == 0x114:
+			return max(len(self.tx)-1, 0)
+		elif offset == 0x118:
+			return max(len(self.rx)-1, 0)
+		elif offset == 0x120:
+			return self.pirq
+		return 0
+
+	def write(self, offset, value):
+		if offset == 0x01C:
+			self.gie = value
+		elif offset == 0x020:
+			# toggle on write
+			self.isr ^= value
+			self.levels()
+		elif offset == 0x028:
+			self.ier = value
+		elif offset == 0x040:
+			if value == 0xA:
+				self.reset()
+		elif offset == 0x100:
+			self.cr = value & 0xFF
+			if value & 0x2:
+				self.tx.clear()
+				self.stopped = False
+			self.run()
+		elif offset == 0x108:
+			if len(self.tx) < self.fifo_depth:
+				self.tx.append(value & 0x3FF)
+			self.run()
+		elif offset == 0x120:
+			self.pirq = value & 0xF
+			self.levels()
+
+	# The RX FIFO interrupt stays on for as long as the occupancy is
+	# past RX_FIFO_PIRQ.
+	def levels(self):
+		if len(self.rx) >= self.pirq + 1:
+			self.isr |= 0x08
+
+	def refill(self):
+		while len(self.rx_pending) and len(self.rx) < self.fifo_depth:
+			self.rx.append(self.rx_pending.popleft())
+		if not len(self.rx_pending) and self.reading == None:
+			self.isr |= 0x10
+		self.levels()
+
+	# Like the core, the rest of the transfer stays in the TX FIFO,
+	# and nothing more goes out until that's reset.
+	def nak(self):
+		self.isr |= 0x02
+		self.writing = None
+		self.reading = None
+		self.stopped = True
+
+	def run(self):
+		if not (self.cr & 0x1) or self.stopped:
+			return
+		while len(self.tx):
+			word = self.tx[0]
+			if self.reading != None:
+				# waiting on the read length word
+				self.tx.popleft()
+				dev = self.reading
+				self.reading = None
+				self.rx_pending.extend(self.devices[dev].read(word & 0xFF))
+				self.refill()
+				continue
+			if word & 0x100:
+				# (repeated) start: finish off any open write first
+				self.tx.popleft()
+				if self.writing != None:
+					self.devices[self.writing[0]].write(self.writing[1])
+					self.writing = None
+				dev = (word >> 1) & 0x7F
+				if dev not in self.devices:
+					self.nak()
+					return
+				self.isr &= ~0x10
+				if word & 0x1:
+					self.reading = dev
+				elif word & 0x200:
+					self.devices[dev].write([])
+				else:
+					self.writing = (dev, [])
+				continue
+			self.tx.popleft()
+			if self.writing == None:
+				# data without an address: the core flags an error
+				self.isr |= 0x02
+				continue
+			self.writing[1].append(word & 0xFF)
+			if word & 0x200:
+				self.devices[self.writing[0]].write(self.writing[1])
+				self.writing = None
+		self.isr |= 0x04
+		if self.writing == None and self.reading == None and not len(self.rx_pending):
+			self.isr |= 0x10
+
+# AXI Quad SPI in standard mode with the flash on slave select 0.
+class SimQuadSPI(object):
+	fifo_depth = 16
+
+	def __init__(self, flash):
+		self.flash = flash
+		self.reset()
+
+	def reset(self):
+		self.spicr = 0x180
+		self.ssr = 0xFFFF
+		self.tx = collections.deque()
+		self.rx = collections.deque()
+		self.ipisr = 0
+		self.ipier = 0
+		self.dgier = 0
+		self.flash.deselect()
+
+	def status(self):
+		sr = 0
+		if not len(self.rx):
+			sr |= 0x1
+		if len(self.rx) >= self.fifo_depth:
+			sr |= 0x2
+		if not len(self.tx):
+			sr |= 0x4
+		if len(self.tx) >= self.fifo_depth:
+			sr |= 0x8
+		return sr
+
+	def read(self, offset):
+		if offset == 0x60:
+			return self.spicr
+		elif offset == 0x64:
+			return self.status()
+		elif offset == 0x6C:
+			return self.rx.popleft() if len(self.rx) else 0
+		elif offset == 0x70:
+			return self.ssr
+		elif offset == 0x74:
+			return max(len(self.tx)-1, 0)
+		elif offset == 0x78:
+			return max(len(self.rx)-1, 0)
+		elif offset == 0x1C:
+			return self.dgier
+		elif offset == 0x20:
+			return self.ipisr
+		elif offset == 0x28:
+			return self.ipier
+		return 0
+
+	def write(self, offset, value):
+		if offset == 0x40:
+			if value == 0xA:
+				self.reset()
+		elif offset == 0x60:
+			if value & 0x20:
+				self.tx.clear()
+			if value & 0x40:
+				self.rx.clear()
+			self.spicr = value & 0x39F
+			self.run()
+		elif offset == 0x68:
+			if len(self.tx) < self.fifo_depth:
+				self.tx.append(value & 0xFF)
+			self.run()
+		elif offset == 0x70:
+			was = not (self.ssr & 0x1)
+			self.ssr = value & 0xFFFF
+			now = not (self.ssr & 0x1)
+			if was and not now:
+				self.flash.deselect()
+			elif now and not was:
+				self.flash.select()
+			self.run()
+		elif offset == 0x1C:
+			self.dgier = value
+		elif offset == 0x20:
+			self.ipisr ^= value
+		elif offset == 0x28:
+			self.ipier = value
+
+	def run(self):
+		# SPE + master, not inhibited, flash selected
+		if (self.spicr & 0x106) != 0x006 or (self.ssr & 0x1):
+			return
+		while len(self.tx):
+			r = self.flash.xfer(self.tx.popleft())
+			if len(self.rx) < self.fifo_depth:
+				self.rx.append(r)
+
+# HWICAP. Writing 1 to the control register pushes the write FIFO to
+# the ICAP; if that contained an IPROG, the board reloads.
+class SimICAP(object):
+	fifo_depth = 64
+
+	def __init__(self, board):
+		self.board = board
+		self.fifo = []
+		self.last = []
+
+	def read(self, offset):
+		if offset == 0x110:
+			return 0x5
+		elif offset == 0x114:
+			return self.fifo_depth - len(self.fifo)
+		return 0
+
+	def write(self, offset, value):
+		if offset == 0x100:
+			if len(self.fifo) < self.fifo_depth:
+				self.fifo.append(value)
+		elif offset == 0x10C:
+			if value & 0x1:
+				self.last = self.fifo
+				self.fifo = []
+				for i in xrange(len(self.last)-1):
+					if self.last[i] == 0x30008001 and self.last[i+1] == 0x0000000F:
+						self.board.reload()
+						break
+
+# One simulated board: a DNA, an IP, and the register models.
+class SimBoard(object):
+	def __init__(self, dna=0x0123456789ABCD, ip='127.0.0.1', flash=None, i2c_devices=None,
+				 reload_time=0.1):
+		self.dna = dna
+		self.ip = ip
+		self.flash = flash if flash != None else SimFlash()
+		self.i2c_devices = i2c_devices if i2c_devices != None else {}
+		self.reload_time = reload_time
+		self.reloading_until = 0
+		self.reloads = 0
+		self.reset()
+
+	def reset(self):
+		self.gpio = SimGPIO()
+		self.xadc = SimXADC() if not hasattr(self, 'xadc') else self.xadc
+		self.iic = SimIIC(self.i2c_devices)
+		self.qspi = SimQuadSPI(self.flash)
+		self.icap = SimICAP(self)
+		self.devices = { 0x0000 : self.gpio,
+						 0x1000 : self.xadc,
+						 0x2000 : self.iic,
+						 0x3000 : self.qspi,
+						 0x4000 : self.icap }
+
+	def reload(self):
+		self.reloads += 1
+		self.reloading_until = time.time() + self.reload_time
+		self.reset()
+
+	def read_reg(self, addr):
+		dev = self.devices.get(addr & 0xF000)
+		if dev == None:
+			return 0
+		return dev.read(addr & 0xFFF) & 0xFFFFFFFF
+
+	def write_reg(self, addr, value):
+		dev = self.devices.get(addr & 0xF000)
+		if dev != None:
+			dev.write(addr & 0xFFF, value)
+
+	# Handle one request datagram, returning the reply (or None).
+	def handle(self, data):
+		if time.time() < self.reloading_until or len(data) < 3:
+			return None
+		cmd = data[0:2]
+		if cmd == 'ID':
+			return struct.pack('!2sB', 'ID', 0) + inet_aton(self.ip) + struct.pack('!Q', self.dna)
+		elif cmd == 'SI' and len(data) >= 15:
+			dna = struct.unpack('!Q', data[3:11])[0]
+			if dna != self.dna:
+				return None
+			self.ip = inet_ntoa(data[11:15])
+			return struct.pack('!2sBQ', 'SI', 0, self.dna)
+		elif cmd == 'RD' and len(data) >= 6:
+			addr, count = struct.unpack('!HB', data[3:6])
+			words = [ self.read_reg(addr) for i in xrange(count) ]
+			return struct.pack('!2sBH%dL' % count, 'RD', 0, addr, *words)
+		elif cmd == 'WR' and len(data) >= 5:
+			addr = struct.unpack('!H', data[3:5])[0]
+			count = (len(data) - 5)/4
+			for i in xrange(count):
+				self.write_reg(addr, struct.unpack('!L', data[5+4*i:9+4*i])[0])
+			if time.time() < self.reloading_until:
+				# that write reloaded us: we're gone
+				return None
+			return struct.pack('!2sBHB', 'WR', 0, addr, count & 0xFF)
+		return None
+
+# Serves one or more SimBoards over UDP. Each board gets its own socket
+# on (board.ip, port) so replies come from the right source address;
+# give boards distinct loopback addresses (127.0.0.2, 127.0.0.3, ...)
+# to simulate a crate. A wildcard socket catches broadcast ID/SI.
+#
+# Network impairments, applied per datagram:
+#   latency  - seconds added before every reply (plus up to 'jitter')
+#   loss     - probability a request is dropped before the board sees it
+#   reply_loss - probability a reply is dropped after the board acted on it
+#   reorder  - probability a reply is held back an extra 'reorder_delay'
+class Simulator(object):
+	def __init__(self, boards, port=18520, reply_port=18521, latency=0.0, jitter=0.0,
+				 loss=0.0, reply_loss=0.0, reorder=0.0, reorder_delay=0.002, seed=None):
+		self.boards = boards
+		self.port = port
+		self.reply_port = reply_port
+		self.latency = latency
+		self.jitter = jitter
+		self.loss = loss
+		self.reply_loss = reply_loss
+		self.reorder = reorder
+		self.reorder_delay = reorder_delay
+		self.random = random.Random(seed)
+		self.sockets = {}
+		for board in boards:
+			s = socket(AF_INET, SOCK_DGRAM)
+			s.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+			s.bind((board.ip, port))
+			self.sockets[s] = board
+		self.listener = socket(AF_INET, SOCK_DGRAM)
+		self.listener.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+		self.listener.bind(('0.0.0.0', port))
+		self.queue = []
+		self.sequence = 0
+		self.running = False
+		self.thread = None
+		self.requests = 0
+		self.dropped = 0
+
+	def socket_for(self, board):
+		for s in self.sockets:
+			if self.sockets[s] is board:
+				return s
+
+	def schedule(self, sock, reply, addr):
+		if self.random.random() < self.reply_loss:
+			self.dropped += 1
+			return
+		when = time.time() + self.latency
+		if self.jitter:
+			when += self.random.random()*self.jitter
+		if self.random.random() < self.reorder:
+			when += self.reorder_delay
+		self.sequence += 1
+		heapq.heappush(self.queue, (when, self.sequence, sock, reply, (addr[0], self.reply_port)))
+
+	def receive(self, sock):
+		try:
+			data, addr = sock.recvfrom(4096)
+		except error:
+			return
+		self.requests += 1
+		if self.random.random() < self.loss:
+			self.dropped += 1
+			return
+		if sock is self.listener:
+			# broadcast: only discovery commands, every board answers
+			if data[0:2] not in ('ID', 'SI'):
+				return
+			targets = self.boards
+		else:
+			targets = [ self.sockets[sock] ]
+		for board in targets:
+			reply = board.handle(data)
+			if reply != None:
+				self.schedule(self.socket_for(board), reply, addr)
+
+	def step(self, timeout):
+		if len(self.queue):
+			timeout = min(timeout, max(self.queue[0][0] - time.time(), 0))
+		ready = select.select(self.sockets.keys() + [ self.listener ], [], [], timeout)
+		for sock in ready[0]:
+			self.receive(sock)
+		now = time.time()
+		while len(self.queue) and self.queue[0][0] <= now:
+			when, seq, sock, reply, addr = heapq.heappop(self.queue)
+			sock.sendto(reply, addr)
+
+	def serve_forever(self):
+		self.running = True
+		while self.running:
+			self.step(0.05)
+
+	# Run in a background thread.
+	def start(self):
+		self.thread = threading.Thread(target=self.serve_forever)
+		self.thread.daemon = True
+		self.thread.start()
+		return self
+
+	def stop(self):
+		self.running = False
+		if self.thread != None:
+			self.thread.join()
+			self.thread = None
+		for s in self.sockets.keys() + [ self.listener ]:
+			s.close()
+
+if __name__ == "__main__":
+	import argparse
+	parser = argparse.ArgumentParser(description="Simulate TOF boards on the local host.")
+	parser.add_argument("--boards", type=int, default=1, help="number of boards (at 127.0.0.1, .2, ...)")
+	parser.add_argument("--flash", help="flash image to load into every board")
+	parser.add_argument("--latency", type=float, default=0.0)
+	parser.add_argument("--jitter", type=float, default=0.0)
+	parser.add_argument("--loss", type=float, default=0.0)
+	parser.add_argument("--reply-loss", type=float, default=0.0)
+	parser.add_argument("--reorder", type=float, default=0.0)
+	parser.add_argument("--flash-timing", type=float, default=0.01,
+						help="scale for flash program/erase times (1 = real)")
+	args = parser.parse_args()
+	boards = []
+	for i in xrange(args.boards):
+		if args.flash:
+			flash = SimFlash.from_file(args.flash, time_scale=args.flash_timing)
+		else:
+			flash = SimFlash(time_scale=args.flash_timing)
+		boards.append(SimBoard(dna=0x0123456789ABCD + i, ip='127.0.0.%d' % (i+1), flash=flash))
+	sim = Simulator(boards, latency=args.latency, jitter=args.jitter, loss=args.loss,
+					reply_loss=args.reply_loss, reorder=args.reorder)
+	print "Simulating %d board(s) on port %d." % (len(boards), sim.port)
+	try:
+		sim.serve_forever()
+	except KeyboardInterrupt:
+		pass
@@ -1,9 +1,19 @@
 import struct
+import itertools
 import sys
 import time
-import hexfile
+import binascii
+import codec
+import discovery
+import image
+import poll
+import regcache
+import retry
 from bf import * 
 
+# hexfile is only imported when an MCS file has to be parsed (see
+# image.py), so just talking to a board doesn't need it.
+
 #Low-level implementations.
 # OpenCores SPI controller. Typically on an OpenCores PCI device, so
 # usually just has read/write
@@ -20,41 +30,48 @@ class OCSPI:
              'RFFULL'    : 0x02,
              'RFEMPTY'   : 0x01 }
 
+	SPCR = Register('SPCR', 0x00, SPR=(1,0), CPHA=2, CPOL=3, MSTR=4, SPE=6, SPIE=7)
+	SPSR = Register('SPSR', 0x04, RFEMPTY=0, RFFULL=1, WFEMPTY=2, WFFULL=3, WCOL=6, SPIF=7)
+
 	def __init__(self, dev, base, device=0):
 		self.dev = dev
 		self.base = base
 		self.device = device
-		val = bf(self.dev.read(self.base + self.map['SPCR']))
-		val[6] = 1
-		val[3] = 0
-		val[2] = 0
-		self.dev.write(self.base+self.map['SPCR'], int(val))
+		self.spcr = base + self.SPCR.offset
+		self.spsr = base + self.SPSR.offset
+		self.spdr = base + self.map['SPDR']
+		val = self.dev.read(self.spcr)
+		val = self.SPCR.encode(val, SPE=1, CPOL=0, CPHA=0)
+		self.dev.write(self.spcr, val)
 		
 	def command(self, command, dummy_bytes, num_read_bytes, data_in = []):
 		self.dev.spi_cs(self.device, 1)
-		self.dev.write(self.base + self.map['SPDR'], command)
+		self.dev.write(self.spdr, command)
 		x = 0 
+		wcol = self.SPSR.WCOL.mask
 		for dat in data_in:
-			self.dev.write(self.base + self.map['SPDR'], dat)
-			val = bf(self.dev.read(self.map['SPSR']))
+			self.dev.write(self.spdr, dat)
+			val = self.dev.read(self.spsr)
 			x+=1
-			if val[6] == 1:
+			if val & wcol:
 				return x 
 		for i in range(dummy_bytes):
-			self.dev.write(self.base + self.map['SPDR'], 0x00)
+			self.dev.write(self.spdr, 0x00)
 		# Empty the read FIFO.
-		while not (self.dev.read(self.base + self.map['SPSR']) & self.bits['RFEMPTY']):
-			self.dev.read(self.base + self.map['SPDR'])
+		rfempty = self.SPSR.RFEMPTY.mask
+		while not (self.dev.read(self.spsr) & rfempty):
+			self.dev.read(self.spdr)
 		rdata = []
 		for i in range(num_read_bytes):
-			self.dev.write(self.base + self.map['SPDR'], 0x00)
-			rdata.append(self.dev.read(self.base + self.map['SPDR']))
+			self.dev.write(self.spdr, 0x00)
+			rdata.append(self.dev.read(self.spdr))
 		self.dev.spi_cs(self.device, 0)    
 		return rdata
 
 
 # Xilinx AXI Quad SPI controller. This one presumes you have
-# a read/write/readMultiple command.
+# a read/write/readMultiple command, and a batch() to queue
+# them up with (see udp.Batch).
 # (I should implement readMultiple for the OpenCores PCI device...)
 class AXIQuadSPI:
 	map = { 'SRR'				: 0x40,
@@ -68,68 +85,353 @@ class AXIQuadSPI:
 			'DGIER'				: 0x1C,
 			'IPISR'				: 0x20,
 			'IPIER'				: 0x28 }
+
+	SPICR = Register('SPICR', 0x60, LOOP=0, SPE=1, MASTER=2, CPOL=3, CPHA=4, TX_FIFO_RESET=5,
+					 RX_FIFO_RESET=6, MANUAL_SS=7, INHIBIT=8, LSB_FIRST=9)
+	SPISR = Register('SPISR', 0x64, RX_EMPTY=0, RX_FULL=1, TX_EMPTY=2, TX_FULL=3, MODF=4,
+					 SLAVE_MODE_SELECT=5, CPOL_CPHA_ERROR=6, SLAVE_MODE_ERROR=7, MSB_ERROR=8,
+					 LOOPBACK_ERROR=9, COMMAND_ERROR=10)
+	# SPICR for each stage of a transfer: reset the FIFOs with the
+	# master inhibited while the first load goes in, run, and stop.
+	CR_SETUP = SPICR.encode(SPE=1, MASTER=1, TX_FIFO_RESET=1, RX_FIFO_RESET=1, MANUAL_SS=1, INHIBIT=1)
+	CR_RUN = SPICR.encode(SPE=1, MASTER=1, MANUAL_SS=1)
+	CR_STOP = SPICR.encode(SPE=1, MASTER=1, MANUAL_SS=1, INHIBIT=1)
+	SS_NONE = 0xFFFF
+	# what the core was built with: FIFO depth (16 or 256), and SCK
+	# (ext_spi_clk over the SCK ratio), for utilization()
+	fifo_depth = 16
+	sck_hz = 25e6
+	# reads go through stream_ahead() until it fails
+	read_ahead = True
+
 	def __init__(self, dev, base, device=0):
 		self.dev = dev
 		self.base = base
 		self.device = device
-		# Don't need to initialize anything in this case.
+		self.reset_stats()
+		# Don't need to initialize anything in this case, just work
+		# out the addresses once.
+		self.spicr = base + self.SPICR.offset
+		self.spisr = base + self.SPISR.offset
+		self.spidtr = base + self.map['SPIDTR']
+		self.spidrr = base + self.map['SPIDRR']
+		self.spissr = base + self.map['SPISSR']
+		self.spitxfifoavail = base + self.map['SPITXFIFOAVAIL']
+		self.spirxfifoavail = base + self.map['SPIRXFIFOAVAIL']
+		self.ss_select = self.SS_NONE & ~(1 << device)
+		if hasattr(dev, 'cache'):
+			# only we touch SPICR (the FIFO resets self-clear) and
+			# SPISSR; DTR/DRR are FIFOs, never to be retransmitted
+			dev.cache.declare(self.spicr, self.spicr + 4, regcache.CACHEABLE,
+							  clear=self.SPICR.TX_FIFO_RESET.mask | self.SPICR.RX_FIFO_RESET.mask)
+			dev.cache.declare(self.spissr, self.spissr + 4, regcache.CACHEABLE)
+			dev.cache.declare(self.spidtr, self.spidrr + 4, regcache.FIFO)
 
 	def command(self, command, dummy_bytes, num_read_bytes, data_in = []):
-		# reset RX/TX FIFOs + master transaction inhibit + slave assertion + spi enable + master mode		
-		self.dev.write(self.base+self.map['SPICR'], 0x1E6)
-		# compose the full data to be sent
-		# that is, the RES command, which sends
-		# 
-		data = [ command ] + data_in + [0]*(dummy_bytes + num_read_bytes)
 		rdata = []
-		# short operation?
-		if len(data) <= 16:
-			self.dev.write(self.base+self.map['SPIDTR'], data)
-			val = bf(0xFFFF)
-			val[self.device]=0			
-			self.dev.write(self.base+self.map['SPISSR'], int(val))
-			# enable transaction (+no reset)
-			self.dev.write(self.base+self.map['SPICR'], 0x86)
-			ntries=0
-			while ntries<1000:
-				ntries=ntries+1
-				if (self.dev.read(self.base+self.map['SPISR']) & 0x4):
-					break
-			rdata=self.dev.readMultiple(self.base+self.map['SPIDRR'], len(data))
-		else:
-			# yoink 16 bytes of data
-			count=len(data)
-			wdata=data[0:16]
-			data=data[16:]
-			rdata=[]
-			self.dev.write(self.base+self.map['SPIDTR'], wdata)
-			val = bf(0xFFFF)
-			val[self.device]=0			
-			self.dev.write(self.base+self.map['SPISSR'], int(val))
-			self.dev.write(self.base+self.map['SPICR'], 0x86)
-			# now loop
+		for data in self.stream(command, dummy_bytes, num_read_bytes, data_in):
+			rdata.extend(data)
+		return rdata
+
+	# Run one SPI transfer (chip select held throughout) and yield the
+	# bytes read back after the command, data_in and dummy bytes, as
+	# bytearrays of about 'chunk' bytes (chunk=None: all in one).
+	# data_in is a sequence of bytes, or an iterator of chunks of them,
+	# so nothing big ever has to be a list. If the transfer fails,
+	# whatever had been read back before the failure is yielded before
+	# the error's raised, so a read can carry on from there.
+	#
+	# Reads go through stream_ahead() while that keeps working, and
+	# everything else through stream_rounds().
+	def stream(self, command, dummy_bytes, num_read_bytes, data_in = [], chunk=None):
+		if num_read_bytes and self.read_ahead:
+			return self.stream_ahead(command, dummy_bytes, num_read_bytes, data_in, chunk)
+		return self.stream_rounds(command, dummy_bytes, num_read_bytes, data_in, chunk)
+
+	# Reset the FIFOs, queue the first load and start the transfer.
+	def start(self, b, data):
+		# reset RX/TX FIFOs + master transaction inhibit + slave assertion + spi enable + master mode
+		b.write(self.spicr, self.CR_SETUP)
+		self.load(b, data)
+		b.write(self.spissr, self.ss_select)
+		# enable transaction (+no reset)
+		b.write(self.spicr, self.CR_RUN)
+
+	def stop(self, b):
+		b.write(self.spissr, self.SS_NONE)
+		b.write(self.spicr, self.CR_STOP)
+
+	# The careful way: the FIFOs are kept moving a round trip at a
+	# time. Each round is one batch, with no polls in it: drain
+	# whatever the last round saw waiting in the RX FIFO, top up the
+	# TX FIFO with as much as there's room for, and read SPISR and an
+	# occupancy register to see how far it got. Room is counted so
+	# neither FIFO can overflow: the TX FIFO never holds more than
+	# fifo_depth, and when reading there are never more than fifo_depth
+	# bytes sent that haven't been read back. With nothing to read
+	# back the RX FIFO is left to fill up (the next CR_SETUP clears
+	# it), and only the TX FIFO is tracked.
+	def stream_rounds(self, command, dummy_bytes, num_read_bytes, data_in, chunk):
+		feed = Feed(command, data_in, dummy_bytes, num_read_bytes)
+		reading = num_read_bytes > 0
+		depth = self.fifo_depth
+		tx_empty = self.SPISR.TX_EMPTY.mask
+		rx_empty = self.SPISR.RX_EMPTY.mask
+		# bytes known to have left the TX FIFO, read out of the RX
+		# FIFO, and being read out this round
+		shifted = 0
+		drained = 0
+		draining = 0
+		reads = []
+		rdata = bytearray()
+		began = time.time()
+		progress = began
+		rounds = 0
+		b = self.dev.batch()
+		self.start(b, feed.take(depth))
+		finished = False
+		try:
 			while True:
-				ntries=0
-				while ntries<1000:
-					ntries=ntries+1
-					if (self.dev.read(self.base+self.map['SPISR']) & 0x4):
+				if reading:
+					done = feed.done() and drained + draining == feed.sent
+				else:
+					done = feed.done() and shifted == feed.sent
+				if done:
+					self.stop(b)
+				else:
+					sr = b.read(self.spisr)
+					avail = b.read(self.spirxfifoavail if reading else self.spitxfifoavail)
+				error = None
+				try:
+					results = b.execute()
+				except retry.TransactionError:
+					# keep what was read out before it went wrong
+					error = sys.exc_info()
+					results = b.results
+				rounds = rounds + 1
+				for rd in reads:
+					if rd >= b.completed:
 						break
-				rdata.extend(self.dev.readMultiple(self.base+self.map['SPIDRR'], len(wdata)))
-				count = count - len(wdata)
-				if count == 0:
+					for val in results[rd]:
+						if feed.is_read(drained):
+							rdata.append(val & 0xFF)
+						drained = drained + 1
+				if error != None:
+					if len(rdata):
+						yield rdata
+					raise error[0], error[1], error[2]
+				draining = 0
+				reads = []
+				if done:
+					finished = True
 					break
-				if len(data) <= 16:
-					wdata=data
+				if chunk != None and len(rdata) >= chunk:
+					yield rdata
+					rdata = bytearray()
+				# the status was read after this round's writes went in
+				was = (shifted, drained)
+				b = self.dev.batch()
+				if reading:
+					# only the RX side matters: whatever's come back
+					# has been shifted
+					if not results[sr] & rx_empty:
+						draining = results[avail] + 1
+					for offset in xrange(0, draining, codec.MAX_WORDS):
+						reads.append(b.readMultiple(self.spidrr, min(codec.MAX_WORDS, draining - offset)))
+					shifted = drained + draining
+					room = depth - (feed.sent - shifted)
 				else:
-					wdata=data[0:16]
-					data=data[16:]
-				
-				self.dev.write(self.base+self.map['SPIDTR'], wdata)
-		self.dev.write(self.base+self.map['SPISSR'], 0xFFFF)
-		self.dev.write(self.base+self.map['SPICR'], 0x186)
-		# Strip off command, dummy bytes, and write data (then back one since we start at 0)
-		rdata=rdata[1+dummy_bytes+len(data_in):]
-		return rdata
+					shifted = feed.sent - (0 if results[sr] & tx_empty else results[avail] + 1)
+					room = depth - (feed.sent - shifted)
+				now = time.time()
+				if (shifted, drained) != was:
+					progress = now
+				elif now - progress > self.dev.timeout:
+					raise retry.TransactionError("SPI transfer stalled (%d of %d bytes out)" % (shifted, feed.sent))
+				self.load(b, feed.take(room))
+		finally:
+			# failed, or whoever was reading stopped early
+			if not finished:
+				self.dev.write(self.spissr, self.SS_NONE)
+				self.dev.write(self.spicr, self.CR_STOP)
+		self.record(feed.sent, time.time() - began, rounds)
+		if len(rdata):
+			yield rdata
+
+	# Reads, without waiting to see how far each load got: the bus
+	# is normally far quicker than the network, so by the time the
+	# board gets the next request the last load's long since been
+	# shifted out. The transfer goes in steps of half the FIFO, each
+	# one loaded behind the last, which is then read out of the RX
+	# FIFO, after a read of SPIRXFIFOAVAIL to check it's all there.
+	# A whole chunk's worth of steps goes out as one batch. Half the
+	# FIFO per step means neither FIFO can overflow even if a step's
+	# still shifting when the next one goes in, and as long as every
+	# check passes (every read-out got real data) the FIFOs stayed in
+	# step. If one fails the bus is slower than it looked: the
+	# transfer fails (to be retried), and this controller sticks to
+	# stream_rounds() from then on.
+	def stream_ahead(self, command, dummy_bytes, num_read_bytes, data_in, chunk):
+		feed = Feed(command, data_in, dummy_bytes, num_read_bytes)
+		step = max(self.fifo_depth/2, 1)
+		rx_empty = self.SPISR.RX_EMPTY.mask
+		rdata = bytearray()
+		drained = 0
+		# size of the step loaded but not read out yet
+		pending = 0
+		began = time.time()
+		rounds = 0
+		finished = False
+		try:
+			while True:
+				b = self.dev.batch()
+				checks = []
+				sent = feed.sent
+				while not feed.done() and (chunk == None or feed.sent - sent < chunk):
+					data = feed.take(step)
+					if feed.sent == len(data):
+						self.start(b, data)
+					else:
+						self.load(b, data)
+					if pending:
+						checks.append(self.read_out(b, pending))
+					pending = len(data)
+				if feed.done():
+					if pending:
+						checks.append(self.read_out(b, pending))
+						pending = 0
+					self.stop(b)
+				# one timeout per 256 bytes
+				error = None
+				try:
+					results = b.execute(self.dev.timeout*((feed.sent - sent + 255)/256 + 1))
+				except retry.TransactionError:
+					# what was read out before it went wrong is still
+					# good: hand that over first (see SPI.stream_read)
+					error = sys.exc_info()
+					results = b.results
+				rounds = rounds + 1
+				for sr, avail, reads, n in checks:
+					if reads[-1] >= b.completed:
+						break
+					if results[avail] + 1 < n or (sr != None and results[sr] & rx_empty):
+						if error != None:
+							# a load went missing, that's all
+							break
+						self.read_ahead = False
+						raise retry.TransactionError("SPI RX FIFO had %d of %d bytes: bus too slow to read ahead" % (
+							results[avail] + 1, n))
+					for rd in reads:
+						for val in results[rd]:
+							if feed.is_read(drained):
+								rdata.append(val & 0xFF)
+							drained = drained + 1
+				if error != None:
+					if len(rdata):
+						yield rdata
+					raise error[0], error[1], error[2]
+				if feed.done() and not pending:
+					finished = True
+					break
+				if chunk != None and len(rdata):
+					yield rdata
+					rdata = bytearray()
+		finally:
+			if not finished:
+				self.dev.write(self.spissr, self.SS_NONE)
+				self.dev.write(self.spicr, self.CR_STOP)
+		self.record(feed.sent, time.time() - began, rounds)
+		if len(rdata):
+			yield rdata
+
+	# Check that 'n' bytes are waiting in the RX FIFO (SPIRXFIFOAVAIL
+	# is one less than that, so a single byte needs SPISR too), and
+	# read them out.
+	def read_out(self, b, n):
+		sr = b.read(self.spisr) if n == 1 else None
+		avail = b.read(self.spirxfifoavail)
+		reads = []
+		for offset in xrange(0, n, codec.MAX_WORDS):
+			reads.append(b.readMultiple(self.spidrr, min(codec.MAX_WORDS, n - offset)))
+		return (sr, avail, reads, n)
+
+	# Queue 'data' into the TX FIFO.
+	def load(self, b, data):
+		for offset in xrange(0, len(data), codec.MAX_WORDS):
+			b.write(self.spidtr, data[offset:offset+codec.MAX_WORDS])
+
+	def record(self, nbytes, elapsed, rounds):
+		self.transfers = self.transfers + 1
+		self.bus_bytes = self.bus_bytes + nbytes
+		self.elapsed = self.elapsed + elapsed
+		self.rounds = self.rounds + rounds
+
+	def reset_stats(self):
+		self.transfers = 0
+		self.bus_bytes = 0
+		self.elapsed = 0.0
+		self.rounds = 0
+
+	# Fraction of the time spent in transfers that SCK was actually
+	# running.
+	def utilization(self):
+		if not self.elapsed:
+			return 0.0
+		return self.bus_bytes*8/self.sck_hz/self.elapsed
+
+	def report(self):
+		print "SPI: %d transfers, %d bytes in %.3f s (%.1f kB/s), %d round trips, bus %.2f%% busy at %.1f MHz" % (
+			self.transfers, self.bus_bytes, self.elapsed, self.bus_bytes/1024.0/max(self.elapsed, 1e-9),
+			self.rounds, 100*self.utilization(), self.sck_hz/1e6)
+
+# What goes out on MOSI during a transfer, taken a FIFO load at a
+# time: the command, data_in (a sequence of bytes, or an iterator of
+# chunks of them), the dummy bytes and a zero for every byte read.
+class Feed(object):
+	def __init__(self, command, data_in, dummy_bytes, num_read_bytes):
+		if hasattr(data_in, '__getitem__'):
+			data_in = [ data_in ]
+		self.chunks = itertools.chain([ [ command ] ], data_in)
+		self.chunk = []
+		self.offset = 0
+		self.dummy_bytes = dummy_bytes
+		self.zeros = dummy_bytes + num_read_bytes
+		self.sent = 0
+		# how many bytes come before the read data, once that's known
+		self.header = None
+		self.next_chunk()
+
+	def next_chunk(self):
+		while self.chunks != None and self.offset >= len(self.chunk):
+			try:
+				self.chunk = self.chunks.next()
+				self.offset = 0
+			except StopIteration:
+				self.chunks = None
+				self.header = self.sent + self.dummy_bytes
+
+	# Up to 'n' more bytes, as a list.
+	def take(self, n):
+		data = []
+		while len(data) < n and self.chunks != None:
+			count = min(n - len(data), len(self.chunk) - self.offset)
+			data.extend(bytearray(self.chunk[self.offset:self.offset+count]))
+			self.offset = self.offset + count
+			self.sent = self.sent + count
+			self.next_chunk()
+		if self.chunks == None and len(data) < n:
+			count = min(n - len(data), self.zeros)
+			data.extend([ 0 ]*count)
+			self.zeros = self.zeros - count
+			self.sent = self.sent + count
+		return data
+
+	def done(self):
+		return self.chunks == None and self.zeros == 0
+
+	# Is byte 'index' of what comes back read data?
+	def is_read(self, index):
+		return self.header != None and index >= self.header
 
 class SPI:    
 	cmd = { 'RES'        : 0xAB ,
@@ -141,6 +443,7 @@ class SPI:
             '4READ'      : 0x13 , 
 		    '3READ'      : 0x03 ,   
             'FASTREAD'   : 0x0B ,
+            '4FASTREAD'  : 0x0C ,
             '4PP'        : 0x12 , 
 		    '3PP'        : 0x02 , 
             '4SE'        : 0xDC , 
@@ -149,25 +452,129 @@ class SPI:
             'BRWR'       : 0x17 , 
             'BE'         : 0xC7 ,
 			'RDSFDP'	 : 0x5A }
-			    
+	# FASTREAD needs 8 dummy clocks after the address
+	fastread_dummy_bytes = 1
+	# times to restart a transfer that failed partway
+	retries = 3
+	# times a stream_read() may fail in a row without getting any
+	# further. It keeps what came in before each failure, so on a lossy
+	# network it mostly does get further; it only gets nowhere when the
+	# loss is right at the start.
+	stream_retries = 10
+
+	# A lost FIFO access can't just be resent, but a whole transfer
+	# can: each one starts by resetting the FIFOs. That's fine for
+	# anything that doesn't change the flash; for what does, see
+	# write_command().
 	def command(self, command, dummy_bytes, num_read_bytes, data_in = []):
-		return self.dev.command(command, dummy_bytes, num_read_bytes, data_in)
+		attempt = 0
+		while True:
+			try:
+				return self.dev.command(command, dummy_bytes, num_read_bytes, data_in)
+			except retry.WriteLost:
+				# something before this went wrong
+				raise
+			except retry.TransactionError:
+				attempt = attempt + 1
+				if attempt > self.retries:
+					raise
+
+	# Program/erase: write enable, then the command, then wait 'expected'
+	# (up to 'limit') for it to finish. If the transfer fails partway
+	# the flash may or may not have started, and if it did WEL is gone,
+	# so wait it out and redo the whole thing. Programming a page
+	# again with the same data (or erasing twice) doesn't hurt. With
+	# posted writes (udp.UDPFPGA.post_writes) a lost write only shows
+	# up at the next read, so that's the first status read after the
+	# write enable or the command.
+	# If 'resume' is given, it's called after a failure instead, to see
+	# what's left to do: it returns the data_in to redo the command
+	# with, or None if it's done after all. Getting a shorter data_in
+	# back counts as progress, and only failures without any count
+	# against 'retries'.
+	# Returns how many attempts failed.
+	def write_command(self, command, data_in, expected, limit, name, resume=None):
+		attempt = 0
+		failed = 0
+		while True:
+			try:
+				self.write_enable()
+				self.dev.command(command, 0, 0, data_in)
+				self.wait_ready(expected, limit, name)
+				return failed
+			except retry.TransactionError:
+				attempt = attempt + 1
+				failed = failed + 1
+				if attempt > self.retries:
+					raise
+				self.wait_ready(expected, limit, name)
+				if resume != None:
+					left = resume()
+					if left == None:
+						return failed
+					if len(left) < len(data_in):
+						attempt = 0
+					data_in = left
 		
-	def __init__(self, low_level_spi):
+	# what probe() finds out about the flash
+	identity = ('electronic_signature', 'manufacturer_id', 'memory_type', 'memory_capacity',
+				'extended_data', 'serial_flash_parameters')
+
+	# 'key' identifies the flash for the identity cache (the board's
+	# DNA), if there is one. Nothing's said to the flash until
+	# something needs to know what it is.
+	def __init__(self, low_level_spi, key=None):
 		self.dev = low_level_spi
-		res = self.command(self.cmd['RES'], 3, 1)
-		self.electronic_signature = res[0]
-		res = self.command(self.cmd['RDID'], 0, 4)
-		self.manufacturer_id = res[0]
-		self.memory_type = res[1]
-		self.memory_capacity = 2**res[2]        
-		extended_data_count = res[3]
-		self.extended_data = []
+		self.key = key
+		self.identities = discovery.default_cache('flash')
+		# bytes page-programmed so far
+		self.programmed = 0
+		# share the board's poller (and its stats) if it has one
+		if hasattr(self.dev, 'dev') and hasattr(self.dev.dev, 'poller'):
+			self.poller = self.dev.dev.poller
+		else:
+			self.poller = poll.Poller()
+
+	def __getattr__(self, name):
+		if name in SPI.identity:
+			self.probe()
+			return self.__dict__[name]
+		raise AttributeError(name)
+
+	# Find out what the flash is: RES, RDID (and extended RDID), and
+	# the SFDP basic parameter table. That's five transfers, so what
+	# it said is kept by board DNA and only asked again with 'refresh'.
+	def probe(self, refresh=False):
+		record = None
+		if self.key != None and not refresh:
+			record = self.identities.get(self.key)
+		if record != None:
+			try:
+				signature, rdid, sfdp = [ list(bytearray(binascii.unhexlify(field))) for field in record.split(':') ]
+			except (TypeError, ValueError):
+				record = None
+		if record == None:
+			signature, rdid, sfdp = self.read_identity()
+			if self.key != None:
+				self.identities.update({ self.key : ':'.join([ binascii.hexlify(bytearray(field))
+															   for field in (signature, rdid, sfdp) ]) })
+		self.electronic_signature = signature[0]
+		self.manufacturer_id = rdid[0]
+		self.memory_type = rdid[1]
+		self.memory_capacity = 2**rdid[2]
+		self.extended_data = rdid[4:]
+		self.serial_flash_parameters = sfdp
+
+	# Returns the RES signature, the RDID response and the SFDP
+	# parameters (empty if it doesn't do SFDP), as lists.
+	def read_identity(self):
+		signature = self.command(self.cmd['RES'], 3, 1)
+		rdid = self.command(self.cmd['RDID'], 0, 4)
+		extended_data_count = rdid[3]
 		if extended_data_count != 0 and extended_data_count != 255:
-			res = self.command(self.cmd['RDID'], 0, 4+extended_data_count)
-			self.extended_data = res[4:]
-        # Now try fetching SFDP.
-		self.serial_flash_parameters = []
+			rdid = self.command(self.cmd['RDID'], 0, 4+extended_data_count)
+		# Now try fetching SFDP.
+		sfdp = []
 		addr=[0,0,0]
 		res = self.command(self.cmd['RDSFDP'], 1, 16, addr)
 		if chr(res[0]) == 'S' and chr(res[1]) == 'F' and chr(res[2]) == 'D' and chr(res[3]) == 'P':
@@ -178,8 +585,8 @@ class SPI:
 				# grr. read out = lowest address first
 				# send in = highest address first
 				addr=[ res[14], res[13], res[12] ]
-				self.serial_flash_parameters = self.command(self.cmd['RDSFDP'], 1, len, addr)
-		
+				sfdp = self.command(self.cmd['RDSFDP'], 1, len, addr)
+		return (signature, rdid, sfdp)
 		
 	def status(self):
 		res = self.command(self.cmd['RDSR'], 0, 1)
@@ -194,14 +601,14 @@ class SPI:
 			i = 0
 			while i<len(self.extended_data):
 				dat=self.extended_data[i:i+16]
-				print '[{}]'.format(', '.join(hex(x) for x in dat))
+				print '[{}]'.format(', '.join('0x%x' % x for x in dat))
 				i=i+16
 		if len(self.serial_flash_parameters):
 			print "Serial Flash Discoverable Parameters:"
 			i = 0
 			while i<len(self.serial_flash_parameters):
 				dat=self.serial_flash_parameters[i:i+16]
-				print '[{}]'.format(', '.join(hex(x) for x in dat))
+				print '[{}]'.format(', '.join('0x%x' % x for x in dat))
 				i=i+16
 							
 	def read(self, address, length):
@@ -219,17 +626,108 @@ class SPI:
 			data_in.append(address & 0xFF)
 			result = self.command(self.cmd['3READ'], 0, length, data_in)
 		return result 
+
+	# Stream 'length' bytes from 'address' with FASTREAD as one long
+	# transfer, yielding bytearrays of about 'chunk' bytes as they come
+	# in. Controllers without a stream() fall back to plain reads.
+	def stream_read(self, address, length, chunk=4096):
+		if not hasattr(self.dev, 'stream'):
+			offset = 0
+			while offset < length:
+				n = min(chunk, length - offset)
+				yield bytearray(self.read(address + offset, n))
+				offset = offset + n
+			return
+		if self.memory_capacity > 2**24:
+			cmd = self.cmd['4FASTREAD']
+		else:
+			cmd = self.cmd['FASTREAD']
+		# if a chunk fails, pick up again from where it got to in smaller
+		# ones (giving up only if it keeps failing without getting
+		# anywhere)
+		offset = 0
+		attempt = 0
+		while offset < length:
+			try:
+				for data in self.dev.stream(cmd, self.fastread_dummy_bytes, length - offset,
+											self.address_bytes(address + offset), chunk):
+					offset = offset + len(data)
+					attempt = 0
+					yield data
+			except retry.TransactionError:
+				attempt = attempt + 1
+				if attempt > self.stream_retries:
+					raise
+				if chunk != None:
+					chunk = max(chunk/2, 256)
+
+	# 3 or 4 address bytes, whichever the flash takes.
+	def address_bytes(self, address):
+		if self.memory_capacity > 2**24:
+			return [ (address >> 24) & 0xFF, (address >> 16) & 0xFF, (address >> 8) & 0xFF, address & 0xFF ]
+		return [ (address >> 16) & 0xFF, (address >> 8) & 0xFF, address & 0xFF ]
+
+	def read_bytes(self, address, length):
+		data = bytearray()
+		for chunk in self.stream_read(address, length):
+			data.extend(chunk)
+		return data
+
+	# Dump flash contents to a file (by default, the whole thing).
+	def dump(self, filename, address=0, length=None):
+		if length == None:
+			length = self.memory_capacity - address
+		f = open(filename, 'wb')
+		done = 0
+		self.update_progress(0)
+		for data in self.stream_read(address, length, chunk=64*1024):
+			f.write(data)
+			done = done + len(data)
+			self.update_progress(float(done)/float(length))
+		f.close()
+
+	# Compare the flash against an MCS file as it's read back.
+	# Returns True if everything matched.
+	def verify_mcs(self, filename, max_report=10):
+		f = image.load(filename)
+		mismatches = 0
+		total = 0
+		for seg in f.segments:
+			total = total + seg.end_address - seg.start_address
+		done = 0
+		print "Verifying %d bytes." % total
+		self.update_progress(0)
+		for seg in f.segments:
+			want = seg.data
+			offset = 0
+			for data in self.stream_read(seg.start_address, len(want), chunk=16*1024):
+				expected = bytearray(want[offset:offset+len(data)])
+				if data != expected:
+					for i in xrange(len(data)):
+						if data[i] != expected[i]:
+							if mismatches < max_report:
+								print "\nMismatch at 0x%x: read 0x%x, expected 0x%x" % (seg.start_address+offset+i, data[i], expected[i])
+							mismatches = mismatches + 1
+				offset = offset + len(data)
+				done = done + len(data)
+				self.update_progress(float(done)/float(total))
+		if mismatches:
+			print "Verify failed: %d bytes differ." % mismatches
+			return False
+		print "Verify OK."
+		return True
 	
 	def write_enable(self):
 		enable = self.command(self.cmd["WREN"], 0, 0)
-		trials = 0
-		while trials < 10:
-			res = self.status()
-			if not res & 0x2:
-				trials = trials + 1
-			else:
-				return
-		print "Write enable failed (%d)!" % res
+		try:
+			self.poller.until(self.status, lambda res: res & 0x2, timeout=0.1, name='write enable')
+		except poll.PollTimeout as e:
+			print "Write enable failed (%d)!" % e.value
+
+	# Wait for WIP to clear. 'expected' is the typical time for the
+	# operation, 'limit' the most it should take.
+	def wait_ready(self, expected, limit, name):
+		return self.poller.until(self.status, lambda res: not (res & 0x1), expected, limit, name)
 		
 	def write_disable(self):
 		disable = self.command(self.cmd["WRDI"], 0, 0)
@@ -238,34 +736,198 @@ class SPI:
 			print "Write disable failed (%d)!" % res
 
 	def find_erase_sector_size(self):
-		sector_size = 0
-		if len(self.serial_flash_parameters) != 0:
+		sfdp = self.serial_flash_parameters
+		if len(sfdp) != 0:
 			# derive sector size from parameters
-			print "Finding sector size from SFDP"
-			if self.serial_flash_parameters[0x1D] == self.cmd['3SE']:
-				sector_size=2**self.serial_flash_parameters[0x1C]
-			elif self.serial_flash_parameters[0x1F] == self.cmd['3SE']:
-				sector_size=2**self.serial_flash_parameters[0x1E]
-			elif self.serial_flash_parameters[0x21] == self.cmd['3SE']:
-				sector_size=2**self.serial_flash_parameters[0x20]
-			elif self.serial_flash_parameters[0x23] == self.cmd['3SE']:
-				sector_size=2**self.serial_flash_parameters[0x22]
-		else:
-			if self.manufacturer_id == 0x01 and len(self.extended_data) != 0:
-				print "Finding sector size from Spansion/Cypress CFI"
-				if self.extended_data[0] == 0x00:
-					sector_size = 256*1024
-				elif self.extended_data[0] == 0x01:
-					sector_size = 64*1024
-				else:
-					print "Unknown sector architecture %x in Spansion/Cypress CFI" % self.extended_data[0]
-					print "Guessing 64 kB."
-					sector_size = 64*1024
+			self.say("Finding sector size from SFDP")
+			for i in xrange(4):
+				if sfdp[0x1D + 2*i] == self.cmd['3SE']:
+					return 2**sfdp[0x1C + 2*i]
+			self.say("No sector erase in SFDP")
+		if self.manufacturer_id == 0x01 and len(self.extended_data) != 0:
+			self.say("Finding sector size from Spansion/Cypress CFI")
+			if self.extended_data[0] == 0x00:
+				return 256*1024
+			elif self.extended_data[0] == 0x01:
+				return 64*1024
+			self.say("Unknown sector architecture %x in Spansion/Cypress CFI" % self.extended_data[0])
+			self.say("Guessing 64 kB.")
+			return 64*1024
+		self.say("No SFDP, no CFI: guessing sector size is 64 kB")
+		self.say("If this is wrong, try passing the correct value")
+		return 64*1024
+
+	# The erase opcode (from erase_types) for a 'size' byte sector.
+	def erase_opcode(self, size):
+		for s, opcode, t in self.erase_types():
+			if s == size:
+				return opcode
+		raise ValueError("No %d byte erase on this flash" % size)
+
+	# 3-byte erase opcodes from SFDP, and their 4-byte equivalents
+	four_byte_erase = { 0x20 : 0x21, 0x52 : 0x5C, 0xD8 : 0xDC }
+
+	# Typical erase time units in SFDP DWORD10 / chip erase in DWORD11
+	erase_time_units = [ 0.001, 0.016, 0.128, 1.0 ]
+	chip_erase_time_units = [ 0.016, 0.256, 4.0, 64.0 ]
+
+	# Guesses for a sector erase/page program if SFDP doesn't say,
+	# and how much longer than typical the max is.
+	default_erase_time = 1.0
+	default_page_program_time = 0.001
+	default_max_multiplier = 6
+
+	# Shortest timeouts we'll use, whatever SFDP says: the round trips
+	# to ask have to fit in too.
+	min_program_timeout = 0.1
+	min_erase_timeout = 1.0
+
+	# List of (size, opcode, typical time) for each erase type, smallest
+	# first. From SFDP (bytes 0x1C-0x23, times from 0x24-0x27) if
+	# there is one, otherwise just the sector erase.
+	def erase_types(self):
+		types = []
+		sfdp = self.serial_flash_parameters
+		if len(sfdp) >= 0x24:
+			times = None
+			if len(sfdp) >= 0x28:
+				times = sfdp[0x24] | (sfdp[0x25] << 8) | (sfdp[0x26] << 16) | (sfdp[0x27] << 24)
+			for i in xrange(4):
+				size = sfdp[0x1C + 2*i]
+				opcode = sfdp[0x1D + 2*i]
+				if size == 0:
+					continue
+				t = self.default_erase_time
+				if times != None:
+					count = (times >> (4 + 7*i)) & 0x1F
+					units = (times >> (9 + 7*i)) & 0x3
+					t = (count + 1)*self.erase_time_units[units]
+				if self.memory_capacity > 2**24:
+					if opcode not in self.four_byte_erase:
+						continue
+					opcode = self.four_byte_erase[opcode]
+				types.append((2**size, opcode, t))
+		if not len(types):
+			sector_size = self.find_erase_sector_size()
+			opcode = self.cmd['4SE'] if self.memory_capacity > 2**24 else self.cmd['3SE']
+			types.append((sector_size, opcode, self.default_erase_time))
+		types.sort()
+		return types
+
+	# (typical, max) time for an erase with 'opcode'.
+	def erase_time(self, opcode):
+		multiplier = self.default_max_multiplier
+		sfdp = self.serial_flash_parameters
+		if len(sfdp) >= 0x28:
+			multiplier = 2*((sfdp[0x24] & 0xF) + 1)
+		if opcode == self.cmd['BE']:
+			t = self.chip_erase_time()
+			if t == None:
+				t = self.default_erase_time*self.memory_capacity/(64*1024)
+			return (t, t*multiplier)
+		for size, op, t in self.erase_types():
+			if op == opcode:
+				return (t, t*multiplier)
+		return (self.default_erase_time, self.default_erase_time*multiplier)
+
+	# (typical, max) page program time from SFDP DWORD11.
+	def page_program_time(self):
+		sfdp = self.serial_flash_parameters
+		if len(sfdp) < 0x2C:
+			t = self.default_page_program_time
+			return (t, t*self.default_max_multiplier)
+		val = sfdp[0x28] | (sfdp[0x29] << 8)
+		count = (val >> 8) & 0x1F
+		units = 0.000064 if val & 0x2000 else 0.000008
+		t = (count + 1)*units
+		return (t, t*2*((val & 0xF) + 1))
+
+	# Typical whole-chip erase time from SFDP, or None if unknown.
+	def chip_erase_time(self):
+		sfdp = self.serial_flash_parameters
+		if len(sfdp) < 0x2C:
+			return None
+		val = sfdp[0x28] | (sfdp[0x29] << 8) | (sfdp[0x2A] << 16) | (sfdp[0x2B] << 24)
+		count = (val >> 24) & 0x1F
+		units = (val >> 29) & 0x3
+		return (count + 1)*self.chip_erase_time_units[units]
+
+	# Work out the fastest way to erase everything the hexfile's
+	# segments cover. Only blocks of the largest erase type that the
+	# image touches may be erased (same as erasing by sector always
+	# did); within those, each block is either erased whole or split
+	# into smaller erases, whichever's quicker. Given 'largest', no
+	# erase type bigger than that is used. Bulk erase wipes the entire
+	# chip, so it's only considered if allow_bulk is set.
+	# Returns (list of (address, size, opcode, time), predicted time);
+	# a bulk erase is (0, capacity, BE, time).
+	def plan_erase(self, f, allow_bulk=False, largest=None):
+		types = [ t for t in self.erase_types() if largest == None or t[0] <= largest ]
+		if not len(types):
+			raise ValueError("No erase of %d bytes or less on this flash" % largest)
+		unit = types[0][0]
+		needed = set()
+		for seg in f.segments:
+			if seg.end_address <= seg.start_address:
+				continue
+			for block in xrange(seg.start_address/unit, (seg.end_address-1)/unit + 1):
+				needed.add(block)
+		# cost of erasing block 'index' of types[level]: (time, ops)
+		def cost(level, index):
+			size, opcode, t = types[level]
+			per = size/unit
+			if not any([ (index*per + i) in needed for i in xrange(per) ]):
+				return (0, [])
+			best = (t, [ (index*size, size, opcode, t) ])
+			if level > 0:
+				ratio = size/types[level-1][0]
+				total = 0
+				ops = []
+				for i in xrange(ratio):
+					sub = cost(level-1, index*ratio + i)
+					total = total + sub[0]
+					ops.extend(sub[1])
+				if total < best[0]:
+					best = (total, ops)
+			return best
+		top = len(types)-1
+		per = types[top][0]/unit
+		plan = []
+		predicted = 0
+		for index in sorted(set([ block/per for block in needed ])):
+			t, ops = cost(top, index)
+			plan.extend(ops)
+			predicted = predicted + t
+		bulk = self.chip_erase_time()
+		if allow_bulk and bulk != None and bulk < predicted:
+			return ([ (0, self.memory_capacity, self.cmd['BE'], bulk) ], bulk)
+		return (plan, predicted)
+
+	# Carry out a plan from plan_erase, reporting predicted vs.
+	# actual time. Returns the actual time taken.
+	def execute_erase_plan(self, plan, predicted):
+		sizes = {}
+		for address, size, opcode, t in plan:
+			sizes[size] = sizes.get(size, 0) + 1
+		self.say("Erasing: %s (predicted %.1f s)." % (', '.join([ '%d x %d kB' % (sizes[size], size/1024) for size in sorted(sizes) ]), predicted))
+		start = time.time()
+		count = 0
+		self.update_progress(0)
+		for address, size, opcode, t in plan:
+			if opcode == self.cmd['BE']:
+				self.bulk_erase()
 			else:
-				print "No SFDP, no CFI: guessing sector size is 64 kB"
-				print "If this is wrong, try passing the correct value"
-				sector_size = 64*1024
-		return sector_size	
+				self.erase(address, opcode)
+			count = count + 1
+			self.update_progress(float(count)/float(len(plan)))
+		actual = time.time() - start
+		self.say("Erase took %.1f s (predicted %.1f s)." % (actual, predicted))
+		return actual
+
+	# Progress and messages from the long operations. Replace these on
+	# an instance to send them somewhere else (see fleet.py).
+	def say(self, text):
+		print text
 
 	@staticmethod
 	def update_progress(progress):
@@ -288,106 +950,182 @@ class SPI:
 		sys.stdout.flush()
 
 
-	def program_mcs(self, filename, sector_size=0):
-		f = hexfile.load(filename)
-		# Figure out what sectors we need to erase.
-		sector_size = 0
-		total_size = self.memory_capacity
-		page_size = 256
-		if sector_size == 0:
-			sector_size = self.find_erase_sector_size()
-			
-		print "Sector size is %d" % sector_size
-		erase_sectors = [0]*(total_size/sector_size)
-		sector_list = []
-		for seg in f.segments:
-			start_sector = seg.start_address/sector_size
-			if erase_sectors[start_sector] == 0:
-				erase_sectors[start_sector] = 1
-				sector_list.append(start_sector)
-			end_address = seg.end_address
-			end_sector = start_sector + 1
-			while end_sector*sector_size < seg.end_address:
-				if erase_sectors[end_sector] == 0:
-					erase_sectors[end_sector] = 1
-					sector_list.append(end_sector)
-				end_sector = end_sector + 1
-		count=0
-		total=len(sector_list)
-		print "Erasing %d sectors." % total
-		SPI.update_progress(0)
-		for erase in sector_list:
-			self.erase(erase*sector_size)
-			count=count+1
-			SPI.update_progress(float(count)/float(total))
-		seg_count=0
+	# With incremental=True, only sectors whose contents differ from
+	# what's already in the flash get erased and programmed (see
+	# program_incremental). Otherwise the erase is planned with
+	# plan_erase: allow_bulk lets it pick a whole-chip erase. A
+	# 'sector_size' is the biggest erase either one uses (by default,
+	# incremental programming goes by the flash's sector erase, and
+	# the plan uses whatever's quickest). Takes anything image.load
+	# does (.mcs, .hex, .bin, .bit).
+	def program_mcs(self, filename, sector_size=0, incremental=False, allow_bulk=False):
+		return self.program_image(image.load(filename), sector_size, incremental, allow_bulk)
+
+	# Same, with the image already loaded (so it can be shared). A
+	# parsed hexfile works too.
+	def program_image(self, f, sector_size=0, incremental=False, allow_bulk=False):
+		if not isinstance(f, image.Image):
+			f = image.from_hexfile(f)
+		if incremental:
+			if sector_size == 0:
+				sector_size = self.find_erase_sector_size()
+			self.say("Sector size is %d" % sector_size)
+			return self.program_incremental(f, sector_size)
+		plan, predicted = f.erase_plan(self, allow_bulk, sector_size if sector_size != 0 else None)
+		self.execute_erase_plan(plan, predicted)
+		count = f.page_count()
+		self.say("Programming %d pages." % count)
+		self.update_progress(0)
+		done = 0
+		for address, data in f.pages():
+			self.page_program(address, data)
+			done = done + 1
+			self.update_progress(float(done)/float(count))
+		self.write_disable()
+		self.say("Complete!")
+
+	# Lay out what each sector touched by the hexfile's segments
+	# should hold afterwards: segment data, and 0xFF (erased) anywhere
+	# the segments don't cover. Returns { sector number : bytearray }.
+	@staticmethod
+	def sector_images(f, sector_size):
+		sectors = {}
 		for seg in f.segments:
-			start = seg.start_address
-			end = 0
-			print "Programming segment %d/%d." % (seg_count+1 , len(f.segments))
-			SPI.update_progress(0)
-			while start < seg.size:
-				end = start + page_size
-				if end > seg.end_address:
-					end = seg.end_address
-				data = seg[start:end].data
-				self.page_program(start, data)
-				start = end
-				SPI.update_progress(float(start)/float(seg.size))
-				
+			data = seg[seg.start_address:seg.end_address].data
+			address = seg.start_address
+			offset = 0
+			while offset < len(data):
+				sector = (address + offset)/sector_size
+				base = sector*sector_size
+				if sector not in sectors:
+					sectors[sector] = bytearray('\xff'*sector_size)
+				start = address + offset - base
+				n = min(len(data) - offset, sector_size - start)
+				sectors[sector][start:start+n] = bytearray(data[offset:offset+n])
+				offset = offset + n
+		return sectors
+
+	# Differential programming. Each sector the image touches is read
+	# back and compared with what it should hold:
+	#   identical                  - left alone
+	#   only needs 1->0 bit flips  - differing pages programmed, no erase
+	#   anything else              - erased, then non-blank pages programmed
+	# so the time taken scales with how much changed, not the image size.
+	def program_incremental(self, f, sector_size, page_size=256):
+		opcode = self.erase_opcode(sector_size)
+		sectors = SPI.sector_images(f, sector_size)
+		blank = bytearray('\xff'*page_size)
+		erase_list = []
+		program_list = []
+		unchanged = 0
+		self.say("Comparing %d sectors." % len(sectors))
+		self.update_progress(0)
+		count = 0
+		for sector in sorted(sectors):
+			want = sectors[sector]
+			base = sector*sector_size
+			have = self.read_bytes(base, sector_size)
+			count = count + 1
+			self.update_progress(float(count)/float(len(sectors)))
+			if have == want:
+				unchanged = unchanged + 1
+				continue
+			changed = []
+			erase = False
+			for page in xrange(0, sector_size, page_size):
+				w = want[page:page+page_size]
+				h = have[page:page+page_size]
+				if w == h:
+					continue
+				changed.append(page)
+				if not erase:
+					for i in xrange(len(w)):
+						if (h[i] & w[i]) != w[i]:
+							erase = True
+							break
+			if erase:
+				erase_list.append(base)
+				for page in xrange(0, sector_size, page_size):
+					if want[page:page+page_size] != blank:
+						program_list.append((base + page, want[page:page+page_size]))
+			else:
+				for page in changed:
+					program_list.append((base + page, want[page:page+page_size]))
+		self.say("%d sectors unchanged, erasing %d, programming %d pages." % (unchanged, len(erase_list), len(program_list)))
+		if len(erase_list):
+			self.update_progress(0)
+			count = 0
+			for address in erase_list:
+				self.erase(address, opcode)
+				count = count + 1
+				self.update_progress(float(count)/float(len(erase_list)))
+		if len(program_list):
+			self.update_progress(0)
+			count = 0
+			for address, data in program_list:
+				self.page_program(address, data)
+				count = count + 1
+				self.update_progress(float(count)/float(len(program_list)))
 		self.write_disable()
-		print "Complete!"
+		self.say("Complete!")
 
-	def page_program(self, address, data_write = []):
-		self.write_enable()
-		data_write.insert(0,(address & 0xFF))
-		data_write.insert(0,((address>>8) & 0xFF))
-		data_write.insert(0,((address>>16) & 0xFF))
+	# If a transfer fails partway, the flash programs however much of
+	# the page it got (each transfer's loads go out one round at a
+	# time, so that's always the start of it). The page is read back
+	# and programmed again from the first byte that isn't right yet;
+	# the bytes that are get the same data again, which doesn't hurt.
+	# Should the read back show bits cleared that shouldn't be (some
+	# bytes out of place), no amount of retrying will undo that, and
+	# you get an error (program_mcs(..., incremental=True) will erase
+	# and redo it).
+	def page_program(self, address, data):
+		data = bytearray(data)
 		if self.memory_capacity > 2**24:
-			data_write.insert(0,((address>>24) & 0xFF))
-			self.command(self.cmd["4PP"],0,0,data_write)
+			opcode = self.cmd["4PP"]
 		else:
-			self.command(self.cmd["3PP"],0,0,data_write)
-		res = self.status()
-		trials = 0
-		while trials < 10:
-			res = self.status()
-			if res & 0x1:
-				break
-			trials = trials + 1
-		trials = 0
-		while res & 0x1:
-			res = self.status()
-			trials = trials + 1
-
-	def erase(self, address): 
-		self.write_enable()
+			opcode = self.cmd["3PP"]
+		t, limit = self.page_program_time()
+		self.programmed = self.programmed + len(data)
+		def resume():
+			have = self.read_bytes(address, len(data))
+			first = None
+			for i in xrange(len(data)):
+				if (have[i] & data[i]) != data[i]:
+					raise retry.TransactionError("Page at 0x%x damaged by a failed transfer!" % address)
+				if first == None and have[i] != data[i]:
+					first = i
+			if first == None:
+				return None
+			return self.address_bytes(address + first) + list(data[first:])
+		if self.write_command(opcode, self.address_bytes(address) + list(data), t,
+							  max(limit, self.min_program_timeout), 'page program', resume):
+			if resume() != None:
+				raise retry.TransactionError("Page at 0x%x damaged by a failed transfer!" % address)
+
+	# Sector erase by default; pass 'opcode' for another erase type
+	# (see erase_types).
+	def erase(self, address, opcode=None): 
 		if self.memory_capacity > 2**24:
 			data = []
 			data.append((address >> 24) & 0xFF)
 			data.append((address >> 16) & 0xFF)
 			data.append((address >> 8) & 0xFF)
 			data.append((address & 0xFF))
-			erase = self.command(self.cmd["4SE"], 0, 0, data)
+			if opcode == None:
+				opcode = self.cmd["4SE"]
 		else:
 			data = []
 			data.append((address>>16) & 0xFF)
 			data.append((address>>8) & 0xFF)
 			data.append((address & 0xFF))
-			erase = self.command(self.cmd["3SE"], 0, 0, data)
-		res = self.status()
-		trials = 0
-		while trials < 10:
-			res = self.status()
-			if res & 0x1:
-				break
-		if trials == 10:
-			print "Erase did not start (res=%x)!" % res
-			return
-		trials = 0
-		while res & 0x1:
-			res = self.status()
-			trials = trials + 1
+			if opcode == None:
+				opcode = self.cmd["3SE"]
+		t, limit = self.erase_time(opcode)
+		self.write_command(opcode, data, t, max(limit, self.min_erase_timeout), 'erase')
+
+	def bulk_erase(self):
+		t, limit = self.erase_time(self.cmd["BE"])
+		self.write_command(self.cmd["BE"], [], t, max(limit, self.min_erase_timeout), 'bulk erase')
 
 	def write_bank_address(self, bank):
 		if self.memory_capacity > 2**24:
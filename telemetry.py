@@ -0,0 +1,225 @@
+import time
+from array import array
+
+import codec
+
+# NumPy is optional: without it the ring buffers are plain arrays and
+# conversions are done a sample at a time.
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+#
+# Background XADC health monitoring.
+#
+#	ctl = BoardController()
+#	boards = [ ctl.board(dna) for dna in ctl.discover() ]
+#	tm = telemetry.Telemetry(boards, rate=10)
+#	... anything that talks to the boards keeps sampling going ...
+#	tm.run(60)			# or just let it sample for a minute
+#	print tm.stats()	# dna -> { channel : (min, max, mean) }
+#
+# Sampling rides along on process(): whenever a board's next sample
+# is due, reads of every channel are queued up asynchronously and
+# stored raw in that board's ring buffer as they come back, so it
+# never blocks anything else. Conversion to degrees/volts only
+# happens when you ask for values, a whole buffer at once.
+#
+# The XADC status registers don't sit behind a FIFO, and a multi-word
+# RD always re-reads the same address, so a sample is one read per
+# channel, all in flight together (one round trip per sample).
+#
+
+# name, offset from the XADC base, scale, offset: value = (raw >> 4)*scale + offset
+TEMPERATURE = ('temperature', 0x200, 503.975/4096, -273.15)
+VCCINT = ('vccint', 0x204, 3.0/4096, 0.0)
+VCCAUX = ('vccaux', 0x208, 3.0/4096, 0.0)
+VCCBRAM = ('vccbram', 0x218, 3.0/4096, 0.0)
+CHANNELS = [ TEMPERATURE, VCCINT, VCCAUX, VCCBRAM ]
+
+# Fixed-size ring of raw samples: one row of 'width' words per sample,
+# plus when it was taken.
+class Ring(object):
+	def __init__(self, depth, width):
+		self.depth = depth
+		self.width = width
+		# samples ever stored
+		self.count = 0
+		if numpy != None:
+			self.raw = numpy.zeros((depth, width), dtype=numpy.uint32)
+			self.times = numpy.zeros(depth)
+		else:
+			self.raw = array(codec.WORD, [0]*(depth*width))
+			self.times = array('d', [0.0]*depth)
+
+	def __len__(self):
+		return min(self.count, self.depth)
+
+	def append(self, t, row):
+		i = self.count % self.depth
+		self.times[i] = t
+		if numpy != None:
+			self.raw[i] = row
+		else:
+			self.raw[i*self.width:(i+1)*self.width] = array(codec.WORD, row)
+		self.count = self.count + 1
+
+	# The last 'n' samples (all of them if None), oldest first:
+	# (times, raw). With NumPy these are arrays, raw is n x width;
+	# otherwise lists, raw is a list of rows.
+	def latest(self, n=None):
+		n = len(self) if n == None else min(n, len(self))
+		if numpy != None:
+			index = numpy.arange(self.count - n, self.count) % self.depth
+			return (self.times[index], self.raw[index])
+		times = []
+		raw = []
+		for k in xrange(self.count - n, self.count):
+			i = k % self.depth
+			times.append(self.times[i])
+			raw.append(list(self.raw[i*self.width:(i+1)*self.width]))
+		return (times, raw)
+
+class Telemetry(object):
+	# samples kept per board
+	depth = 3600
+
+	# 'boards' are UDPFPGA handles (all on one controller, or just
+	# one without). 'rate' is samples per second per board.
+	def __init__(self, boards, rate=1.0, depth=None, channels=CHANNELS, base=0x1000):
+		if depth != None:
+			self.depth = depth
+		self.channels = channels
+		self.names = [ ch[0] for ch in channels ]
+		self.addrs = [ base + ch[1] for ch in channels ]
+		self.scales = [ ch[2] for ch in channels ]
+		self.offsets = [ ch[3] for ch in channels ]
+		self.boards = {}
+		self.rings = {}
+		self.periods = {}
+		self.due = {}
+		self.busy = {}
+		self.dropped = {}
+		self.targets = []
+		for handle in boards:
+			self.add(handle, rate)
+
+	def add(self, handle, rate=1.0):
+		dna = handle.target_dna
+		self.boards[dna] = handle
+		self.rings[dna] = Ring(self.depth, len(self.channels))
+		self.periods[dna] = 1.0/rate
+		self.due[dna] = 0
+		self.busy[dna] = False
+		self.dropped[dna] = 0
+		self.attach(handle.controller if handle.controller != None else handle)
+
+	def attach(self, target):
+		if target not in self.targets:
+			target.periodic.append(self.tick)
+			self.targets.append(target)
+
+	# Stop sampling.
+	def detach(self):
+		for target in self.targets:
+			target.periodic.remove(self.tick)
+		self.targets = []
+
+	# Samples per second, for one board or all of them.
+	def set_rate(self, rate, dna=None):
+		for d in ([ dna ] if dna != None else self.boards.keys()):
+			self.periods[d] = 1.0/rate
+
+	# Called from process(): start whichever samples are due. Returns
+	# when the next one will be.
+	def tick(self, now=None):
+		if now == None:
+			now = time.time()
+		next_due = None
+		for dna in self.boards:
+			if not self.busy[dna] and now >= self.due[dna]:
+				self.due[dna] = max(self.due[dna] + self.periods[dna], now)
+				self.sample(dna, now)
+			if next_due == None or self.due[dna] < next_due:
+				next_due = self.due[dna]
+		return next_due
+
+	def sample(self, dna, now):
+		handle = self.boards[dna]
+		row = [ 0 ]*len(self.addrs)
+		state = { 'left' : len(self.addrs), 'failed' : False }
+		def store(i):
+			def callback(txn):
+				if txn.error != None:
+					state['failed'] = True
+				else:
+					row[i] = txn.value[0]
+				state['left'] = state['left'] - 1
+				if state['left'] == 0:
+					self.busy[dna] = False
+					if state['failed']:
+						self.dropped[dna] = self.dropped[dna] + 1
+					else:
+						self.rings[dna].append(now, row)
+			return callback
+		self.busy[dna] = True
+		for i in xrange(len(self.addrs)):
+			handle.read_async(self.addrs[i], callback=store(i))
+
+	# Keep sampling for 'duration' seconds with nothing else going on.
+	def run(self, duration):
+		end = time.time() + duration
+		while True:
+			now = time.time()
+			if now >= end:
+				break
+			next_due = self.tick(now)
+			wait = end - now
+			if next_due != None:
+				wait = min(wait, max(next_due - now, 0))
+			for target in self.targets:
+				target.process(wait)
+				wait = 0
+
+	def convert(self, raw, i):
+		return (raw >> 4)*self.scales[i] + self.offsets[i]
+
+	# Converted samples for one board: (times, { channel : values })
+	# for the last 'n' samples (all if None), oldest first.
+	def values(self, dna, n=None):
+		times, raw = self.rings[dna].latest(n)
+		result = {}
+		for i in xrange(len(self.names)):
+			if numpy != None:
+				result[self.names[i]] = self.convert(raw[:,i], i)
+			else:
+				result[self.names[i]] = [ self.convert(row[i], i) for row in raw ]
+		return (times, result)
+
+	# min/max/mean of each channel over the last 'n' samples (all if
+	# None), for one board or every board: these never go near the
+	# network. Channels with no samples yet give None.
+	def stats(self, dna=None, n=None):
+		if dna == None:
+			result = {}
+			for d in self.boards:
+				result[d] = self.stats(d, n)
+			return result
+		times, raw = self.rings[dna].latest(n)
+		result = {}
+		for i in xrange(len(self.names)):
+			if not len(raw):
+				result[self.names[i]] = None
+				continue
+			if numpy != None:
+				col = raw[:,i] >> 4
+				lo, hi, mean = col.min(), col.max(), col.mean()
+			else:
+				col = [ row[i] >> 4 for row in raw ]
+				lo, hi, mean = min(col), max(col), float(sum(col))/len(col)
+			# the conversions are linear, so convert after
+			result[self.names[i]] = (float(lo)*self.scales[i] + self.offsets[i],
+									 float(hi)*self.scales[i] + self.offsets[i],
+									 float(mean)*self.scales[i] + self.offsets[i])
+		return result
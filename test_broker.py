@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+#
+# broker.py on a temporary socket, against the simulator (sim.py):
+# python test_broker.py
+#
+import collections
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from socket import *
+
+import broker
+import sim
+
+def setUpModule():
+	global board, simulator, directory, path, server, thread
+	board = sim.SimBoard()
+	simulator = sim.Simulator([ board ]).start()
+	directory = tempfile.mkdtemp()
+	path = os.path.join(directory, 'broker')
+	server = broker.Broker(path)
+	thread = threading.Thread(target=server.serve_forever)
+	thread.daemon = True
+	thread.start()
+
+def tearDownModule():
+	server.running = False
+	# wake it up
+	RawClient().close()
+	thread.join()
+	server.close()
+	server.controller.server.close()
+	server.controller.client.close()
+	simulator.stop()
+	shutil.rmtree(directory)
+
+# The client's end of the protocol, by hand.
+class RawClient(object):
+	def __init__(self):
+		self.sock = socket(AF_UNIX, SOCK_STREAM)
+		self.sock.connect(path)
+		self.sock.settimeout(2)
+		self.rx = ''
+		self.inbox = collections.deque()
+
+	def close(self):
+		self.sock.close()
+
+	def send(self, msg):
+		broker.send_message(self.sock, msg)
+
+	# The next message back, or None if the broker hung up.
+	def receive(self):
+		while not len(self.inbox):
+			data = self.sock.recv(65536)
+			if not len(data):
+				return None
+			msgs, self.rx = broker.split_messages(self.rx + data)
+			self.inbox.extend(msgs)
+		return self.inbox.popleft()
+
+	def open(self):
+		self.send({ 'op' : 'hello', 'name' : 'raw', 'priority' : 0 })
+		self.send({ 'op' : 'open', 'dna' : None, 'id' : 1 })
+		return self.receive()
+
+def frame(data):
+	return broker.FRAME.pack(len(data)) + data
+
+class FramingTest(unittest.TestCase):
+	def test_split(self):
+		first = frame('{"a":1}')
+		data = first + frame('[2]')
+		self.assertEqual(broker.split_messages(data), ([ { 'a' : 1 }, [ 2 ] ], ''))
+		# anything short of a whole message stays in the buffer
+		for n in xrange(len(data)):
+			if n < len(first):
+				self.assertEqual(broker.split_messages(data[:n]), ([], data[:n]))
+			else:
+				self.assertEqual(broker.split_messages(data[:n]), ([ { 'a' : 1 } ], data[len(first):n]))
+		self.assertRaises(ValueError, broker.split_messages, broker.FRAME.pack(broker.MAX_MESSAGE + 1))
+		self.assertRaises(ValueError, broker.split_messages, frame('{'))
+
+	# A message that comes in a byte at a time.
+	def test_partial(self):
+		raw = RawClient()
+		try:
+			self.assertEqual(raw.open()['value'], board.dna)
+			data = frame('{"op":"write","addr":16,"data":[7],"ack":true,"id":2}')
+			data = data + frame('{"op":"read","addr":16,"count":1,"id":3}')
+			for c in data:
+				raw.sock.send(c)
+				time.sleep(0.001)
+			self.assertEqual(raw.receive(), { 'id' : 2, 'value' : 1 })
+			self.assertEqual(raw.receive(), { 'id' : 3, 'value' : [ 7 ] })
+		finally:
+			raw.close()
+
+	def test_oversized(self):
+		raw = RawClient()
+		try:
+			raw.open()
+			raw.sock.sendall(broker.FRAME.pack(broker.MAX_MESSAGE + 1) + 'x'*1000)
+			self.assertEqual(raw.receive(), None)
+		finally:
+			raw.close()
+		self.assertEqual(RawClient().open()['value'], board.dna)
+
+	def test_garbage(self):
+		raw = RawClient()
+		try:
+			raw.sock.sendall(frame('{"op":'))
+			self.assertEqual(raw.receive(), None)
+		finally:
+			raw.close()
+
+class RoutingTest(unittest.TestCase):
+	def setUp(self):
+		self.dev = broker.BrokerTOF(path=path, name='test')
+
+	def tearDown(self):
+		self.dev.close()
+
+	def test_requests(self):
+		dev = self.dev
+		self.assertEqual(dev.write(0x0020, [ 1, 2 ]), 2)
+		self.assertEqual(dev.read(0x0020), 2)
+		self.assertEqual(list(dev.readMultiple(0x0020, 3)), [ 2, 2, 2 ])
+		b = dev.batch()
+		b.write(0x0024, 3)
+		b.poll(0x0024, 0x3, 0x3)
+		rd = b.readMultiple(0x0024, 2)
+		self.assertEqual(list(b.execute()[rd]), [ 3, 3 ])
+		self.assertEqual(dev.write_block(0x0028, range(4), True), 4)
+		self.assertEqual(list(dev.read_block(0x0028, 4, True)), range(4))
+		self.assertEqual(board.gpio.read(0x020), 2)
+
+	def test_errors(self):
+		b = self.dev.batch()
+		b.poll(0x0034, 0x1)
+		self.assertRaises(broker.poll.PollTimeout, b.execute, 0.05)
+		self.assertRaises(ValueError, self.dev.request({ 'op' : 'bogus' }).result)
+
+	# Every client sees what the others did.
+	def test_clients(self):
+		other = broker.BrokerTOF(path=path, name='other', priority=1)
+		try:
+			self.dev.write(0x0038, 5)
+			self.assertEqual(other.read(0x0038), 5)
+			other.write(0x0038, 6)
+			self.assertEqual(self.dev.read(0x0038), 6)
+		finally:
+			other.close()
+
+	# A client that goes away with a batch running: the batch still
+	# finishes, nothing's sent to it, and everyone else carries on.
+	def test_disconnect(self):
+		threading.Timer(0.05, board.gpio.write, (0x040, 1)).start()
+		raw = RawClient()
+		raw.open()
+		raw.send({ 'op' : 'batch', 'id' : 2, 'timeout' : 1,
+				   'steps' : [ [ 'poll', 0x0040, 0x1, None ], [ 'write', 0x0044, [ 9 ], False ] ] })
+		raw.send({ 'op' : 'read', 'addr' : 0x0044, 'count' : 1, 'id' : 3 })
+		raw.close()
+		self.assertEqual(self.dev.read(0x0048), 0)
+		time.sleep(0.2)
+		self.assertEqual(self.dev.read(0x0044), 9)
+		self.assertEqual([ client.name for client in server.clients ], [ 'test' ])
+
+if __name__ == '__main__':
+	unittest.main()
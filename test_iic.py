@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+#
+# iic.AXIIIC against the simulator (sim.py): python test_iic.py
+#
+import time
+import unittest
+
+import retry
+import sim
+import udp
+
+# A board that drops the next request matching each of 'drops'
+# (a function of the request datagram) before it's seen.
+class LossyBoard(sim.SimBoard):
+	def __init__(self, **kwargs):
+		sim.SimBoard.__init__(self, **kwargs)
+		self.drops = []
+
+	def handle(self, data):
+		for drop in self.drops:
+			if drop(data):
+				self.drops.remove(drop)
+				return None
+		return sim.SimBoard.handle(self, data)
+
+# A read of the IIC RX FIFO
+def rx_fifo_read(data):
+	return data[0:2] == 'RD' and data[3:5] == '\x21\x0C'
+
+# A write to the IIC TX FIFO
+def tx_fifo_write(data):
+	return data[0:2] == 'WR' and data[3:5] == '\x21\x08'
+
+class AXIIICTest(unittest.TestCase):
+	@classmethod
+	def setUpClass(cls):
+		cls.device = sim.SimI2CDevice(range(256))
+		cls.board = LossyBoard(i2c_devices={ 0x20 : cls.device })
+		cls.sim = sim.Simulator([ cls.board ]).start()
+		cls.dev = udp.TOFProto()
+
+	@classmethod
+	def tearDownClass(cls):
+		cls.sim.stop()
+
+	def setUp(self):
+		self.board.drops = []
+
+	def test_write_read(self):
+		self.assertTrue(self.dev.writeI2C(0x20, [ 0x80 ] + range(100, 140)))
+		self.assertEqual(list(self.device.regs[0x80:0xA8]), range(100, 140))
+		self.assertEqual(self.dev.readI2CRegister(0x20, 0x80, 40), range(100, 140))
+
+	# The NAK leaves the data in the TX FIFO, which mustn't hold the
+	# write up until it times out, or get in the way of the next one.
+	def test_nak(self):
+		start = time.time()
+		self.assertFalse(self.dev.writeI2C(0x33, [ 1, 2, 3 ]))
+		self.assertLess(time.time() - start, self.dev.timeout/2)
+		self.assertFalse(self.dev.readI2CRegister(0x33, 0, 4))
+		self.assertTrue(self.dev.writeI2C(0x20, [ 0x10, 0xAA ]))
+		self.assertEqual(self.dev.readI2CRegister(0x20, 0x10, 1), [ 0xAA ])
+
+	# What the lost read left in the RX FIFO mustn't turn up in the
+	# next transfer.
+	def test_drop_mid_read(self):
+		self.board.drops = [ rx_fifo_read ]
+		self.assertRaises(retry.TransactionError, self.dev.readI2C, 0x20, 20)
+		self.assertEqual(self.board.drops, [])
+		self.assertEqual(self.dev.readI2CRegister(0x20, 0x40, 20), range(0x40, 0x54))
+		self.assertEqual(self.dev.readI2CRegister(0x20, 0x40, 20), range(0x40, 0x54))
+
+	# Register reads and writes are just done over.
+	def test_drop_retried(self):
+		self.board.drops = [ rx_fifo_read ]
+		self.assertEqual(self.dev.readI2CRegister(0x20, 0x40, 20), range(0x40, 0x54))
+		self.assertEqual(self.board.drops, [])
+		self.board.drops = [ tx_fifo_write ]
+		self.assertTrue(self.dev.writeI2C(0x20, [ 0x60, 1, 2, 3 ]))
+		self.assertEqual(self.board.drops, [])
+		self.assertEqual(self.dev.readI2CRegister(0x20, 0x60, 3), [ 1, 2, 3 ])
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+#
+# spi.SPI flash programming against the simulator (sim.py):
+# python test_spi.py
+#
+import random
+import unittest
+
+import image
+import sim
+import spi
+import udp
+
+# A flash that remembers what it was asked to erase and program:
+# (opcode, address) of each.
+class LogFlash(sim.SimFlash):
+	def __init__(self, **kwargs):
+		sim.SimFlash.__init__(self, **kwargs)
+		self.erases = []
+		self.programs = []
+
+	def finish(self):
+		if self.wel and not self.busy() and self.cmd != None:
+			if self.cmd in self.erase_ops:
+				self.erases.append((self.cmd, self.address(self.address_bytes())))
+			elif self.cmd in (0x02, 0x12):
+				self.programs.append((self.cmd, self.address(self.address_bytes())))
+		sim.SimFlash.finish(self)
+
+def setUpModule():
+	global flash, simulator, dev
+	flash = LogFlash(time_scale=0)
+	simulator = sim.Simulator([ sim.SimBoard(flash=flash) ]).start()
+	dev = udp.TOFProto()
+	dev.spi.say = lambda text: None
+	dev.spi.update_progress = lambda progress: None
+
+def tearDownModule():
+	simulator.stop()
+	dev.server.close()
+	dev.client.close()
+
+class FlashTest(unittest.TestCase):
+	def setUp(self):
+		flash.erases = []
+		flash.programs = []
+
+# Differential programming, with 4 kB sectors to keep it quick.
+class IncrementalTest(FlashTest):
+	base = 0x40000
+	sector = 4096
+
+	def setUp(self):
+		FlashTest.setUp(self)
+		flash.image[self.base:self.base+4*self.sector] = '\xff'*4*self.sector
+		r = random.Random(8)
+		self.data = bytearray(r.getrandbits(8) for i in xrange(3*self.sector + 100))
+		self.program()
+		flash.erases = []
+		flash.programs = []
+
+	def program(self):
+		img = image.Image(self.data, [ (self.base, 0, len(self.data)) ])
+		dev.spi.program_image(img, self.sector, incremental=True)
+		self.assertEqual(flash.image[self.base:self.base+len(self.data)], self.data)
+
+	def test_unchanged(self):
+		self.program()
+		self.assertEqual(flash.erases, [])
+		self.assertEqual(flash.programs, [])
+
+	# Setting a bit takes an erase: just that sector's, and then the
+	# pages in it get programmed again.
+	def test_erase_one(self):
+		offset = self.sector + 1000
+		self.data[offset] = 0xFF if self.data[offset] != 0xFF else 0x00
+		self.program()
+		sector = self.base + self.sector
+		self.assertEqual(flash.erases, [ (0x20, sector) ])
+		self.assertEqual(flash.programs, [ (0x02, address) for address in xrange(sector, sector + self.sector, 256) ])
+
+	# Clearing bits doesn't: just the page gets programmed.
+	def test_program_one(self):
+		offset = 2*self.sector + 600
+		while not (self.data[offset] & 0x1):
+			offset = offset + 1
+		self.data[offset] = self.data[offset] & 0xFE
+		self.program()
+		self.assertEqual(flash.erases, [])
+		self.assertEqual(flash.programs, [ (0x02, (self.base + offset) & ~0xFF) ])
+
+	def test_sector_images(self):
+		img = image.Image(bytearray('\x01\x02\x03'), [ (0x1FFE, 0, 3) ])
+		sectors = spi.SPI.sector_images(img, 0x1000)
+		self.assertEqual(sorted(sectors), [ 1, 2 ])
+		self.assertEqual(sectors[1], bytearray('\xff'*0xFFE + '\x01\x02'))
+		self.assertEqual(sectors[2], bytearray('\x03' + '\xff'*0xFFF))
+
+# An SPI with made-up erase types, for plan_erase on its own.
+class PlanSPI(spi.SPI):
+	def __init__(self, types, chip=None, capacity=16*1024*1024):
+		self.types = types
+		self.chip = chip
+		self.memory_capacity = capacity
+
+	def erase_types(self):
+		return list(self.types)
+
+	def chip_erase_time(self):
+		return self.chip
+
+# Just the segments of an image: (address, size) of each.
+class Spans(object):
+	def __init__(self, *spans):
+		self.segments = [ image.Segment(None, address, 0, size) for address, size in spans ]
+
+SE4 = (4*1024, 0x20, 0.048)
+SE32 = (32*1024, 0x52, 0.35)
+SE64 = (64*1024, 0xD8, 0.64)
+
+class PlanTest(unittest.TestCase):
+	def plan(self, spans, types=[ SE4, SE32, SE64 ], chip=None, allow_bulk=False, largest=None):
+		return PlanSPI(types, chip).plan_erase(Spans(*spans), allow_bulk, largest)
+
+	def test_subsector(self):
+		self.assertEqual(self.plan([ (0x10100, 100) ]), ([ (0x10000,) + SE4 ], 0.048))
+
+	def test_whole_block(self):
+		self.assertEqual(self.plan([ (0x20000, 0x10000) ]), ([ (0x20000,) + SE64 ], 0.64))
+
+	# A full half block is quicker as a 32 kB erase, the three
+	# subsectors after it as 4 kB ones.
+	def test_mixed(self):
+		plan, predicted = self.plan([ (0x30000, 0xB000) ])
+		self.assertEqual(plan, [ (0x30000,) + SE32, (0x38000,) + SE4, (0x39000,) + SE4, (0x3A000,) + SE4 ])
+		self.assertAlmostEqual(predicted, 0.35 + 3*0.048)
+
+	def test_untouched(self):
+		plan, predicted = self.plan([ (0x5FF00, 0x200), (0x200000, 0x10) ])
+		self.assertEqual(plan, [ (0x5F000,) + SE4, (0x60000,) + SE4, (0x200000,) + SE4 ])
+		self.assertEqual(self.plan([ (0x1000, 0) ]), ([], 0))
+
+	def test_largest(self):
+		plan, predicted = self.plan([ (0x20000, 0x10000) ], largest=32*1024)
+		self.assertEqual(plan, [ (0x20000,) + SE32, (0x28000,) + SE32 ])
+		self.assertRaises(ValueError, self.plan, [ (0x20000, 0x10000) ], largest=1024)
+
+	# Twenty 64 kB erases take longer than a chip erase, ten don't.
+	def test_bulk(self):
+		spans = [ (0x100000, 20*0x10000) ]
+		bulk = ([ (0, 16*1024*1024, 0xC7, 10.0) ], 10.0)
+		self.assertEqual(self.plan(spans, [ SE64 ], 10.0, True), bulk)
+		plan, predicted = self.plan(spans, [ SE64 ], 10.0)
+		self.assertEqual(len(plan), 20)
+		self.assertEqual(len(self.plan(spans, [ SE64 ], None, True)[0]), 20)
+		plan, predicted = self.plan([ (0x100000, 10*0x10000) ], [ SE64 ], 10.0, True)
+		self.assertEqual([ op[0] for op in plan ], range(0x100000, 0x1A0000, 0x10000))
+
+# The simulated flash has 4 kB and 64 kB erases.
+class EraseTest(FlashTest):
+	def test_plan_erased(self):
+		flash.image[0x80000:0xA0000] = '\x00'*0x20000
+		img = image.Image(bytearray('\xff'*0x11800), [ (0x80000, 0, 0x10000), (0x91000, 0x10000, 0x1800) ])
+		plan, predicted = dev.spi.plan_erase(img)
+		self.assertEqual([ (address, size) for address, size, opcode, t in plan ],
+						 [ (0x80000, 0x10000), (0x91000, 0x1000), (0x92000, 0x1000) ])
+		dev.spi.execute_erase_plan(plan, predicted)
+		self.assertEqual(flash.erases, [ (opcode, address) for address, size, opcode, t in plan ])
+		erased = bytearray(flash.image[0x80000:0xA0000])
+		for address, size, opcode, t in plan:
+			self.assertEqual(flash.image[address:address+size], '\xff'*size)
+			erased[address-0x80000:address-0x80000+size] = '\x00'*size
+		self.assertEqual(erased, '\x00'*0x20000)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,378 @@
+#!/usr/bin/env python
+#
+# udp.UDPFPGA's transaction engine against the simulator (sim.py):
+# python test_udp.py
+#
+import struct
+import threading
+import time
+import unittest
+
+import poll
+import sim
+import udp
+
+# A board that drops requests before they're seen: the next one
+# matching each of 'drops', and every one matching any of 'lost' (a
+# function of the request datagram). The (opcode, address) of every
+# RD/WR that gets through goes in 'log'.
+class LossyBoard(sim.SimBoard):
+	def __init__(self, **kwargs):
+		sim.SimBoard.__init__(self, **kwargs)
+		self.drops = []
+		self.lost = []
+		self.log = []
+
+	def handle(self, data):
+		for drop in self.drops:
+			if drop(data):
+				self.drops.remove(drop)
+				return None
+		for lost in self.lost:
+			if lost(data):
+				return None
+		if data[0:2] in ('RD', 'WR'):
+			self.log.append((data[0:2], struct.unpack('!H', data[3:5])[0]))
+		return sim.SimBoard.handle(self, data)
+
+# A simulator that does things to replies: the next one matching each
+# of 'faults' (match, copies, delay) goes out 'copies' times (0 loses
+# it after the board's acted on the request), 'delay' seconds late.
+class FaultySimulator(sim.Simulator):
+	def __init__(self, boards, **kwargs):
+		sim.Simulator.__init__(self, boards, **kwargs)
+		self.faults = []
+
+	def schedule(self, sock, reply, addr):
+		for fault in self.faults:
+			match, copies, delay = fault
+			if match(reply):
+				self.faults.remove(fault)
+				latency = self.latency
+				self.latency = latency + delay
+				for i in xrange(copies):
+					sim.Simulator.schedule(self, sock, reply, addr)
+				self.latency = latency
+				return
+		sim.Simulator.schedule(self, sock, reply, addr)
+
+# A request (or reply) for 'opcode' to 'addr', for 'count' words if
+# given
+def request(opcode, addr, count=None):
+	def match(data):
+		if data[0:2] != opcode or data[3:5] != chr(addr >> 8) + chr(addr & 0xFF):
+			return False
+		return count == None or words(data) == count
+	return match
+
+reply = request
+
+# How many words a request or reply is for: RD requests and WR
+# replies give the count, the others carry the words.
+def words(data):
+	return ord(data[5]) if len(data) == 6 else (len(data) - 5)/4
+
+# One simulated board and one handle on it for all the tests, since
+# the handle has the host port to itself.
+def setUpModule():
+	global board, simulator, dev
+	board = LossyBoard()
+	simulator = FaultySimulator([ board ]).start()
+	dev = udp.TOFProto()
+
+def tearDownModule():
+	simulator.stop()
+	dev.server.close()
+	dev.client.close()
+
+class EngineTest(unittest.TestCase):
+	def setUp(self):
+		board.drops = []
+		board.lost = []
+		board.log = []
+		simulator.faults = []
+		dev.cache.invalidate()
+
+# The LED register (0x0000) is cached.
+class CacheTest(EngineTest):
+	def test_read_before_write(self):
+		dev.write(0x0000, 5)
+		b = dev.batch()
+		rd = b.read(0x0000)
+		b.write(0x0000, 9)
+		self.assertEqual(b.execute()[rd], 5)
+		self.assertEqual(dev.read(0x0000), 9)
+
+	def test_not_executed(self):
+		dev.write(0x0000, 9)
+		b = dev.batch()
+		b.write(0x0000, 0x77)
+		self.assertEqual(dev.read(0x0000), 9)
+
+	# The batch stops at a poll that never gets answered, so the
+	# write after it doesn't go out.
+	def test_stopped_before_write(self):
+		dev.write(0x0000, 9)
+		board.lost = [ request('RD', 0x0004) ]
+		b = dev.batch()
+		b.poll(0x0004, 0x1)
+		b.write(0x0000, 0x77)
+		self.assertRaises(udp.NoResponse, b.execute)
+		board.lost = []
+		self.assertEqual(dev.read(0x0000), 9)
+		self.assertEqual(board.gpio.read(0x000), 9)
+
+	def test_write_lost(self):
+		dev.write(0x0000, 9)
+		board.lost = [ request('WR', 0x0000) ]
+		b = dev.batch()
+		b.write(0x0000, 0x77)
+		self.assertRaises(udp.NoResponse, b.execute)
+		board.lost = []
+		self.assertEqual(dev.read(0x0000), 9)
+
+class PostedTest(EngineTest):
+	def setUp(self):
+		EngineTest.setUp(self)
+		dev.post_writes = True
+
+	def tearDown(self):
+		dev.post_writes = False
+
+	def test_read_block(self):
+		dev.write(0x0010, 1)
+		self.assertEqual(list(dev.read_block(0x0010, 1)), [ 1 ])
+		self.assertEqual(len(dev.posted), 0)
+
+	def test_read_block_after_lost(self):
+		board.lost = [ request('WR', 0x0010) ]
+		dev.write(0x0010, 2)
+		self.assertEqual(len(dev.posted), 1)
+		self.assertRaises(udp.WriteLost, dev.read_block, 0x0000, 4, True)
+		self.assertEqual(len(dev.posted), 0)
+		board.lost = []
+		dev.fence()
+
+class CombineTest(EngineTest):
+	def setUp(self):
+		EngineTest.setUp(self)
+		dev.combine = True
+
+	def tearDown(self):
+		dev.combine = False
+
+	# Nothing else is outstanding, so there's nothing to wait for.
+	def test_lone_write(self):
+		txn = dev.write_async(0x0014, 5)
+		time.sleep(0.05)
+		self.assertEqual(board.gpio.read(0x014), 5)
+		self.assertEqual(txn.result(), 1)
+
+	# The writes behind the first are held until it's answered, then
+	# go together, without anything but the engine being driven.
+	def test_held_writes(self):
+		m = dev.enable_metrics()
+		try:
+			txns = [ dev.write_async(0x0018, i) for i in xrange(1, 5) ]
+			dev.idle(0.05)
+			self.assertEqual(board.gpio.read(0x018), 4)
+			self.assertEqual([ txn.done for txn in txns ], [ True ]*4)
+			self.assertEqual(m.sent_datagrams, 2)
+			self.assertEqual(m.combined_writes, 3)
+		finally:
+			dev.disable_metrics()
+
+# Lost, late and repeated requests and replies. The GPIO registers
+# past the LED are plain volatile ones; 0x2108/0x210C are the IIC TX
+# and RX FIFOs, which mustn't be accessed twice.
+class RetransmitTest(EngineTest):
+	def setUp(self):
+		EngineTest.setUp(self)
+		board.iic.reset()
+		self.metrics = dev.enable_metrics()
+
+	def tearDown(self):
+		dev.disable_metrics()
+		board.lost = []
+		dev.idle(0.01)
+
+	def test_read_lost(self):
+		dev.write(0x0020, 3)
+		board.drops = [ request('RD', 0x0020) ]
+		self.assertEqual(dev.read(0x0020), 3)
+		self.assertEqual(board.drops, [])
+		self.assertEqual(self.metrics.retransmits, { 'RD' : 1 })
+
+	def test_write_lost(self):
+		board.drops = [ request('WR', 0x0020) ]
+		self.assertEqual(dev.write(0x0020, 4), 1)
+		self.assertEqual(board.drops, [])
+		self.assertEqual(board.gpio.read(0x020), 4)
+		self.assertEqual(self.metrics.retransmits, { 'WR' : 1 })
+
+	# The first copy's reply turns up after the retransmission's, while
+	# the next read of the register is waiting (it gets answered late,
+	# and its retransmissions are lost). It mustn't be taken for that
+	# read's: the retransmission and the next read go out as 2-word
+	# reads so they can be told apart.
+	def test_late_read_reply(self):
+		dev.write(0x0024, 1)
+		simulator.faults = [ (reply('RD', 0x0024, 1), 1, 0.1) ]
+		self.assertEqual(dev.read(0x0024), 1)
+		self.assertTrue(('RD', 0x0024) in dev.late)
+		dev.write(0x0024, 2)
+		simulator.faults = [ (reply('RD', 0x0024, 2), 1, 0.2) ]
+		board.lost = [ lambda data: request('RD', 0x0024)(data) and words(data) != 2 ]
+		self.assertEqual(dev.read(0x0024), 2)
+		self.assertEqual(self.metrics.duplicates, 1)
+		self.assertEqual(self.metrics.short, 0)
+
+	# A write's retransmission repeats the word, which is the same as
+	# writing it once.
+	def test_late_write_reply(self):
+		simulator.faults = [ (reply('WR', 0x0028, 1), 1, 0.1) ]
+		self.assertEqual(dev.write(0x0028, 7), 1)
+		dev.idle(0.15)
+		self.assertEqual(board.gpio.read(0x028), 7)
+		self.assertEqual(self.metrics.duplicates, 1)
+		self.assertFalse(('WR', 0x0028) in dev.late)
+
+	# Replies that nothing's waiting for are dropped.
+	def test_repeated_reply(self):
+		dev.write(0x0030, 5)
+		simulator.faults = [ (reply('RD', 0x0030), 2, 0) ]
+		self.assertEqual(dev.read(0x0030), 5)
+		dev.idle(0.01)
+		self.assertEqual(self.metrics.unmatched, 1)
+		dev.write(0x0030, 6)
+		self.assertEqual(dev.read(0x0030), 6)
+
+	# A lost FIFO write isn't sent again, even if it was only the reply
+	# that went missing.
+	def test_fifo_write_reply_lost(self):
+		simulator.faults = [ (reply('WR', 0x2108), 0, 0) ]
+		self.assertRaises(udp.NoResponse, dev.write, 0x2108, [ 1, 2, 3, 4 ])
+		self.assertEqual(list(board.iic.tx), [ 1, 2, 3, 4 ])
+		self.assertEqual(self.metrics.retransmits, {})
+
+	def test_fifo_read_lost(self):
+		board.iic.rx.extend(range(1, 9))
+		board.drops = [ request('RD', 0x210C) ]
+		self.assertRaises(udp.NoResponse, dev.readMultiple, 0x210C, 4)
+		self.assertEqual(list(dev.readMultiple(0x210C, 4)), [ 1, 2, 3, 4 ])
+		simulator.faults = [ (reply('RD', 0x210C), 0, 0) ]
+		self.assertRaises(udp.NoResponse, dev.readMultiple, 0x210C, 2)
+		self.assertEqual(list(dev.readMultiple(0x210C, 2)), [ 7, 8 ])
+		self.assertEqual(self.metrics.retransmits, {})
+
+	def test_fifo_repeated_reply(self):
+		board.iic.rx.extend(range(1, 9))
+		simulator.faults = [ (reply('RD', 0x210C), 2, 0) ]
+		self.assertEqual(list(dev.readMultiple(0x210C, 4)), [ 1, 2, 3, 4 ])
+		dev.idle(0.01)
+		self.assertEqual(list(dev.readMultiple(0x210C, 4)), [ 5, 6, 7, 8 ])
+		self.assertEqual(self.metrics.unmatched, 1)
+
+	# Once a FIFO write's queued behind it, an earlier write in the same
+	# batch isn't retransmitted (its copy would land after the FIFO
+	# write), so losing it fails the batch.
+	def test_batch_hold(self):
+		board.drops = [ request('WR', 0x002C) ]
+		b = dev.batch()
+		b.write(0x002C, 1)
+		b.write(0x2108, [ 1, 2 ])
+		self.assertRaises(udp.NoResponse, b.execute)
+		self.assertEqual(b.completed, 0)
+		self.assertEqual(board.gpio.read(0x02C), 0)
+		self.assertEqual(list(board.iic.tx), [ 1, 2 ])
+		self.assertEqual(self.metrics.retransmits, {})
+
+	# One after it still is.
+	def test_batch_after_fifo(self):
+		board.drops = [ request('WR', 0x0034) ]
+		b = dev.batch()
+		b.write(0x2108, [ 1, 2 ])
+		b.write(0x0034, 1)
+		self.assertEqual(b.execute(), [ 2, 1 ])
+		self.assertEqual(board.gpio.read(0x034), 1)
+		self.assertEqual(self.metrics.retransmits, { 'WR' : 1 })
+
+class BatchTest(EngineTest):
+	def test_results(self):
+		board.gpio.write(0x040, 0x10)
+		b = dev.batch()
+		wr = b.write(0x0044, [ 1, 2, 3 ])
+		rd = b.read(0x0044)
+		rds = b.readMultiple(0x0040, 2)
+		p = b.poll(0x0040, 0x10)
+		results = b.execute()
+		self.assertEqual(results[wr], 3)
+		self.assertEqual(results[rd], 3)
+		self.assertEqual(list(results[rds]), [ 0x10, 0x10 ])
+		self.assertEqual(results[p], 0x10)
+		self.assertEqual(b.completed, 4)
+
+	# Nothing after a poll goes out until it comes true, and
+	# everything before it goes out first.
+	def test_poll_barrier(self):
+		threading.Timer(0.02, board.gpio.write, (0x048, 1)).start()
+		b = dev.batch()
+		b.write(0x004C, 1)
+		b.poll(0x0048, 0x1)
+		rd = b.read(0x004C)
+		self.assertEqual(b.execute()[rd], 1)
+		polls = [ i for i in xrange(len(board.log)) if board.log[i] == ('RD', 0x0048) ]
+		self.assertTrue(len(polls) > 1)
+		self.assertEqual(board.log[0], ('WR', 0x004C))
+		self.assertEqual(board.log[polls[-1]+1:], [ ('RD', 0x004C) ])
+
+	def test_poll_timeout(self):
+		for i in xrange(10):
+			b = dev.batch()
+			b.write(0x0050, 1)
+			b.poll(0x0054, 0x1)
+			b.read(0x0050)
+			self.assertRaises(poll.PollTimeout, b.execute, 0.02)
+			self.assertEqual(b.completed, 1)
+			self.assertEqual(b.results, [ 1, None, None ])
+		self.assertFalse(('RD', 0x0050) in board.log)
+
+	# The FIFO read after the lost one has the same opcode, address
+	# and count, so its reply might have been the lost one's: it
+	# doesn't count as done, and nothing after it does either.
+	def test_lost_fifo_read(self):
+		board.iic.reset()
+		board.iic.rx.extend(range(1, 9))
+		board.drops = [ request('RD', 0x210C) ]
+		b = dev.batch()
+		b.write(0x0058, 1)
+		b.readMultiple(0x210C, 2)
+		b.readMultiple(0x210C, 2)
+		b.read(0x0058)
+		self.assertRaises(udp.NoResponse, b.execute)
+		self.assertEqual(b.completed, 1)
+		self.assertEqual(b.results, [ 1, None, None, None ])
+
+	def test_doubtful(self):
+		def txn(addr, first_sent, answered, count=2):
+			t = udp.Transaction(dev, 'RD', addr, None, count)
+			t.first_sent = first_sent
+			t.answered = answered
+			if answered == None:
+				t.error = udp.NoResponse("lost")
+			return t
+		lost = txn(0x210C, 1.0, None)
+		before = txn(0x210C, 0.5, 0.9)
+		after = txn(0x210C, 1.1, 1.2)
+		# answered after 'after' went out, so it might have got its reply
+		later = txn(0x210C, 1.15, 1.3)
+		other_addr = txn(0x2108, 1.1, 1.2)
+		other_count = txn(0x210C, 1.1, 1.2, 1)
+		unsent = udp.Transaction(dev, 'RD', 0x210C, None, 2)
+		unsent.error = udp.NoResponse("not sent")
+		txns = [ before, lost, after, later, other_addr, other_count, unsent ]
+		self.assertEqual(udp.Batch.doubtful(txns), set([ lost, after, later ]))
+		self.assertEqual(udp.Batch.doubtful([ before, after, other_addr ]), set())
+
+if __name__ == '__main__':
+	unittest.main()
@@ -1,257 +1,1052 @@
 from socket import *
 import struct
+import sys
 import select
 import time
+import collections
+from array import array
 
-import spi
+import codec
+import discovery
+import iic
+import metrics
+import poll
+import regcache
+import retry
+from retry import TransactionError, NoResponse, ShortReply, NotConnected, WriteLost
+
+# A single RD/WR request handed to the transaction engine in UDPFPGA.
+# It behaves like a future: check 'done', or call result() to block
+# until the reply comes back (or the request times out). If a callback
+# was given it's called with the transaction once it completes.
+# 'timeout' overrides the owner's timeout for this one request.
+# A 'volatile' read always goes to the board, even if the register
+# cache has the value. An 'ordered' request is never retransmitted,
+# since a late copy would land after whatever was sent behind it.
+# Requests in the same 'group' (a Batch's are) keep their order too:
+# once one that can't be retransmitted is queued, nothing before it
+# in the group is retransmitted any more.
+class Transaction(object):
+	def __init__(self, owner, opcode, addr, datagram, count=1, acknowledge=True, callback=None,
+				 timeout=None, volatile=False, ordered=False, group=None):
+		self.owner = owner
+		self.opcode = opcode
+		self.addr = addr
+		self.datagram = datagram
+		self.count = count
+		self.acknowledge = acknowledge
+		self.callback = callback
+		self.timeout = timeout
+		self.volatile = volatile
+		self.ordered = ordered
+		self.group = group
+		# filled in by the engine: can it be retransmitted, the word
+		# count it went out with (see UDPFPGA.retag) and every one
+		# used so far, how many times it's been sent, first and latest
+		# send times, when this attempt and the whole thing time out,
+		# and when the reply was matched to it
+		self.idempotent = True
+		self.tag = count
+		self.tags = []
+		self.attempts = 0
+		self.first_sent = None
+		self.sent = None
+		self.deadline = None
+		self.final = None
+		self.answered = None
+		self.done = False
+		self.value = None
+		# a retry.TransactionError if it failed
+		self.error = None
+
+	def complete(self, value, error=None):
+		self.value = value
+		self.error = error
+		self.done = True
+		if self.callback != None:
+			self.callback(self)
+
+	def wait(self):
+		if not self.done:
+			self.owner.wait(self)
+		return self
+
+	# The value, or raise whatever went wrong.
+	def result(self):
+		self.wait()
+		if self.error != None:
+			raise self.error
+		return self.value
+
+# Call every periodic hook and return the earliest time any of them
+# wants to be called again (None if they don't care).
+def run_periodic(hooks):
+	now = time.time()
+	wakeup = None
+	for hook in list(hooks):
+		t = hook(now)
+		if t != None and (wakeup == None or t < wakeup):
+			wakeup = t
+	return wakeup
+
+# A fixed list of register operations, recorded up front and then
+# sent back-to-back through the transaction engine. Get one from
+# UDPFPGA.batch(). Each recording call returns the index of its
+# result in the list execute() returns:
+#	b = dev.batch()
+#	b.write(0x2040, 0xA)
+#	b.poll(0x3064, 0x4)
+#	rd = b.readMultiple(0x306C, 4)
+#	data = b.execute()[rd]
+# A poll is a barrier: it re-reads its register until the condition
+# holds, and nothing recorded after it is sent until then (and until
+# everything before it has been answered: if any of that failed, the
+# batch stops there). Everything recorded before it goes out together
+# with the first poll read.
+# A lost request is retransmitted if it's idempotent (see
+# regcache.RegisterCache.idempotent) and nothing that isn't has been
+# sent after it in the same batch; otherwise the batch fails, and it's
+# up to the caller to start the whole thing over (spi.SPI.command,
+# iic.AXIIIC do). FIFO accesses never are, since there's no telling
+# whether the board saw the first copy.
+# Re-reads back off (up to 'poll_interval' apart) rather than
+# hammering the board, and are counted in the board's poller stats.
+# The whole batch shares one timeout; a poll that runs out of it
+# raises poll.PollTimeout.
+# With posted writes (UDPFPGA.post_writes) writes that haven't been
+# acknowledged by the end aren't waited for, and a batch that reads
+# anything checks every posted write before it (see UDPFPGA.fence).
+class Batch(object):
+	poll_interval = 0.001
+
+	def __init__(self, dev):
+		self.dev = dev
+		self.steps = []
+
+	def add(self, kind, addr, datagram, count=1, mask=0, value=None, acknowledge=True):
+		self.steps.append((kind, addr, datagram, count, mask, value, acknowledge))
+		return len(self.steps)-1
+
+	def read(self, addr):
+		return self.add('read', addr, self.dev.read_command(addr, 1))
+
+	def readMultiple(self, addr, numReads):
+		return self.add('readMultiple', addr, self.dev.read_command(addr, numReads), numReads)
+
+	# The register cache only hears about the write when it's sent
+	# (see send), so a read before it in the batch, or after a batch
+	# that never got that far, still gets what's on the board.
+	def write(self, addr, data, no_acknowledge=False):
+		if type(data) is not list: data = [ data ]
+		return self.add('write', addr, self.dev.write_command(addr, data), len(data),
+						value=data[-1] if len(data) else None, acknowledge=not no_acknowledge)
+
+	# Wait until (register & mask) == value, or if value isn't given,
+	# until any bit in mask is set.
+	def poll(self, addr, mask, value=None):
+		return self.add('poll', addr, self.dev.read_command(addr, 1), 1, mask, value)
+
+	# A poll's read gets at least one attempt's worth of time, even
+	# right at the deadline, so a poll that runs out of time raises
+	# poll.PollTimeout rather than retry.NoResponse.
+	def send(self, index, deadline):
+		kind, addr, datagram, count, mask, value, acknowledge = self.steps[index]
+		opcode = 'WR' if kind == 'write' else 'RD'
+		if kind == 'write' and value != None:
+			self.dev.cache.written(addr, value)
+		timeout = max(deadline - time.time(), 0)
+		if kind == 'poll':
+			timeout = max(timeout, self.dev.retry.timeout())
+		txn = Transaction(self.dev, opcode, addr, datagram, count, acknowledge,
+						  timeout=timeout, volatile=(kind == 'poll'), group=self)
+		return self.dev.submit(txn)
+
+	# What a step's request came back with, as execute() returns it.
+	def result(self, index, value):
+		kind = self.steps[index][0]
+		if kind == 'read' or kind == 'poll':
+			return value[0]
+		return value
+
+	# Which of 'txns' might have been answered with a reply meant for
+	# another. Replies are only told apart by opcode, address and word
+	# count, so if a request never got one, any like it answered after
+	# it went out might have got its reply instead, and so on.
+	@staticmethod
+	def doubtful(txns):
+		lost = [ txn for txn in txns if txn.error != None and txn.first_sent != None ]
+		doubtful = set(lost)
+		while len(lost):
+			other = lost.pop()
+			for txn in txns:
+				if (txn not in doubtful and txn.answered != None and txn.answered >= other.first_sent and
+					txn.opcode == other.opcode and txn.addr == other.addr and txn.count == other.count):
+					doubtful.add(txn)
+					lost.append(txn)
+		return doubtful
+
+	# Send everything and return the list of results: a value for
+	# read/poll, a list for readMultiple, the write count for write.
+	# Raises retry.TransactionError if any request failed, or
+	# poll.PollTimeout if a poll ran out of time. Either way 'completed'
+	# is then how many steps, from the first, got done, and 'results'
+	# has theirs (None for the rest), so a transfer that failed partway
+	# can pick up from there.
+	def execute(self, timeout=None):
+		if timeout == None:
+			timeout = self.dev.timeout
+		deadline = time.time() + timeout
+		results = [ None ]*len(self.steps)
+		self.results = results
+		self.completed = 0
+		txns = []
+		# requests before here are known to have gone through
+		settled = 0
+		i = 0
+		try:
+			while i < len(self.steps):
+				# send up to and including the next poll
+				while i < len(self.steps):
+					txns.append((i, self.send(i, deadline)))
+					i = i + 1
+					if self.steps[i-1][0] == 'poll':
+						break
+				index, txn = txns[-1]
+				kind, addr, datagram, count, mask, value, acknowledge = self.steps[index]
+				if kind != 'poll':
+					continue
+				name = 'poll 0x%04x' % addr
+				start = time.time()
+				delays = self.dev.poller.backoff(self.poll_interval)
+				polls = 1
+				while True:
+					val = txn.result()[0]
+					if (value == None and val & mask) or (value != None and (val & mask) == value):
+						break
+					# no point waiting if something before it failed
+					while settled < len(txns) - 1 and txns[settled][1].done:
+						txns[settled][1].result()
+						settled = settled + 1
+					now = time.time()
+					if now > deadline:
+						self.dev.poller.record(name, polls, now - start, True)
+						raise poll.PollTimeout(name, polls, now - start, val)
+					self.dev.idle(min(delays.next(), deadline - now))
+					txn = self.send(index, deadline)
+					polls = polls + 1
+				self.dev.poller.record(name, polls, time.time() - start, False)
+				txns[-1] = (index, txn)
+				# make sure everything up to the poll got there (it's
+				# usually all back before the poll is) so nothing goes
+				# out after a write that didn't
+				while settled < len(txns) - 1:
+					txns[settled][1].result()
+					settled = settled + 1
+			reads = False
+			for index, txn in txns:
+				kind = self.steps[index][0]
+				if kind == 'write' and not txn.done and self.dev.post_writes:
+					self.dev.post(txn)
+					results[index] = txn.count
+					continue
+				results[index] = self.result(index, txn.result())
+				reads = reads or kind != 'write'
+			self.completed = len(self.steps)
+			if reads and (len(self.dev.posted) or len(self.dev.lost)):
+				self.dev.fence()
+		except (TransactionError, poll.PollTimeout):
+			# let whatever's still in flight finish first, or its
+			# replies could be taken for the next batch's
+			error = sys.exc_info()
+			for index, txn in txns:
+				txn.wait()
+			# a poll that ran out of time didn't get done either
+			stop = txns[-1][0] if isinstance(error[1], poll.PollTimeout) else len(self.steps)
+			doubtful = Batch.doubtful([ txn for index, txn in txns ])
+			results[:] = [ None ]*len(results)
+			self.completed = 0
+			for index, txn in txns:
+				if index != self.completed or index >= stop or txn.error != None or txn in doubtful:
+					break
+				results[index] = self.result(index, txn.value)
+				self.completed = index + 1
+			raise error[0], error[1], error[2]
+		return results
 
 # Base class of a network-ified FPGA.
-# For multiple FPGA comms, this really needs to be turned into
-# some sort of a server thing.
+# On its own it binds the host port (18521) itself, so only one
+# board can be driven per process. To talk to several boards, create
+# a controller.BoardController and pass it in: it owns the port and
+# hands each board the replies that came from its address.
+#
+# Register accesses go through a small pipelined transaction engine:
+# read_async/write_async queue up a Transaction, and up to 'window'
+# of them are kept in flight at once. Replies are matched up to the
+# oldest outstanding request with the same opcode and address.
+# read/readMultiple/write are just blocking wrappers around this.
+#
+# Lost requests are retransmitted according to 'retry' (a
+# retry.RetryPolicy), and when a request finally fails the blocking
+# calls raise a retry.TransactionError.
+#
+# With 'combine' set, runs of writes to the same address are sent as
+# one datagram (see combine_write). With 'post_writes' set, writes
+# don't wait for their acknowledgements (see post).
 class UDPFPGA:
-	def __init__(self):
-		self.client = socket(AF_INET, SOCK_DGRAM)
-		self.client.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
-		self.server = socket(AF_INET, SOCK_DGRAM)
-		# this makes it so we can't talk to multiple things right now
-		# deal with this later
-		self.server.bind(('0.0.0.0', 18521))
+	# number of requests allowed in flight at once
+	window = 8
+	# write combining, off unless asked for
+	combine = False
+	# how long a run of writes waits for more to join it
+	combine_delay = 0.0005
+	# posted writes, off unless asked for
+	post_writes = False
+	# longest a request can take, retransmissions and all
+	timeout = 2
+	# unicast IDs sent to a cached address before giving up on it
+	probe_attempts = 2
+
+	def __init__(self, controller=None):
+		self.controller = controller
+		if controller != None:
+			self.client = controller.client
+			self.server = controller.server
+			self.board_cache = controller.board_cache
+		else:
+			# where boards were last time: see discovery.py
+			self.board_cache = discovery.default_cache()
+			self.client = socket(AF_INET, SOCK_DGRAM)
+			self.client.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+			self.server = socket(AF_INET, SOCK_DGRAM)
+			# this makes it so we can't talk to multiple things
+			# without a controller.
+			self.server.bind(('0.0.0.0', 18521))
+			self.server.setblocking(0)
 		self.target = None
-		self.server.setblocking(0)
+		self.target_dna = None
+		self.rx = codec.ReplyBuffer()
+		self.cache = regcache.RegisterCache()
+		self.poller = poll.Poller(self.idle)
+		self.retry = retry.RetryPolicy()
+		# (opcode, addr) -> { tag : until }: replies that might still
+		# turn up for copies of requests that are already finished
+		self.late = {}
+		self.pending = collections.deque()
+		self.inflight = []
+		# writes held back for combining, how many words they are, and
+		# when they have to go
+		self.combining = []
+		self.combine_words = 0
+		self.combine_deadline = None
+		# posted writes not known to have landed yet, what went wrong
+		# with the ones that didn't, and the words posted and
+		# acknowledged since the last fence()
+		self.posted = collections.deque()
+		self.lost = []
+		self.posted_words = 0
+		self.acknowledged_words = 0
+		# hook(now) called on every process(), returning when it next
+		# wants to be called (or None): see telemetry.Telemetry
+		self.periodic = []
+		self.next_periodic = None
+		# metrics.Metrics, if enable_metrics() was called
+		self.metrics = None
+
+	# Start recording transaction metrics (into 'm' if given, say to
+	# share one between boards). Returns the Metrics.
+	def enable_metrics(self, m=None):
+		self.metrics = m if m != None else metrics.Metrics()
+		return self.metrics
+
+	def disable_metrics(self):
+		self.metrics = None
 	
 	def empty_socket(self):
+		# the socket's shared: anything in it might be for another board
+		if self.controller != None:
+			return
 		try:
 			while True:
-				self.server.recv(1024)
+				n = self.rx.recv(self.server)
+				if self.metrics != None:
+					self.metrics.discard(n)
 		except:
 			pass
 
 	def assign_ip(self, dna, ip):
+		if self.controller != None:
+			return self.controller.assign_ip(self, dna, ip)
 		if len(ip) > 4:
 			ip=inet_aton(ip)
-		self.client.setsockopt(SOL_SOCKET, SO_BROADCAST, 1)
-		self.empty_socket()
-		self.client.sendto(self.static_ip_command(dna, ip), ("255.255.255.255", 18520))
-		self.client.setsockopt(SOL_SOCKET, SO_BROADCAST, 0)
-		while True:
-			ready = select.select([self.server], [], [], 2)
-			if ready[0]:
-				data = self.server.recv(4096)
-				cmd = struct.unpack('2sB', data[0:3])
-				if cmd[0]=='SI' and cmd[1]==0:
-					vals = struct.unpack('!Q', data[3:11])
-					if vals[0] == dna:
-						self.target = (ip, 18520)
-						self.target_dna = vals[0]
-						return True
-					else:
-						print "Got a response from unaddressed target: %x" % dna
-						return False
+		def handle(n):
+			if n < codec.SI_REPLY.size:
+				return None
+			cmd = codec.SI_REPLY.unpack_from(self.rx.buf)
+			if cmd[0]=='SI' and cmd[1]==0:
+				vals = cmd[2:]
+				if vals[0] == dna:
+					self.target = (inet_ntoa(ip), 18520)
+					self.target_dna = vals[0]
+					self.board_cache.update({ dna : self.target[0] })
+					return True
 				else:
-					print "No acknowledgement of IP address assignment."
-					print "Check IP address "		
+					print "Got a response from unaddressed target: %x" % dna
+					return False
+			return None
+		result = self.broadcast(self.static_ip_command(dna, ip), 'SI', handle)
+		if result == None:
+			print "No acknowledgement of IP address assignment."
+			print "Check IP address "		
+			return False
+		return result
 
+	# Without a DNA, whatever answers a broadcast ID first. With one,
+	# it's asked for directly where it was last time if it's in the
+	# board cache, and broadcast for only if it isn't there.
 	def connect(self, dna=None):
+		if self.controller != None:
+			return self.controller.connect(self, dna)
 		if self.target == None:
-			self.client.setsockopt(SOL_SOCKET, SO_BROADCAST, 1)
-			self.empty_socket()
-			self.client.sendto(self.id_command(), ("255.255.255.255", 18520))
-			self.client.setsockopt(SOL_SOCKET, SO_BROADCAST, 0)
+			def handle(n):
+				if n < codec.ID_REPLY.size:
+					return None
+				cmd = codec.ID_REPLY.unpack_from(self.rx.buf)
+				if cmd[0]=='ID' and cmd[1]==0:
+					target_ip = inet_ntoa(cmd[2])
+					vals = cmd[3:]
+					if dna == None or vals[0] == dna:
+						self.target = (target_ip, 18520)
+						self.target_dna = vals[0]
+						return True
+				return None
+			ip = self.board_cache.get(dna) if dna != None else None
+			if ip != None:
+				if self.broadcast(self.id_command(), 'ID', handle, ip, self.probe_attempts) == None:
+					self.board_cache.forget([ dna ])
+			if self.target == None and self.broadcast(self.id_command(), 'ID', handle) == None:
+				print "Failed to find device."
+				return False
+			self.board_cache.update({ self.target_dna : self.target[0] })
+			return True
+
+	# Broadcast 'datagram' and hand the length of each reply to
+	# 'handle' until it returns something other than None, which is
+	# returned. Retransmits on the retry policy's timeouts, up to
+	# 'attempts' sends in all; None if nothing ever answered. Given an
+	# 'ip', it's sent just there instead.
+	def broadcast(self, datagram, opcode, handle, ip=None, attempts=None):
+		self.empty_socket()
+		sent = time.time()
+		if attempts == None:
+			attempts = self.retry.retries + 1
+		for attempt in xrange(attempts):
+			if ip != None:
+				self.client.sendto(datagram, (ip, 18520))
+			else:
+				self.client.setsockopt(SOL_SOCKET, SO_BROADCAST, 1)
+				self.client.sendto(datagram, ("255.255.255.255", 18520))
+				self.client.setsockopt(SOL_SOCKET, SO_BROADCAST, 0)
+			if self.metrics != None:
+				self.metrics.sent(opcode, None, len(datagram))
+				if attempt:
+					self.metrics.retransmit(opcode, None)
+			deadline = time.time() + self.retry.timeout(attempt)
 			while True:
-				ready = select.select([self.server], [],[], 2)
-				if ready[0]:
-					data = self.server.recv(4096)
-					# TODO: check length here
-					cmd = struct.unpack('2sB', data[0:3])
-					if cmd[0]=='ID' and cmd[1]==0:
-						target_ip = inet_ntoa(data[3:7])
-						vals = struct.unpack('!Q', data[7:15])
-						if dna != None:
-							if vals[0] == dna:
-								self.target = (target_ip, 18520)
-								self.target_dna = vals[0]
-								return True
-						else:
-							self.target = (target_ip, 18520)
-							self.target_dna = vals[0]
-							return True
-				else:
-					print "Failed to find device."
-					return False
+				remaining = deadline - time.time()
+				if remaining <= 0:
+					break
+				ready = select.select([self.server], [], [], remaining)
+				if not ready[0]:
+					break
+				n = self.rx.recv(self.server)
+				if self.metrics != None:
+					self.metrics.received(n)
+				result = handle(n)
+				if result != None:
+					if self.metrics != None:
+						self.metrics.completed(opcode, 0, time.time() - sent)
+					return result
+		return None
 	
-	def readMultiple(self, addr, numReads):
-		if numReads > 16:
-			return None
-		if self.target != None:
+	# Queue up a transaction. Single reads the register cache can
+	# answer complete right away.
+	def submit(self, txn):
+		if self.target == None:
+			txn.complete(None, NotConnected("No target, use connect first"))
+			return txn
+		if txn.opcode == 'RD' and txn.count == 1 and not txn.volatile:
+			val = self.cache.lookup(txn.addr)
+			if val != None:
+				txn.complete(array(codec.WORD, [ val ]))
+				return txn
+		if self.combine and txn.opcode == 'WR':
+			self.combine_write(txn)
+			return txn
+		self.flush()
+		self.enqueue(txn)
+		self.fill()
+		return txn
+
+	# Anything left over in the socket from before is thrown away if
+	# nothing's outstanding.
+	def enqueue(self, txn):
+		if not len(self.pending) and not len(self.inflight):
 			self.empty_socket()
-			self.client.sendto(self.read_command(addr, numReads), self.target)
+		txn.idempotent = not txn.ordered and self.cache.idempotent(txn.opcode, txn.addr)
+		if not txn.idempotent and txn.group != None:
+			self.hold(txn.group)
+		self.pending.append(txn)
+
+	# Stop retransmitting anything outstanding in 'group': something's
+	# going out behind it that a late copy mustn't land after. What's
+	# already been sent gets as long as a request that never could be.
+	def hold(self, group):
+		for txn in self.inflight:
+			if txn.group is group and txn.idempotent:
+				txn.idempotent = False
+				txn.deadline = min(txn.sent + self.attempt_timeout(txn), txn.final)
+		for txn in self.pending:
+			if txn.group is group:
+				txn.idempotent = False
+
+	# Write combining. Several words in one WR all go to the same
+	# address, which is just the same as writing them one after
+	# another, so a run of writes to one address (all acknowledged, or
+	# none) is held back while there's something else outstanding, in
+	# case more join it. It goes once it's MAX_WORDS long, nothing else
+	# is pending or in flight any more, or 'combine_delay' runs out
+	# (whichever process() or idle() sees first), so a write with
+	# nothing in front of it goes straight out. Anything else - a
+	# write somewhere else, any read, fence(), waiting on one of the
+	# writes - sends it first, so everything still goes out in the
+	# order it was asked for. Each write's Transaction completes as
+	# usual when the combined one does.
+	def combine_write(self, txn):
+		run = self.combining
+		if len(run) and (run[0].addr != txn.addr or run[0].acknowledge != txn.acknowledge or
+						 self.combine_words + txn.count > codec.MAX_WORDS):
+			self.flush()
+		if not len(self.combining):
+			self.combine_deadline = time.time() + self.combine_delay
+			self.combine_words = 0
+		self.combining.append(txn)
+		self.combine_words = self.combine_words + txn.count
+		if self.combine_words >= codec.MAX_WORDS:
+			self.flush()
+		self.fill()
+
+	# Queue up the writes held back for combining.
+	def flush(self):
+		run = self.combining
+		if not len(run):
+			return
+		self.combining = []
+		self.combine_deadline = None
+		if len(run) == 1:
+			self.enqueue(run[0])
+			return
+		def done(txn):
+			for part in run:
+				part.complete(part.count if txn.acknowledge and txn.error == None else txn.value, txn.error)
+		datagram = run[0].datagram + ''.join([ part.datagram[codec.DATA_OFFSET:] for part in run[1:] ])
+		timeouts = [ part.timeout for part in run if part.timeout != None ]
+		groups = set([ part.group for part in run ])
+		txn = Transaction(self, 'WR', run[0].addr, datagram, self.combine_words,
+						  run[0].acknowledge, callback=done, timeout=min(timeouts) if len(timeouts) else None,
+						  ordered=any([ part.ordered for part in run ]) or len(groups) > 1,
+						  group=groups.pop() if len(groups) == 1 else None)
+		if self.metrics != None:
+			self.metrics.combined(len(run))
+		self.enqueue(txn)
+
+	# Posted writes. With 'post_writes' set, write() (and the writes
+	# at the end of a batch) hand their Transaction in here instead of
+	# waiting for it. The board still acknowledges every one: they're
+	# counted as they come in, and fence(), or the next read, waits for
+	# the rest and raises if any are missing. That's one round trip per
+	# fence instead of one per write, and nothing goes unchecked.
+	def post(self, txn):
+		self.posted_words = self.posted_words + txn.count
+		self.posted.append(txn)
+		while len(self.posted) and self.posted[0].done:
+			self.settle(self.posted.popleft())
+
+	def settle(self, txn):
+		if txn.error != None:
+			self.lost.append(txn)
+		else:
+			self.acknowledged_words = self.acknowledged_words + txn.count
+
+	# Send whatever's been held back for combining, and wait for every
+	# posted write. Raises retry.WriteLost if any of them weren't
+	# acknowledged.
+	def fence(self):
+		self.flush()
+		self.fill()
+		while len(self.posted):
+			self.settle(self.posted[0].wait())
+			self.posted.popleft()
+		lost = self.lost
+		missing = self.posted_words - self.acknowledged_words
+		self.lost = []
+		self.posted_words = 0
+		self.acknowledged_words = 0
+		if len(lost):
+			raise WriteLost("%d posted write(s) lost (%d words): %s" % (len(lost), missing, lost[0].error))
+
+	# Send as many pending transactions as the window allows, after
+	# any writes held back for combining that are due to go.
+	# Unacknowledged writes complete as soon as they're sent,
+	# and don't take up a slot in the window.
+	def fill(self):
+		if self.combine_deadline != None and (time.time() >= self.combine_deadline or
+											  not (len(self.pending) or len(self.inflight))):
+			self.flush()
+		while len(self.pending) and len(self.inflight) < self.window:
+			txn = self.pending.popleft()
+			if txn.idempotent and len(self.late):
+				self.retag(txn)
+			self.client.sendto(txn.datagram, self.target)
+			if self.metrics != None:
+				self.metrics.sent(txn.opcode, txn.addr, len(txn.datagram))
+			if txn.acknowledge:
+				txn.sent = time.time()
+				txn.first_sent = txn.sent
+				txn.attempts = 1
+				txn.tags = [ txn.tag ]
+				txn.final = txn.sent + (txn.timeout if txn.timeout != None else self.timeout)
+				txn.deadline = min(txn.sent + self.attempt_timeout(txn), txn.final)
+				self.inflight.append(txn)
+			else:
+				txn.complete(None)
+
+	# How long to give the current attempt at 'txn'. Requests that
+	# can't be retransmitted get as long as the last retransmission
+	# of one that can.
+	def attempt_timeout(self, txn):
+		if not txn.idempotent:
+			return self.retry.timeout(self.retry.retries)
+		return self.retry.timeout(txn.attempts - 1)
+
+	def retransmit(self, txn):
+		self.retag(txn)
+		self.client.sendto(txn.datagram, self.target)
+		txn.sent = time.time()
+		txn.attempts = txn.attempts + 1
+		txn.tags.append(txn.tag)
+		txn.deadline = min(txn.sent + self.attempt_timeout(txn), txn.final)
+		if self.metrics != None:
+			self.metrics.sent(txn.opcode, txn.addr, len(txn.datagram))
+			self.metrics.retransmit(txn.opcode, txn.addr)
+
+	# Sequence numbers, of a sort. The protocol doesn't have any, but
+	# the reply to an idempotent request says how many words it was
+	# for, and reading a register (or writing the same words to it)
+	# several times over is the same as doing it once. So each copy
+	# of a request that might get a late reply goes out as a
+	# different multiple of its word count, and a reply can only be
+	# for the copy with its count. Pick one that nothing else to the
+	# same address could answer, if there is one.
+	def retag(self, txn):
+		key = (txn.opcode, txn.addr)
+		taken = set(txn.tags)
+		if key in self.late:
+			taken.update(self.late[key])
+		for other in self.inflight:
+			if other is not txn and other.opcode == txn.opcode and other.addr == txn.addr:
+				taken.add(other.tag)
+		if txn.tag not in taken:
+			return
+		for tag in xrange(txn.count, codec.MAX_WORDS + 1, txn.count):
+			if tag not in taken:
+				break
+		else:
+			return
+		txn.tag = tag
+		if txn.opcode == 'RD':
+			txn.datagram = self.read_command(txn.addr, tag)
+		else:
+			data = list(codec.wr_command_struct(txn.count).unpack(txn.datagram[0:codec.DATA_OFFSET + 4*txn.count])[3:])
+			txn.datagram = self.write_command(txn.addr, data*(tag/txn.count))
+
+	# Copies of 'txn' other than the one that got 'answered' (None if
+	# nothing did) might still get replies for a while: make sure
+	# they're recognized and dropped.
+	def expect_late(self, txn, answered=None):
+		tags = list(txn.tags)
+		if answered in tags:
+			tags.remove(answered)
+		if not len(tags):
+			return
+		until = time.time() + 2*self.retry.timeout(self.retry.retries)
+		late = self.late.setdefault((txn.opcode, txn.addr), {})
+		for tag in tags:
+			late[tag] = until
+
+	# Is this reply for a copy of a request that's already finished?
+	# (If so, it's used up.)
+	def stale(self, opcode, addr, tag):
+		key = (opcode, addr)
+		if key not in self.late:
+			return False
+		late = self.late[key]
+		now = time.time()
+		for t in [ t for t in late if late[t] < now ]:
+			del late[t]
+		found = tag in late
+		if found:
+			del late[tag]
+		if not len(late):
+			del self.late[key]
+		return found
+
+	# Wait up to 'timeout' seconds for replies, hand out whatever
+	# showed up, expire anything that's been waiting too long,
+	# and refill the window.
+	def process(self, timeout=0):
+		if self.combine_deadline != None:
+			timeout = min(timeout, max(self.combine_deadline - time.time(), 0))
+		if self.controller != None:
+			self.controller.process(timeout)
+			return
+		ready = select.select([self.server], [], [], timeout)
+		if ready[0]:
 			while True:
-				ready = select.select([self.server], [], [], 2)
-				if ready[0]:
-					data = self.server.recv(4096)
-					# TODO: check length here
-					cmd = struct.unpack('2sB', data[0:3])
-					if cmd[0]=='RD' and cmd[1]==0:
-						respAddr = struct.unpack('!H',data[3:5])
-						if	respAddr[0] != addr:
-							# TODO: this should really be throwing an exception
-							print "Got response for wrong address!"
-							return None
-						respData=[]
-						data=data[5:]
-						for i in xrange(numReads):
-							respData.extend(struct.unpack('!L',data[0:4]))
-							data=data[4:]
-						return respData
-				else:
-					# TODO: this should really be throwing an exception
-					print "No response!"
-					return None
+				try:
+					n = self.rx.recv(self.server)
+				except error:
+					break
+				self.dispatch(self.rx.buf, n)
+		self.expire()
+		self.fill()
+		if len(self.periodic):
+			self.next_periodic = run_periodic(self.periodic)
+
+	# Match up one reply (the first 'length' bytes of 'buf') with
+	# the request it belongs to. RD data comes back as an array.
+	def dispatch(self, buf, length=None):
+		if length == None:
+			length = len(buf)
+		if self.metrics != None:
+			self.metrics.received(length)
+		if length < codec.REPLY.size:
+			return
+		cmd = codec.REPLY.unpack_from(buf)
+		if cmd[1] != 0:
+			return
+		# how many words it's for
+		if cmd[0] == 'RD':
+			tag = (length - codec.DATA_OFFSET)/4
+		elif length >= codec.WR_REPLY.size:
+			tag = codec.WR_REPLY.unpack_from(buf)[3]
 		else:
-			# TODO: this should really be throwing an exception
-			print "No target, use connect first"
-			return None							
-	
+			tag = None
+		if len(self.late) and self.stale(cmd[0], cmd[2], tag):
+			if self.metrics != None:
+				self.metrics.duplicate(cmd[0], cmd[2], length)
+			return
+		match = None
+		for i in xrange(len(self.inflight)):
+			txn = self.inflight[i]
+			if txn.opcode == cmd[0] and txn.addr == cmd[2]:
+				if tag in txn.tags:
+					match = i
+					break
+				if match == None:
+					match = i
+		if match == None:
+			# nobody was waiting for this: stale, or for a request
+			# that already timed out. Drop it.
+			if self.metrics != None:
+				self.metrics.mismatch(cmd[0], cmd[2], length)
+			return
+		txn = self.inflight.pop(match)
+		now = time.time()
+		txn.answered = now
+		if txn.attempts == 1:
+			self.retry.measured(now - txn.sent)
+		else:
+			self.expect_late(txn, tag)
+		if self.metrics != None:
+			self.metrics.completed(txn.opcode, txn.addr, now - txn.first_sent)
+		if tag not in txn.tags:
+			if self.metrics != None:
+				self.metrics.short_reply(txn.opcode, txn.addr, length)
+			if cmd[0] == 'RD':
+				txn.complete(None, ShortReply("Short read response!"))
+			else:
+				# don't know how much of it got there
+				self.cache.invalidate(txn.addr)
+				txn.complete(0, ShortReply("Short write response!"))
+			return
+		if cmd[0] == 'RD':
+			val = codec.words(buf, txn.count)
+			if txn.count == 1:
+				self.cache.fill(txn.addr, val[0])
+			txn.complete(val)
+		else:
+			txn.complete(txn.count)
+
+	def expire(self):
+		now = time.time()
+		for txn in [ txn for txn in self.inflight if now > txn.deadline ]:
+			if txn.idempotent and now < txn.final and txn.attempts <= self.retry.retries:
+				self.retransmit(txn)
+				continue
+			self.inflight.remove(txn)
+			if txn.idempotent or txn.attempts > 1:
+				self.expect_late(txn)
+			if txn.opcode == 'WR':
+				# don't know if it got there
+				self.cache.invalidate(txn.addr)
+			if self.metrics != None:
+				self.metrics.timeout(txn.opcode, txn.addr)
+			txn.complete(None, NoResponse("No response to %s 0x%04x after %d tries!" %
+										  (txn.opcode, txn.addr, txn.attempts)))
+
+	# When the next outstanding request times out, or held back writes
+	# have to go (None if neither).
+	def next_deadline(self):
+		deadlines = [ txn.deadline for txn in self.inflight ]
+		if self.combine_deadline != None:
+			deadlines.append(self.combine_deadline)
+		if not len(deadlines):
+			return None
+		return min(deadlines)
+
+	# Inside a controller.Worker, anything that would block hands
+	# control back to the controller instead.
+	def in_worker(self):
+		return self.controller != None and self.controller.current != None
+
+	# Block until 'txn' completes.
+	def wait(self, txn):
+		self.flush()
+		while not txn.done:
+			if self.in_worker():
+				self.controller.suspend([ txn ])
+			elif len(self.inflight):
+				self.process(max(self.next_deadline() - time.time(), 0))
+			else:
+				self.fill()
+
+	# Let 'seconds' go by, keeping outstanding transactions moving.
+	def idle(self, seconds):
+		if self.in_worker():
+			self.controller.suspend(wake=time.time() + seconds)
+			return
+		deadline = time.time() + seconds
+		while True:
+			remaining = deadline - time.time()
+			if remaining <= 0:
+				break
+			self.process(remaining)
+
+	# Block until everything queued so far has completed.
+	def wait_all(self):
+		self.flush()
+		while len(self.pending) or len(self.inflight):
+			self.wait(self.pending[-1] if len(self.pending) else self.inflight[-1])
+
+	def read_async(self, addr, numReads=1, callback=None):
+		txn = Transaction(self, 'RD', addr, self.read_command(addr, numReads), numReads, callback=callback)
+		return self.submit(txn)
+
+	def write_async(self, addr, data, no_acknowledge=False, callback=None):
+		if type(data) is not list: data = [ data ]
+		if len(data):
+			self.cache.written(addr, data[-1])
+		txn = Transaction(self, 'WR', addr, self.write_command(addr, data), len(data),
+				acknowledge=not no_acknowledge, callback=callback)
+		return self.submit(txn)
+
+	def batch(self):
+		return Batch(self)
+
+	def readMultiple(self, addr, numReads):
+		if numReads > codec.MAX_WORDS:
+			raise ValueError("%d words is more than one read (max %d)" % (numReads, codec.MAX_WORDS))
+		result = self.read_async(addr, numReads).result()
+		if len(self.posted) or len(self.lost):
+			self.fence()
+		return result
 	
 	def read(self, addr):
 		rd = self.readMultiple(addr, 1)
-		return rd[0]
+		return int(rd[0])
+
+	# Don't let the pending queue get much longer than the window
+	# when we're generating lots of transactions.
+	def throttle(self):
+		while len(self.pending) > self.window:
+			if not len(self.inflight):
+				self.fill()
+			elif self.in_worker():
+				self.controller.suspend([ self.inflight[0] ])
+			else:
+				self.process(max(self.next_deadline() - time.time(), 0))
+
+	# Split a block transfer into (address, offset, count) chunks.
+	# With increment=True each word is at its own address (one word
+	# per datagram, since the protocol doesn't increment). Otherwise
+	# they all go to 'addr' (a FIFO), MAX_WORDS at a time.
+	@staticmethod
+	def chunks(addr, count, increment):
+		offset = 0
+		while offset < count:
+			if increment:
+				yield (addr + 4*offset, offset, 1)
+				offset = offset + 1
+			else:
+				n = min(codec.MAX_WORDS, count - offset)
+				yield (addr, offset, n)
+				offset = offset + n
+
+	# Read 'count' words of any length, pipelined, into one array.
+	# Like any read, it checks the posted writes before it.
+	def read_block(self, addr, count, increment=False):
+		result = array(codec.WORD, [ 0 ])*count
+		errors = []
+		def store(txn, offset):
+			if txn.error != None:
+				errors.append(txn.error)
+			else:
+				result[offset:offset+txn.count] = txn.value
+		txns = []
+		for chunk_addr, offset, n in UDPFPGA.chunks(addr, count, increment):
+			txns.append(self.read_async(chunk_addr, n,
+						callback=lambda txn, offset=offset: store(txn, offset)))
+			self.throttle()
+		for txn in txns:
+			txn.wait()
+		if len(errors):
+			raise errors[0]
+		if len(self.posted) or len(self.lost):
+			self.fence()
+		return result
+
+	# Write a block of words of any length, pipelined. Returns the
+	# number of words the board acknowledged. Posted writes before it
+	# are left for the next read or fence() to check, same as write().
+	def write_block(self, addr, data, increment=False):
+		txns = []
+		for chunk_addr, offset, n in UDPFPGA.chunks(addr, len(data), increment):
+			txns.append(self.write_async(chunk_addr, list(data[offset:offset+n])))
+			if self.post_writes:
+				self.post(txns[-1])
+			self.throttle()
+		if self.post_writes:
+			return len(data)
+		written = 0
+		for txn in txns:
+			written = written + txn.result()
+		return written
+
+	# Read-modify-write of the bits in 'mask'. If the register's
+	# cached this is just the write.
+	def modify(self, addr, mask, value):
+		cur = self.read(addr)
+		return self.write(addr, (cur & ~mask) | (value & mask))
 
 	def write(self, addr, data, no_acknowledge=False):
-		if type(data) is not list: data = [ data ]
-		if self.target != None:
-			self.empty_socket()
-			self.client.sendto(self.write_command(addr, data), self.target)
-			if no_acknowledge == True:
-				return
-			while True:
-				ready = select.select([self.server], [], [], 2)
-				if ready[0]:
-					data = self.server.recv(4096)
-					# TODO: check length here
-					cmd = struct.unpack('2sB', data[0:3])
-					if cmd[0]=='WR' and cmd[1]==0:
-						respAddr = struct.unpack('!H',data[3:5])
-						if	respAddr[0] != addr:
-							# TODO: this should really be throwing an exception
-							print "Got response for wrong address!"
-							return 0
-						respNum = struct.unpack('B',data[5])
-						return respNum
-				else:
-					# TODO: this should really be throwing an exception
-					print "No response!"
-					return 0
-		else:
-			# TODO: this should really be throwing an exception
-			print "No target, use connect first"
-			return 0						
+		txn = self.write_async(addr, data, no_acknowledge)
+		if no_acknowledge == True:
+			return
+		if self.post_writes:
+			self.post(txn)
+			self.throttle()
+			return txn.count
+		return txn.result()
 
-	def static_ip_command(self, dna, ip):
-		str = struct.pack('!ccbQ', 'S', 'I', 0, dna) + ip
-		return str
+	# Command builders: see codec.py for the formats.
+	@staticmethod
+	def static_ip_command(dna, ip):
+		return codec.static_ip_command(dna, ip)
 		
-	def id_command(self):
-		str = struct.pack('!ccb', 'I', 'D', 0 )
-		return str
-
-	def write_command(self, addr, data):
-		nwr = len(data)
-		cstr = struct.pack('!ccbH','W','R',0, addr)
-		for i in xrange(nwr):
-			cstr = cstr + struct.pack('!I', data[i])		
-		return cstr
-
-	def read_command(self, addr, numBytes=1):
-		str = struct.pack('!ccbHB','R','D',0, addr, numBytes)
-		return str	
-
-class TOFProto(UDPFPGA):
-	def __init__(self, dna=None, ip=None):
-		UDPFPGA.__init__(self)
-		if ip != None:
-			UDPFPGA.assign_ip(self, dna, ip)
-		elif UDPFPGA.connect(self, dna):
-			print "Connected to device %x" % self.target_dna
-		self.resetI2C()
-		self.spi = spi.SPI(spi.AXIQuadSPI(self, 0x3000, 0))		
+	@staticmethod
+	def id_command():
+		return codec.id_command()
+
+	@staticmethod
+	def write_command(addr, data):
+		return codec.write_command(addr, data)
+
+	@staticmethod
+	def read_command(addr, numBytes=1):
+		return codec.read_command(addr, numBytes)
+
+# What's on a TOF board, however it's reached: mixed in with the
+# transport (UDPFPGA here, or mmio.MMapFPGA), which calls setup().
+# Setting up only costs declaring registers. The I2C controller's
+# reset the first time it's used, and the flash interface (spi.py,
+# and everything it needs) isn't even set up until something uses
+# .spi.
+class TOFBoard:
+	def setup(self):
+		self.declare_registers()
+		self.i2c = iic.AXIIIC(self, 0x2000)
+
+	def __getattr__(self, name):
+		if name == 'spi':
+			import spi
+			self.spi = spi.SPI(spi.AXIQuadSPI(self, 0x3000, 0), self.target_dna)
+			return self.spi
+		raise AttributeError(name)
 	
+	# Registers that only we ever change. Everything else stays
+	# volatile. (The Quad SPI's are declared by spi.AXIQuadSPI.)
+	def declare_registers(self):
+		# LED
+		self.cache.declare(0x0000, 0x0004, regcache.CACHEABLE)
+		# IIC CR
+		self.cache.declare(0x2100, 0x2104, regcache.CACHEABLE)
+		# Nothing that mustn't be done twice gets retransmitted: the
+		# IIC ISR (toggle on write), IIC TX/RX FIFOs, ICAP write FIFO.
+		self.cache.declare(0x2020, 0x2024, regcache.TOGGLE)
+		self.cache.declare(0x2108, 0x2110, regcache.FIFO)
+		self.cache.declare(0x4100, 0x4104, regcache.FIFO)
+
 	def readTemperature(self):
-		raw = self.read(0x1200)
+		return TOFBoard.temperature(self.read(0x1200))
+
+	# Convert a raw XADC temperature register value to degrees C.
+	@staticmethod
+	def temperature(raw):
 		raw = raw >> 4
 		return (raw*503.975)/4096 - 273.15
 		
 	def setLED(self, ledval):
 		self.write(0x0000, ledval)
 		
-	# Call this function at initialization to make sure
-	# we understand what state we're in.
+	# Put the I2C controller in a known state (done anyway before the
+	# first transfer).
 	def resetI2C(self):
-		self.write(0x2040, 0xA)
-		self.write(0x2100, 0x1)
+		self.i2c.reset()
 		
+	# I2C write to a device with 7 bit address 'dev'
+	# (NOTE SEVEN BIT ADDRESS! Not 8-bit!). The address and data go
+	# out as one TX_FIFO write. Returns False on a NAK, and raises
+	# retry.TransactionError if the board doesn't answer (see iic.py).
 	def writeI2C(self, dev, data):
-		# I2C write process (to a device with 7 bit address 'dev')
-		
-		# NOTE SEVEN BIT ADDRESS! Not 8-bit!
-		
-		# Try using the dynamic controller.
-		# write dev to TX_FIFO (0x2108) with start bit set (and stop if no bytes).
-		# write data to TX_FIFO. Last byte has stop bit set.
-		# read ISR. If int(2) is set, transmit is done. If int(1) is set, got a nack.
-		if len(data) == 0:
-			self.write(0x2108, (dev << 1) | 0x300)
-		else:
-                        self.write(0x2108, (dev << 1) | 0x100)
-			# set the last bit in the data
-                	data[-1] = data[-1] |0x200
-#                	data.insert(0,dev << 1 | 0x100) #Delay between writes is 0.5 ms. To make one write command (dev+data) try this line. But, code breaks
-                	self.write(0x2108, data)
-		# now read until something is set in the ISR
-		val = None
-		while True:
-			val = self.read(0x2020)
-			if val & 0x6:
-				break
-		
-		self.write(0x2020, val)				
-		if val & 0x2:
-			print "TX error"
-			# reset FIFO, I guess...?
-			self.write(0x2100, 0x2)
-			self.write(0x2100, 0x0)
-			self.write(0x2020, val)
-			return False
-		else:
-			return True
+		return self.i2c.write(dev, data)
 
+	# I2C read of 'length' bytes from 7 bit address 'dev'.
+	# Returns the bytes, or False on a NAK. A read that loses a request
+	# partway raises rather than being redone, since the device has
+	# moved on.
 	def readI2C(self, dev, length):
-		# I2C read process (to a device with 7 bit address 'dev')
-		# Read len bytes.
-		# Write address + start bit (0x100) with read makes (0x101)
-		if length==0:
-			return []
-		self.write(0x2108, (dev<<1) | 0x101)
-		self.write(0x2108, length | 0x200)
-		# now read until RX_FIFO not empty
-		rxd=[]
-		while len(rxd)<length:
-			val = self.read(0x2104)
-			isr = self.read(0x2020)
-                       # print val
-                       # print isr
-			if not (val & 0x40): #only is true when val & 0x40 is 0 entirely. 0x40 in binary is ,0100,0000
-				rxd.append(self.read(0x210C)) #0x210C is the address for RX_FIFO
-			if isr & 0x2:
-				print "TX error" #
-				self.write(0x2100, 0x2) #Control register address: 0x2=00000010 1 here resets the TX_FIFO
-				self.write(0x2100, 0x1) #control register address: 0x0=00000000 0 now TX_FIFO normal operations
-				self.write(0x2020, isr)
-#				self.write(isr, 0x2020)
-				return False
-		# I need to check somehow that things haven't gone horribly wrong.
+		rxd = self.i2c.read(dev, length)
+		if rxd == None:
+			return False
+		return rxd
+
+	# Write 'register' (a byte or a list of them), then read 'length'
+	# bytes back after a repeated start.
+	def readI2CRegister(self, dev, register, length):
+		rxd = self.i2c.read(dev, length, register)
+		if rxd == None:
+			return False
 		return rxd
-		
 		
 	def reprogram(self, filename):
 		self.spi.program_mcs(filename)
@@ -263,11 +1058,26 @@ class TOFProto(UDPFPGA):
 		# step 2: write 0x1 into control register to initiate write (0x410C)
 		# from UG470		
 		data = [ 0xFFFFFFFF, 0xAA995566, 0x20000000, 0x30020001, address, 0x30008001, 0x0000000F, 0x20000000 ]
-		self.write(0x4100, data)
+		b = self.batch()
+		b.write(0x4100, data)
 		# This write has to be a write without acknowledge.
-		self.write(0x410C, 0x1, no_acknowledge=True)
+		b.write(0x410C, 0x1, no_acknowledge=True)
+		b.execute()
+		# none of the registers are what we left them as anymore
+		self.cache.invalidate()
+		self.i2c.ready = False
 		# poof goes the FPGA
 		print "FPGA reloaded."
+
+# A board over the network. Opening one only costs finding it.
+class TOFProto(TOFBoard, UDPFPGA):
+	def __init__(self, dna=None, ip=None, controller=None):
+		UDPFPGA.__init__(self, controller)
+		if ip != None:
+			UDPFPGA.assign_ip(self, dna, ip)
+		elif UDPFPGA.connect(self, dna):
+			print "Connected to device %x" % self.target_dna
+		self.setup()
 # base addrs: 0000 = gpio
 #             1000 = xadc
 #             2000 = IIC